@@ -0,0 +1,401 @@
+import json
+import uuid
+
+from pbk.util.remote import get_transport, is_local_host
+from pbk.util.histogram import LatencyHistogram
+from pbk.util.descriptors import ValueChecked
+from pbk.execution import TestExecutor
+
+# Data directions fio reports results for
+DIRECTIONS = ['read', 'write', 'trim']
+
+
+def _first_json_document(stdout):
+    """
+    fio can print warnings before its JSON output, skip everything before the first '{'
+    """
+    start = stdout.find('{')
+    if start < 0:
+        raise ValueError(f'No JSON in fio output: {stdout}')
+    document, _ = json.JSONDecoder().raw_decode(stdout, start)
+    return document
+
+
+def parse_latency(latency):
+    """
+    Summary of one of fio's latency objects (clat_ns, slat_ns, lat_ns)
+
+    :return: dict(min, max, mean, stddev, count, percentiles={percentile: ns}, histogram) with numeric keys and
+      values, or None if the object is missing. histogram is a LatencyHistogram built from the bins of json+
+      output, or None for plain json output.
+    """
+    if not latency:
+        return None
+    bins = latency.get('bins')
+    return dict(min=latency.get('min'), max=latency.get('max'), mean=latency.get('mean'),
+                stddev=latency.get('stddev'), count=latency.get('N'),
+                percentiles={float(percentile): value for percentile, value in latency.get('percentile', {}).items()},
+                histogram=LatencyHistogram.from_fio_bins(bins) if bins else None)
+
+
+def merge_latencies(latencies, percentiles=(1, 5, 10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 99, 99.5, 99.9, 99.95,
+                                            99.99)):
+    """
+    Combine the parse_latency summaries of several jobs. Percentiles are computed from the merged histograms, so
+      they are only available when every job has a histogram (json+ output).
+
+    :return: parse_latency style dict or None
+    """
+    latencies = [latency for latency in latencies if latency and latency['count']]
+    if not latencies:
+        return None
+    count = sum(latency['count'] for latency in latencies)
+    merged = dict(min=min(latency['min'] for latency in latencies), max=max(latency['max'] for latency in latencies),
+                  mean=sum(latency['mean'] * latency['count'] for latency in latencies) / count, stddev=None,
+                  count=count, percentiles={}, histogram=None)
+    if all(latency['histogram'] is not None for latency in latencies):
+        merged['histogram'] = LatencyHistogram.merge_all(latency['histogram'] for latency in latencies)
+        merged['percentiles'] = dict(zip((float(p) for p in percentiles), merged['histogram'].percentiles(percentiles)))
+    return merged
+
+
+def parse_direction(stats):
+    """
+    Results of one data direction of a fio job
+
+    :param stats: the 'read', 'write' or 'trim' object of a job
+    :return: dict of numeric results or None if the direction had no I/O
+    """
+    if not stats or not stats.get('total_ios', stats.get('io_bytes')):
+        return None
+    bw_bytes = stats['bw_bytes'] if 'bw_bytes' in stats else stats['bw'] * 1024
+    return dict(iops=float(stats['iops']), bw_bytes=float(bw_bytes),
+                io_bytes=int(stats['io_bytes']), total_ios=stats.get('total_ios'), runtime_ms=stats.get('runtime'),
+                clat_ns=parse_latency(stats.get('clat_ns')), slat_ns=parse_latency(stats.get('slat_ns')),
+                lat_ns=parse_latency(stats.get('lat_ns')))
+
+
+def parse_fio_json(stdout):
+    """
+    Parse the output of `fio --output-format=json` or `json+`
+
+    :param stdout:
+    :return: see parse_fio_document
+    """
+    return parse_fio_document(_first_json_document(stdout))
+
+
+def parse_fio_document(document):
+    """
+    Results of a decoded fio JSON document
+
+    :param document: dict
+    :return: dict with
+      jobs: list of dict(name, <direction>=parse_direction(...)) for each reported job (one per group with
+        group_reporting)
+      <direction>: totals of each direction over all jobs: iops and bw_bytes are summed, latency percentiles come
+        from the merged histograms, see merge_latencies
+      fio_version
+    """
+    jobs = []
+    for job in document.get('jobs', []):
+        parsed = dict(name=job.get('jobname'), error=job.get('error', 0))
+        for direction in DIRECTIONS:
+            parsed[direction] = parse_direction(job.get(direction))
+        jobs.append(parsed)
+
+    result = dict(fio_version=document.get('fio version'), jobs=jobs)
+    for direction in DIRECTIONS:
+        stats = [job[direction] for job in jobs if job[direction]]
+        if not stats:
+            result[direction] = None
+        elif len(stats) == 1:
+            result[direction] = stats[0]
+        else:
+            result[direction] = dict(iops=sum(stat['iops'] for stat in stats),
+                                     bw_bytes=sum(stat['bw_bytes'] for stat in stats),
+                                     io_bytes=sum(stat['io_bytes'] for stat in stats),
+                                     total_ios=sum(stat['total_ios'] or 0 for stat in stats),
+                                     runtime_ms=max(stat['runtime_ms'] or 0 for stat in stats))
+            for latency in ('clat_ns', 'slat_ns', 'lat_ns'):
+                result[direction][latency] = merge_latencies(stat[latency] for stat in stats)
+    return result
+
+
+class FioStatusParser(object):
+
+    def __init__(self):
+        """
+        Incremental parser for the output of `fio --status-interval=N --output-format=json`. fio prints a complete
+          JSON document every interval and a final one at the end. Feed output as it arrives and complete documents
+          are returned as soon as their last byte is in.
+
+        A decode is only attempted once a line starting with '}' arrived (fio's documents end with a closing brace
+          at the start of a line), so large documents that arrive in many chunks aren't re-parsed for every chunk.
+        """
+        self.buffer = ''
+        self.decoder = json.JSONDecoder()
+
+    def feed(self, text):
+        """
+        :param text: the next piece of stdout
+        :return: list of the documents completed by this piece
+        """
+        tail = self.buffer[-1:] if self.buffer else '\n'
+        self.buffer += text
+        if '\n}' not in tail + text:
+            return []
+
+        documents = []
+        while True:
+            start = self.buffer.find('{')
+            end = self.buffer.find('\n}', start)
+            if start < 0 or end < 0:
+                break
+            try:
+                document, end = self.decoder.raw_decode(self.buffer, start)
+            except json.JSONDecodeError:
+                # Not a complete document (e.g. a warning was printed in the middle of it). Drop it up to the
+                #   closing brace so the documents after it can still be parsed.
+                self.buffer = self.buffer[end + 2:]
+                continue
+            documents.append(document)
+            self.buffer = self.buffer[end:]
+        return documents
+
+
+def _snapshot_totals(document, direction):
+    """
+    Cumulative totals of one direction over all jobs of a status document
+    """
+    totals = dict(total_ios=0, io_bytes=0, runtime_ms=0, clat_sum_ns=0.0, clat_count=0, clat_histogram=None)
+    for job in document.get('jobs', []):
+        stats = job.get(direction)
+        if not stats:
+            continue
+        totals['total_ios'] += stats.get('total_ios', 0)
+        totals['io_bytes'] += stats.get('io_bytes', 0)
+        totals['runtime_ms'] = max(totals['runtime_ms'], stats.get('runtime', 0))
+        clat = stats.get('clat_ns') or {}
+        totals['clat_sum_ns'] += clat.get('mean', 0.0) * clat.get('N', 0)
+        totals['clat_count'] += clat.get('N', 0)
+        if clat.get('bins'):
+            histogram = LatencyHistogram.from_fio_bins(clat['bins'])
+            totals['clat_histogram'] = histogram if totals['clat_histogram'] is None else \
+                totals['clat_histogram'].merge(histogram)
+    return totals
+
+
+def interval_series(documents):
+    """
+    Turn a list of cumulative status documents into per interval rates
+
+    :param documents: fio JSON documents in the order they were printed
+    :return: {direction: dict(elapsed_s=[...], iops=[...], bw_bytes=[...], clat_mean_ns=[...], clat_p99_ns=[...])}
+      with one entry per interval. elapsed_s is the measured runtime at the end of the interval. clat_p99_ns comes
+      from the difference of consecutive histograms and is None without json+ bins. Directions without I/O are left
+      out. Intervals without measured runtime (e.g. during ramp_time) are skipped.
+    """
+    series = {}
+    for direction in DIRECTIONS:
+        columns = dict(elapsed_s=[], iops=[], bw_bytes=[], clat_mean_ns=[], clat_p99_ns=[])
+        previous = dict(total_ios=0, io_bytes=0, runtime_ms=0, clat_sum_ns=0.0, clat_count=0, clat_histogram=None)
+        for document in documents:
+            current = _snapshot_totals(document, direction)
+            runtime_s = (current['runtime_ms'] - previous['runtime_ms']) / 1000
+            if runtime_s <= 0:
+                continue
+            ios = current['total_ios'] - previous['total_ios']
+            clat_count = current['clat_count'] - previous['clat_count']
+            columns['elapsed_s'].append(current['runtime_ms'] / 1000)
+            columns['iops'].append(ios / runtime_s)
+            columns['bw_bytes'].append((current['io_bytes'] - previous['io_bytes']) / runtime_s)
+            columns['clat_mean_ns'].append(
+                (current['clat_sum_ns'] - previous['clat_sum_ns']) / clat_count if clat_count > 0 else None)
+            histogram = current['clat_histogram']
+            if histogram is not None and previous['clat_histogram'] is not None:
+                histogram = histogram - previous['clat_histogram']
+            columns['clat_p99_ns'].append(histogram.percentile(99) if histogram is not None else None)
+            previous = current
+        if any(columns['iops']):
+            series[direction] = columns
+    return series
+
+
+class FioTest(TestExecutor):
+    RW_MODES = ['read', 'write', 'trim', 'randread', 'randwrite', 'randtrim', 'rw', 'readwrite', 'randrw',
+                'trimwrite']
+
+    rw = ValueChecked(allowed_values=RW_MODES, prop_name='rw', allow_none=False)
+
+    def __init__(self, host=None, username=None, password=None, key_filename=None, device=None, blocksize='4k',
+                 rwmixread=100, numjobs=1, iodepth=1, rw='randrw', runtime=60, ramp_time=0, size=None,
+                 ioengine='libaio', direct=True, job_options=None, transport='auto', timeout=None, status_interval=None,
+                 *args, **kwargs):
+        """
+        Run a single fio job against a block device or a regular file
+
+        :param device: block device or file to test. For a regular file also set size.
+        :param blocksize: fio bs
+        :param rwmixread: percentage of reads for the mixed rw modes
+        :param numjobs: number of fio jobs. Results are reported for the whole group.
+        :param iodepth: queue depth per job
+        :param rw: one of RW_MODES
+        :param runtime: seconds to run, time based
+        :param ramp_time: seconds to run before measuring
+        :param size: fio size, required when device is a file that doesn't exist yet
+        :param ioengine: fio ioengine, e.g. libaio, io_uring, psync
+        :param direct: use O_DIRECT
+        :param job_options: dict of additional fio options for the job
+        :param timeout: seconds to wait for fio, defaults to runtime + ramp_time + 60
+        :param status_interval: seconds between fio status reports. When set the output is streamed and parsed
+          while fio runs and the result includes a per interval 'series', see interval_series
+        """
+        super().__init__(*args, **kwargs)
+        self.host = host
+        self.username = username
+        self.password = password
+        self.key_filename = key_filename
+        self.device = device
+        self.blocksize = blocksize
+        self.rwmixread = int(rwmixread)
+        self.numjobs = int(numjobs)
+        self.iodepth = int(iodepth)
+        self.rw = rw
+        self.runtime = runtime
+        self.ramp_time = ramp_time
+        self.size = size
+        self.ioengine = ioengine
+        self.direct = direct
+        self.job_options = dict(job_options) if job_options else {}
+        self.transport = transport
+        self.timeout = timeout if timeout is not None else runtime + ramp_time + 60
+        self.status_interval = status_interval
+
+        if host is None:
+            raise ValueError(f'Host needs a non-None value')
+        if device is None:
+            raise ValueError(f'A device or file to test is required')
+
+        local = transport == 'local' or (transport == 'auto' and is_local_host(host, username))
+        if key_filename is None and password is None and not local:
+            raise ValueError(f'A password or key_filename must be provided for host authentication')
+
+    def __str__(self):
+        return str(dict(host=self.host, device=self.device, rw=self.rw, blocksize=self.blocksize,
+                        rwmixread=self.rwmixread, numjobs=self.numjobs, iodepth=self.iodepth))
+
+    def setup(self):
+        self.logger.status(f'Starting setup for test: {self}')
+
+    def teardown(self):
+        self.logger.status(f'Doing teardown for test: {self}')
+
+    def _get_transport(self):
+        return get_transport(host=self.host, username=self.username, password=self.password,
+                             key_filename=self.key_filename, logger=self.logger, transport=self.transport)
+
+    def job_options_list(self):
+        """
+        The fio options of the job as a list of (option, value) pairs. A value of None is a flag.
+        """
+        options = [('filename', self.device), ('rw', self.rw), ('bs', self.blocksize), ('numjobs', self.numjobs),
+                   ('iodepth', self.iodepth), ('ioengine', self.ioengine), ('direct', int(bool(self.direct))),
+                   ('time_based', None), ('runtime', self.runtime), ('group_reporting', None)]
+        if self.rw in ('rw', 'readwrite', 'randrw'):
+            options.append(('rwmixread', self.rwmixread))
+        if self.ramp_time:
+            options.append(('ramp_time', self.ramp_time))
+        if self.size is not None:
+            options.append(('size', self.size))
+        options += list(self.job_options.items())
+        return options
+
+    def build_job_file(self):
+        """
+        :return: the text of the fio job file
+        """
+        lines = ['[pbk]']
+        for option, value in self.job_options_list():
+            lines.append(option if value is None else f'{option}={value}')
+        return '\n'.join(lines) + '\n'
+
+    def fio_arguments(self):
+        arguments = ['--output-format=json+']
+        if self.status_interval:
+            arguments.append(f'--status-interval={self.status_interval}')
+        return arguments
+
+    def build_command(self):
+        """
+        Shell command that writes the job file to a temporary file on the host, runs fio on it and removes it
+        """
+        delimiter = f'PBK_FIO_JOB_{uuid.uuid4().hex}'
+        arguments = ' '.join(self.fio_arguments())
+        return (f'job=$(mktemp /tmp/pbk-fio.XXXXXX) || exit 1\n'
+                f'cat > "$job" <<\'{delimiter}\'\n'
+                f'{self.build_job_file()}'
+                f'{delimiter}\n'
+                f'fio {arguments} "$job"; rc=$?; rm -f "$job"; exit $rc')
+
+    def _run_streaming(self, transport, command):
+        """
+        Run fio with status reports, parsing each report as it arrives
+
+        :return: (list of status documents, stderr, exit_status). The last document is fio's final report.
+        """
+        parser = FioStatusParser()
+        documents = []
+        stderr = []
+        with transport.stream(command, timeout=self.timeout, mode='text') as command_stream:
+            for stream_name, text in command_stream:
+                if stream_name == 'stderr':
+                    stderr.append(text)
+                    continue
+                for document in parser.feed(text):
+                    documents.append(document)
+                    iops = {direction: sum(job.get(direction, {}).get('iops', 0) for job in document.get('jobs', []))
+                            for direction in DIRECTIONS}
+                    self.logger.verbose(f'fio status {len(documents)}: ' + ', '.join(
+                        f'{direction} iops={iops[direction]:.0f}' for direction in DIRECTIONS if iops[direction]))
+        return documents, ''.join(stderr), command_stream.exit_status
+
+    def parse_output(self, stdout, documents=None):
+        """
+        Parse the complete output of the command from build_command. Also used when the command was started by
+          something else, e.g. a synchronized cluster launch.
+
+        :param stdout:
+        :param documents: the status documents if they were already parsed while streaming
+        :return: parse_fio_json result, with a 'series' when status_interval is set
+        """
+        if not self.status_interval:
+            return parse_fio_json(stdout)
+
+        if documents is None:
+            documents = FioStatusParser().feed(stdout)
+        if not documents:
+            raise ValueError(f'No JSON in fio output: {stdout}')
+        result = parse_fio_document(documents[-1])
+        result['series'] = interval_series(documents)
+        return result
+
+    def execute(self):
+        self.logger.status(f'Starting execution of test: {self}')
+        command = self.build_command()
+        transport = self._get_transport()
+        self.logger.debug(f'Sending fio job to: {self.host}\n{self.build_job_file()}')
+        documents = None
+        if self.status_interval:
+            documents, stderr, exit_status = self._run_streaming(transport, command)
+            stdout = ''
+        else:
+            stdout, stderr, exit_status = transport.run(command, timeout=self.timeout)
+        if exit_status != 0:
+            raise RuntimeError(f'fio failed with exit code {exit_status}: {stderr or stdout}')
+
+        result = self.parse_output(stdout, documents=documents)
+        self.logger.result(f'{self}: ' + ', '.join(
+            f'{direction} iops={result[direction]["iops"]:.0f} bw={result[direction]["bw_bytes"]:.0f}B/s'
+            for direction in DIRECTIONS if result[direction]))
+        return result
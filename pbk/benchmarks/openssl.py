@@ -1,22 +1,195 @@
+import re
 import ipaddress
+import collections
 
-from pbk.util.remote import send_ssh_command
+from pbk.util.remote import get_transport, is_local_host
 from pbk.util.descriptors import ValueChecked
 from pbk.execution import TestExecutor
 
+SCALING_MODES = ['multi', 'pinned']
+
+# Public key algorithms are benchmarked by name, everything else goes through `-evp` unless evp is disabled
+ASYMMETRIC_PREFIXES = ('rsa', 'dsa', 'ecdsa', 'ecdh', 'ed25519', 'ed448', 'sm2', 'ffdh')
+
+# Machine readable result rows of public key algorithms: +F<n>:<index>:<bits>[:<name>]:<values>
+ASYMMETRIC_ROWS = {
+    '+F2': ('rsa', False, ('sign', 'verify')),
+    '+F3': ('dsa', False, ('sign', 'verify')),
+    '+F4': ('ecdsa', False, ('sign', 'verify')),
+    '+F5': ('ecdh', False, ('derive', 'seconds_per_derive')),
+    '+F6': ('eddsa', True, ('sign', 'verify')),
+    '+F7': ('sm2', True, ('sign', 'verify')),
+    '+F8': ('ffdh', False, ('derive', 'seconds_per_derive')),
+}
+# ecdsa and ecdh rows only carry the index of the curve in openssl speed's table, and curves share bit sizes (p256
+#   and brp256r1). These are the names openssl speed knows the curves by, in table order.
+EC_CURVES = ('p160', 'p192', 'p224', 'p256', 'p384', 'p521', 'k163', 'k233', 'k283', 'k409', 'k571', 'b163', 'b233',
+             'b283', 'b409', 'b571', 'brp256r1', 'brp256t1', 'brp384r1', 'brp384t1', 'brp512r1', 'brp512t1', 'x25519',
+             'x448')
+
+
+def is_asymmetric(algorithm):
+    return algorithm.lower().startswith(ASYMMETRIC_PREFIXES)
+
+
+def row_name(kind, index, bits):
+    """
+    Name of an unnamed public key row: the openssl speed algorithm name for ecdsa and ecdh curves (e.g. ecdsap256,
+      ecdhbrp256r1), '<type><bits>' for the others
+    """
+    if kind in ('ecdsa', 'ecdh'):
+        return f'{kind}{EC_CURVES[index]}' if index < len(EC_CURVES) else f'{kind}{bits}-{index}'
+    return f'{kind}{bits}'
+
+
+def parse_cpu_list(text):
+    """
+    :param text: a cpu list like '0-3,8,10-11', as in /sys/devices/system/cpu/online or taskset -c
+    :return: list of int
+    """
+    cpus = []
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def parse_mr_output(stdout):
+    """
+    Parse the machine readable (`-mr`) output of openssl speed. Handles the output of any number of algorithms in
+      one run. Lines that are not result rows (e.g. the +DT/+R progress lines if stderr was merged) are ignored.
+
+    :param stdout:
+    :return: dict with
+      block_sizes: list of int, the block sizes of the symmetric rows
+      symmetric: {algorithm: {block_size: bytes per second}} for ciphers, digests and MACs
+      asymmetric: list of dict(type, index, bits, name, <operation>=ops per second, ...). Signature algorithms
+        have 'sign' and 'verify', key exchange algorithms have 'derive' and 'seconds_per_derive'. name is the
+        curve name for eddsa and sm2 rows and see row_name for the others.
+    :raises ValueError: if the output has no result rows
+    """
+    result = dict(block_sizes=[], symmetric={}, asymmetric=[])
+    for line in stdout.splitlines():
+        fields = line.strip().split(':')
+        tag = fields[0]
+        try:
+            if tag == '+H':
+                result['block_sizes'] = [int(size) for size in fields[1:]]
+            elif tag == '+F':
+                values = [float(value) for value in fields[3:]]
+                result['symmetric'][fields[2]] = dict(zip(result['block_sizes'], values))
+            elif tag in ASYMMETRIC_ROWS:
+                kind, named, operations = ASYMMETRIC_ROWS[tag]
+                index, bits = int(fields[1]), int(fields[2])
+                name = fields[3] if named else row_name(kind, index, bits)
+                values = [float(value) for value in fields[4 if named else 3:]]
+                row = dict(type=kind, index=index, bits=bits, name=name)
+                row.update(zip(operations, values))
+                result['asymmetric'].append(row)
+        except (IndexError, ValueError):
+            raise ValueError(f'Malformed openssl speed result line: {line}')
+
+    if not result['symmetric'] and not result['asymmetric']:
+        raise ValueError(f'No openssl speed results in output: {stdout}')
+    return result
+
+
+def sum_mr_results(results):
+    """
+    Add up the parsed results of instances that ran at the same time
+
+    :param results: list of parse_mr_output results
+    :return: one parse_mr_output style result with summed rates. seconds_per_derive is recomputed from the sum.
+    """
+    total = dict(block_sizes=results[0]['block_sizes'], symmetric={}, asymmetric=[])
+    for algorithm, rates in results[0]['symmetric'].items():
+        total['symmetric'][algorithm] = {
+            block_size: sum(result['symmetric'][algorithm][block_size] for result in results) for block_size in rates}
+
+    rows = [{(row['type'], row['name']): row for row in result['asymmetric']} for result in results]
+    for row in results[0]['asymmetric']:
+        summed = dict(row)
+        for operation in ('sign', 'verify', 'derive'):
+            if operation in row:
+                summed[operation] = sum(result[(row['type'], row['name'])][operation] for result in rows)
+        if summed.get('derive'):
+            summed['seconds_per_derive'] = 1 / summed['derive']
+        total['asymmetric'].append(summed)
+    return total
+
+
+# Output of `openssl speed -multi N`: every child's machine readable lines are echoed as "Got: <line> from <child>"
+MULTI_LINE = re.compile(r'^Got: (?P<line>\+\S+) from (?P<instance>\d+)$')
+# Output of the pinned instances: every line is prefixed with the cpu the instance ran on
+PINNED_LINE = re.compile(r'^(?P<instance>\d+) (?P<line>\+\S+)$')
+
+
+def scaling_curve(points, saturation_gain=0.1):
+    """
+    Add speedup and parallel efficiency to the points of a throughput vs instances sweep and find the saturation
+      point: the last instance count before adding instances gains less than saturation_gain of the single instance
+      throughput per added instance.
+
+    :param points: list of dict(instances=N, throughput=total, per_instance=[...]) sorted by instances
+    :param saturation_gain: fraction of the single instance throughput an added instance has to contribute
+    :return: dict(curve=points, peak_throughput, peak_instances, saturation_point)
+    """
+    if not points:
+        return dict(curve=[], peak_throughput=None, peak_instances=None, saturation_point=None)
+
+    base = points[0]
+    per_instance_base = base['throughput'] / base['instances']
+    saturation_point = None
+    previous = None
+    for point in points:
+        ideal = per_instance_base * point['instances']
+        point['speedup'] = point['throughput'] / per_instance_base if per_instance_base else None
+        point['efficiency'] = point['throughput'] / ideal if ideal else None
+        if previous is not None and saturation_point is None:
+            added = point['instances'] - previous['instances']
+            gain = (point['throughput'] - previous['throughput']) / added
+            if gain < saturation_gain * per_instance_base:
+                saturation_point = previous['instances']
+        previous = point
+
+    peak = max(points, key=lambda point: point['throughput'])
+    return dict(curve=points, peak_throughput=peak['throughput'], peak_instances=peak['instances'],
+                saturation_point=saturation_point if saturation_point is not None else points[-1]['instances'])
+
 
 class OpenSSLTest(TestExecutor):
-    ALGORITHMS = ['md2', 'md4', 'md5', 'hmac', 'sha1', 'sha256', 'sha512', 'whirlpoolrmd160', 'idea-cbc', 'seed-cbc',
-                  'rc2-cbc', 'rc5-cbc', 'bf-cbc', 'des-cbc', 'des-ede3', 'aes-128-cbc', 'aes-192-cbc', 'aes-256-cbc',
-                  'aes-128-ige', 'aes-192-ige', 'aes-256-ige', 'camellia-128-cbc', 'camellia-192-cbc',
+    ALGORITHMS = ['md2', 'md4', 'md5', 'hmac', 'sha1', 'sha256', 'sha512', 'whirlpool', 'rmd160', 'idea-cbc',
+                  'seed-cbc', 'rc2-cbc', 'rc5-cbc', 'bf-cbc', 'des-cbc', 'des-ede3', 'aes-128-cbc', 'aes-192-cbc',
+                  'aes-256-cbc', 'aes-128-ige', 'aes-192-ige', 'aes-256-ige', 'camellia-128-cbc', 'camellia-192-cbc',
                   'camellia-256-cbc', 'rc4', 'rsa512', 'rsa1024', 'rsa2048', 'rsa4096', 'dsa512', 'dsa1024', 'dsa2048',
-                  'ecdsap256', 'ecdsap384', 'ecdsap521', 'ecdsa', 'ecdhp256', 'ecdhp384', 'ecdhp521', 'ecdh', 'idea',
-                  'seed', 'rc2', 'des', 'aes', 'camellia', 'rsa', 'blowfish']
+                  'ecdsap256', 'ecdsap384', 'ecdsap521', 'ecdsa', 'ecdhp256', 'ecdhp384', 'ecdhp521', 'ecdh', 'ed25519',
+                  'ed448', 'idea', 'seed', 'rc2', 'des', 'aes', 'camellia', 'rsa', 'blowfish']
 
     algorithm = ValueChecked(allowed_values=ALGORITHMS, prop_name='algorithm', allow_none=False)
 
     def __init__(self, host=None, username=None, password=None, key_filename=None, engine=None, algorithm='aes-128-cbc',
-                 parallel=1, decrypt=False, *args, **kwargs):
+                 parallel=1, decrypt=False, transport='auto', scaling=None, scaling_steps=None, block_size=None,
+                 seconds=None, saturation_gain=0.1, timeout=120, algorithms=None, evp=True, *args, **kwargs):
+        """
+        :param algorithm: algorithm to benchmark. Public key algorithms (rsa, dsa, ecdsa, ecdh, ed25519, ...) are run
+          by name, others through `-evp`.
+        :param parallel: number of openssl speed instances to run at once (`-multi`). In scaling mode the largest
+          instance count of the sweep, with 1 meaning all cores of the host.
+        :param scaling: None for a single run, 'multi' to sweep `openssl speed -multi N` or 'pinned' to sweep N
+          instances pinned with taskset to the first N cpus the host lets openssl run on (its cpu affinity). The
+          result is a throughput vs instances curve.
+        :param scaling_steps: instance counts of the sweep. Defaults to every count from 1 to parallel.
+        :param block_size: block size whose bytes/s is the throughput of the scaling curve. Defaults to the largest.
+        :param seconds: seconds per measurement (`-seconds`), openssl's default is 3 per block size
+        :param saturation_gain: see scaling_curve
+        :param timeout: seconds to wait for a single openssl speed run
+        :param algorithms: list of algorithms to profile in one round trip instead of the single algorithm. Public
+          key algorithms (and, with evp=False, all others) share a single openssl speed invocation. With evp=True
+          each cipher and digest gets its own `-evp` invocation, all sent as one batch over one connection.
+        :param evp: benchmark ciphers and digests through the EVP interface, which uses hardware acceleration
+        """
         super().__init__(*args, **kwargs)
         self.host = host
         self.username = username
@@ -26,32 +199,188 @@ class OpenSSLTest(TestExecutor):
         self.algorithm = algorithm
         self.parallel = parallel
         self.decrypt = decrypt
+        self.transport = transport
+        self.scaling = scaling
+        self.scaling_steps = list(scaling_steps) if scaling_steps is not None else None
+        self.block_size = block_size
+        self.seconds = seconds
+        self.saturation_gain = saturation_gain
+        self.timeout = timeout
+        self.algorithms = list(algorithms) if algorithms is not None else None
+        self.evp = evp
+
+        for name in self.algorithms or []:
+            if name not in self.ALGORITHMS:
+                raise ValueError(f'Value: "{name}" is not of the available options: {str(self.ALGORITHMS)}')
+        if scaling is not None and self.algorithms:
+            raise ValueError('Scaling mode measures a single algorithm, algorithms can not be used with it')
+
+        if scaling is not None and scaling not in SCALING_MODES:
+            raise ValueError(f'Scaling mode must be one of {SCALING_MODES}, not: {scaling}')
 
         if host is None:
             raise ValueError(f'Host needs a non-None value')
 
-        if key_filename is None and password is None:
+        local = transport == 'local' or (transport == 'auto' and is_local_host(host, username))
+        if key_filename is None and password is None and not local:
             raise ValueError(f'A password or key_filename must be provided for host authentication')
 
     def __str__(self):
-        return str(dict(host=self.host, engine=self.engine, algorithm=self.algorithm, parallel=self.parallel,
-                        decrypt=self.decrypt))
+        return str(dict(host=self.host, engine=self.engine, algorithm=self.algorithms or self.algorithm,
+                        parallel=self.parallel, decrypt=self.decrypt, scaling=self.scaling))
 
     def setup(self):
         self.logger.status(f'Starting setup for test: {self}')
 
+    def _get_transport(self):
+        return get_transport(host=self.host, username=self.username, password=self.password,
+                             key_filename=self.key_filename, logger=self.logger, transport=self.transport)
+
+    def _speed_command(self, algorithms=None, instances=1):
+        """
+        openssl speed command line for one `-evp` algorithm or any number of algorithms run by name
+        """
+        algorithms = algorithms or [self.algorithm]
+        cmd = ['openssl', 'speed', '-elapsed', '-mr']
+        if self.seconds:
+            cmd += ['-seconds', str(self.seconds)]
+        if instances > 1:
+            # Options have to come before the algorithm names
+            cmd += ['-multi', str(instances)]
+        if len(algorithms) == 1 and self.evp and not is_asymmetric(algorithms[0]):
+            cmd += ['-evp', algorithms[0]]
+            if self.decrypt:
+                cmd.append('-decrypt')
+        else:
+            cmd += algorithms
+        return ' '.join(cmd)
+
+    def profile_commands(self):
+        """
+        The openssl speed commands that together cover self.algorithms
+        """
+        by_name = [name for name in self.algorithms if is_asymmetric(name) or not self.evp]
+        commands = [self._speed_command(by_name)] if by_name else []
+        commands += [self._speed_command([name]) for name in self.algorithms if name not in by_name]
+        return commands
+
+    def measure_profile(self, transport=None):
+        """
+        Benchmark all of self.algorithms in one round trip
+
+        :return: parse_mr_output style dict with the rows of all algorithms
+        """
+        transport = transport or self._get_transport()
+        commands = self.profile_commands()
+        self.logger.debug(f'Sending {len(commands)} commands to: {self.host}')
+        outputs = transport.send_commands(commands, timeout=self.timeout * len(self.algorithms))
+
+        profile = dict(block_sizes=[], symmetric={}, asymmetric=[])
+        for command, (stdout, stderr, exit_code) in zip(commands, outputs):
+            if exit_code != 0:
+                raise RuntimeError(f'Command "{command}" failed with exit code {exit_code}: {stderr}')
+            parsed = self._parse_mr_stdout(stdout)
+            profile['block_sizes'] = parsed['block_sizes'] or profile['block_sizes']
+            profile['symmetric'].update(parsed['symmetric'])
+            profile['asymmetric'] += parsed['asymmetric']
+        return profile
+
+    def _run_instances(self, transport, instances, cpus=None):
+        """
+        Run `instances` concurrent openssl speed processes in a single remote command
+
+        :param cpus: cpus the host allows, see _cpu_list. Required in pinned mode.
+        :return: list with the parsed output of each instance
+        """
+        command = self._speed_command()
+        if self.scaling == 'pinned':
+            if instances > len(cpus):
+                raise ValueError(f'Pinned mode needs a cpu per instance, {self.host} allows {len(cpus)} cpus: {cpus}')
+            cpus = ' '.join(str(cpu) for cpu in cpus[:instances])
+            command = (f'for cpu in {cpus}; do taskset -c $cpu {command} 2>/dev/null | sed "s/^/$cpu /" & done; '
+                       f'wait')
+            pattern = PINNED_LINE
+        elif instances > 1:
+            command = self._speed_command(instances=instances)
+            pattern = MULTI_LINE
+        else:
+            pattern = None
+
+        self.logger.debug(f'Sending command: {command} to: {self.host}')
+        stdout, stderr = transport.send_command(command, timeout=self.timeout)
+        if pattern is None:
+            return [self._parse_mr_stdout(stdout)]
+
+        lines = collections.defaultdict(list)
+        for line in stdout.splitlines():
+            match = pattern.match(line.strip())
+            if match:
+                lines[match.group('instance')].append(match.group('line'))
+        if len(lines) != instances:
+            raise RuntimeError(f'Expected output from {instances} openssl speed instances, got {len(lines)}: '
+                               f'{stdout} {stderr}')
+        return [self._parse_mr_stdout('\n'.join(instance_lines)) for instance_lines in lines.values()]
+
+    def _throughput(self, parsed):
+        """
+        Throughput of one instance: bytes per second at the scaling block size for symmetric algorithms, operations
+          per second (sign or derive) for public key algorithms
+        """
+        if parsed['symmetric']:
+            rates = next(iter(parsed['symmetric'].values()))
+            block_size = int(self.block_size) if self.block_size is not None else max(rates)
+            return rates[block_size]
+        row = parsed['asymmetric'][0]
+        return row['sign'] if 'sign' in row else row['derive']
+
+    def _core_count(self, transport):
+        stdout, stderr = transport.send_command('nproc', timeout=self.timeout)
+        return int(stdout.strip())
+
+    def _cpu_list(self, transport):
+        """
+        The cpus processes on the host may run on: the affinity of the remote shell, which honors cpusets and
+          offline cpus
+        """
+        stdout, stderr = transport.send_command('taskset -cp $$', timeout=self.timeout)
+        _, separator, cpus = stdout.rpartition(':')
+        if not separator:
+            raise RuntimeError(f'Could not get the cpu affinity of {self.host}: {stdout} {stderr}')
+        return parse_cpu_list(cpus)
+
+    def measure_scaling(self, transport=None):
+        """
+        Run the scaling sweep
+
+        :return: dict, see scaling_curve. Also includes the core count of the host.
+        """
+        transport = transport or self._get_transport()
+        cores = self._core_count(transport)
+        cpus = self._cpu_list(transport) if self.scaling == 'pinned' else None
+        steps = self.scaling_steps or list(range(1, (self.parallel if self.parallel > 1 else cores) + 1))
+
+        points = []
+        for instances in sorted(steps):
+            per_instance = [self._throughput(parsed) for parsed in self._run_instances(transport, instances, cpus)]
+            points.append(dict(instances=instances, throughput=sum(per_instance), per_instance=per_instance))
+            self.logger.verbose(f'{instances} instances of {self.algorithm}: {sum(per_instance)}')
+
+        curve = scaling_curve(points, saturation_gain=self.saturation_gain)
+        curve['cores'] = cores
+        return curve
+
     def execute(self):
         self.logger.status(f'Starting execution of test: {self}')
-        cmd = ['openssl', 'speed', '-evp', self.algorithm, '-elapsed', '-mr']
-        if self.decrypt:
-            cmd += '-decrypt'
+        transport = self._get_transport()
+        if self.scaling is not None:
+            result = self.measure_scaling(transport)
+        elif self.algorithms:
+            result = self.measure_profile(transport)
+        else:
+            result = sum_mr_results(self._run_instances(transport, self.parallel))
 
-        self.logger.debug(f'Sending command: {cmd} with: {self.host} {self.username} {self.password}')
-        stdout, stderr = send_ssh_command(command=cmd, host=self.host, username=self.username, password=self.password,
-                                          key_filename=self.key_filename, logger=self.logger)
-
-        result = self._parse_mr_stdout(stdout)
         self.logger.result(f'{result}')
+        return result
 
     def teardown(self):
         self.logger.status(f'Doing teardown for test: {self}')
@@ -59,10 +388,6 @@ class OpenSSLTest(TestExecutor):
     @staticmethod
     def _parse_mr_stdout(stdout):
         try:
-            block_sizes, kbytes_per_sec = stdout.split()
-            block_sizes = block_sizes.split(':')[1:]
-            kbytes_per_sec = kbytes_per_sec.split(':')[3:]
-
-            return dict(zip(block_sizes, kbytes_per_sec))
-        except:
-            return dict(error=stdout)
+            return parse_mr_output(stdout)
+        except ValueError as e:
+            raise RuntimeError(f'Unable to parse openssl speed output: {e}')
@@ -1,8 +1,16 @@
+import os
 import abc
+import copy
+import logging
+import collections
+import concurrent.futures
 
 from pbk.util.perflogger import LoggedObject
 from pbk.util.descriptors import TypeChecked, ValueChecked
 from pbk.util.persist import PersistentMutableSequence
+from pbk.util.designs import ParameterSpace, expand, coarse_to_fine
+from pbk.util.stats import summarize
+from pbk.util.cluster import SynchronizedLaunch, aggregate_series
 
 
 class PersistentTypeChecked(TypeChecked):
@@ -37,8 +45,20 @@ class TestList:
 
 class TestResult:
 
-    def __init__(self, *args, **kwargs):
-        pass
+    def __init__(self, data=None, samples=None, metric=None, statistics=None, *args, **kwargs):
+        """
+        :param data: the return value of the test's execute(), or of its last repetition
+        :param samples: list of the metric value of every repetition
+        :param metric: name of the primary metric the samples were taken from
+        :param statistics: summary of the samples, see pbk.util.stats.summarize, plus 'converged'
+        """
+        self.data = data
+        self.samples = list(samples) if samples is not None else []
+        self.metric = metric
+        self.statistics = statistics if statistics is not None else {}
+
+    def __repr__(self):
+        return f'TestResult(metric={self.metric!r}, samples={self.samples}, statistics={self.statistics})'
 
     def write_to_datastore(self):
         """
@@ -47,14 +67,167 @@ class TestResult:
         """
 
 
+class RepetitionController(object):
+
+    def __init__(self, metric=None, target_relative_width=0.05, confidence=0.95, min_repetitions=3,
+                 max_repetitions=30):
+        """
+        Decides how many times to repeat a test. Repetitions continue until the confidence interval of the mean of
+          the primary metric is narrower than target_relative_width of the mean, bounded by min_repetitions and
+          max_repetitions. Stable tests stop after min_repetitions, noisy tests get more samples.
+
+        :param metric: how to get the primary metric from the return value of execute(). None uses the value
+          itself, a string is used as a key (dict results) or attribute name, a callable is called with the value.
+          Use a module level function if the test list is pickled.
+        :param target_relative_width: full width of the confidence interval divided by the mean, e.g. 0.05 for +-2.5%
+        :param confidence: confidence level of the interval, see pbk.util.stats.CONFIDENCES
+        :param min_repetitions: never stop before this many repetitions, at least 2
+        :param max_repetitions: always stop after this many repetitions
+        """
+        self.metric = metric
+        self.target_relative_width = target_relative_width
+        self.confidence = confidence
+        self.min_repetitions = max(2, int(min_repetitions))
+        self.max_repetitions = max(self.min_repetitions, int(max_repetitions))
+        self.samples = []
+
+    def reset(self):
+        self.samples = []
+
+    def extract(self, value):
+        if self.metric is None:
+            return float(value)
+        if callable(self.metric):
+            return float(self.metric(value))
+        if isinstance(value, dict):
+            return float(value[self.metric])
+        return float(getattr(value, self.metric))
+
+    def add(self, value):
+        """
+        Record the return value of one repetition
+        """
+        self.samples.append(self.extract(value))
+
+    def summary(self):
+        summary = summarize(self.samples, confidence=self.confidence)
+        summary['converged'] = self.converged
+        return summary
+
+    @property
+    def converged(self):
+        if len(self.samples) < self.min_repetitions:
+            return False
+        relative_width = summarize(self.samples, confidence=self.confidence)['relative_ci_width']
+        return relative_width <= self.target_relative_width
+
+    @property
+    def done(self):
+        return len(self.samples) >= self.max_repetitions or self.converged
+
+
 class TestExecutor(abc.ABC, LoggedObject):
     STATUSES = ['completed', 'pending', 'failed']
     result = PersistentTypeChecked(allowed_type=TestResult, prop_name='result', allow_none=True)
     parent = PersistentTypeChecked(allowed_type=TestList, prop_name='parent', allow_none=True)
     status = PersistentValueChecked(allowed_values=STATUSES, prop_name='status', allow_none=True)
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, resources=None, repetition=None, *args, **kwargs):
+        """
+        :param resources: tags of resources this test needs exclusively, in addition to its host. See resources
+        :param repetition: RepetitionController. When set, run() repeats execute() until the primary metric
+          converges and stores the samples and their statistics in self.result
+        """
         super().__init__(*args, **kwargs)
+        # Set the initial values without going through the descriptors, there is nothing to persist yet
+        self.__dict__.setdefault('result', None)
+        self.__dict__.setdefault('parent', None)
+        self.__dict__.setdefault('status', 'pending')
+        self.resource_tags = list(resources) if resources is not None else []
+        self.repetition = repetition
+
+    @property
+    def resources(self):
+        """
+        Tags of the resources this test needs exclusively. Two tests that share a tag are never run at the same time
+          by a TestScheduler. A test with a `host` attribute always holds 'host:<host>'; add tags like
+          'device:<host>:<device>' through the resources argument.
+        """
+        tags = set(self.__dict__.get('resource_tags') or ())
+        host = getattr(self, 'host', None)
+        if host is not None:
+            tags.add(f'host:{host}')
+        return frozenset(tags)
+
+    def run(self):
+        """
+        Run setup, execute and teardown for this test and store what execute() returned in self.result. A test that
+          raises is marked 'failed', a test that returns without setting its status is marked 'completed'.
+
+        :return: TestResult, None if the test failed
+        """
+        try:
+            self.setup()
+            try:
+                if getattr(self, 'repetition', None) is not None:
+                    self.execute_repeated()
+                else:
+                    self.result = TestResult(data=self.execute())
+            finally:
+                self.teardown()
+        except Exception as e:
+            self.logger.error(f'Test {self} failed: {type(e).__name__}: {e}')
+            self.status = 'failed'
+            return None
+
+        if self.status not in ('completed', 'failed'):
+            self.status = 'completed'
+        return self.result
+
+    def execute_repeated(self, controller=None):
+        """
+        Call execute() until the repetition controller is done and store the samples in self.result
+
+        :param controller: RepetitionController, defaults to self.repetition. The samples are collected in a copy,
+          so one controller can be shared by tests that run in parallel.
+        :return: TestResult
+        """
+        controller = copy.copy(controller or self.repetition)
+        controller.reset()
+        value = None
+        while not controller.done:
+            value = self.execute()
+            controller.add(value)
+
+        summary = controller.summary()
+        self.logger.verbose(f'Test {self} ran {summary["count"]} repetitions, mean: {summary["mean"]}, '
+                            f'relative CI width: {summary["relative_ci_width"]}, converged: {summary["converged"]}')
+        self.result = TestResult(data=value, samples=controller.samples, statistics=summary,
+                                 metric=controller.metric if isinstance(controller.metric, str) else None)
+        return self.result
+
+    def persist(self):
+        """
+        Called by the persistent descriptors whenever result, parent or status change. A test only gets persisted as
+          a member of a TestList.
+        """
+        parent = self.__dict__.get('parent')
+        if parent is not None:
+            parent.persist_item(self)
+
+    def __getstate__(self):
+        # The parent is re-attached by the TestList when it is loaded. Pickling it here would write the whole list
+        #   every time a single member is persisted. Loggers and log queues are tied to the running process.
+        state = self.__dict__.copy()
+        for key in ('parent', 'logger', 'log_queue'):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__['parent'] = None
+        self.log_queue = None
+        self.logger = logging.getLogger(state.get('logger_name') or self.__class__.__name__)
 
     @abc.abstractmethod
     def setup(self):
@@ -73,7 +246,8 @@ class TestExecutor(abc.ABC, LoggedObject):
     @abc.abstractmethod
     def execute(self):
         """
-        The self.execute method should set the self.result and self.status properties and return the result object
+        Run the test once and return its data. run() stores it in self.result, or hands every repetition to the
+          RepetitionController when the test has one.
 
         :return:
         """
@@ -87,6 +261,14 @@ class TestList(PersistentMutableSequence):
         TestList is effectively a version of PersistentMutableSequence that checks the type of member objects
         and assigns a value to the members' 'parent' attribute so that members can call the .persist() method
 
+        For large test plans use storage='journal' so each status or result change appends a single record
+        instead of rewriting the whole list, or storage='sqlite' to keep one row per test with an indexed status
+        and load tests only when they are accessed. A persisted TestList can be reopened with
+        TestList.load(filename, storage=...).
+
+        Bookkeeping writes from the members' persistent descriptors can be coalesced with `with test_list.batch():`
+        or with durability='group', which commits dirty members from a background thread every group_commit_ms.
+
         :param args:
         :param kwargs:
         """
@@ -97,51 +279,396 @@ class TestList(PersistentMutableSequence):
         if not isinstance(obj, TestList.member_type):
             raise TypeError(f'Members of TestList must be of type {TestList.member_type}, not {type(obj)}')
 
-    def _set_member_parent(self, index):
-        self[index].parent = self
+    def _set_member_parent(self, value):
+        # Set the parent before the member is added. The member isn't in the list yet so this doesn't write
+        #   anything, and the record for the insert already includes the member's full state.
+        value.parent = self
+
+    def _on_member_loaded(self, member):
+        member.__dict__['parent'] = self
+
+    def next_index(self, statuses=('pending',), start=0):
+        """
+        Position of the next test with one of the given statuses, or None if there is none
+        """
+        return self.find_status(statuses, start=start)
+
+    def iter_indices(self, statuses=('pending',)):
+        """
+        Positions of all tests with one of the given statuses, in order
+        """
+        position = self.next_index(statuses)
+        while position is not None:
+            yield position
+            position = self.next_index(statuses, start=position + 1)
 
     def __setitem__(self, index, value):
         self._check_obj_type(value)
+        self._set_member_parent(value)
         super().__setitem__(index, value)
-        self._set_member_parent(index)
 
     def insert(self, index, value):
         self._check_obj_type(value)
+        self._set_member_parent(value)
         super().insert(index, value)
-        self._set_member_parent(index)
+
+
+# The parent descriptor was created with the placeholder TestList above, point it at the real class
+vars(TestExecutor)['parent'].allowed_type = TestList
+
+
+class TestScheduler(object):
+
+    def __init__(self, test_list, workers=4, statuses=('pending',), logger=None):
+        """
+        Runs the tests of a TestList concurrently on a pool of worker threads while honoring each test's resources:
+          tests on different hosts run in parallel, tests that share a host (or any other resource tag) run one at
+          a time in list order. Each test persists its own status and result as it completes.
+
+        Pending tests are grouped by their set of resources, so picking the next runnable test costs one look at
+          each group instead of a scan of the whole list.
+
+        :param test_list: TestList
+        :param workers: maximum number of tests running at once
+        :param statuses: statuses of the tests that should be run
+        :param logger:
+        """
+        self.test_list = test_list
+        self.workers = max(1, int(workers))
+        self.statuses = tuple(statuses)
+        self.logger = logger
+
+    def _build_queues(self):
+        queues = collections.OrderedDict()
+        for position in self.test_list.iter_indices(self.statuses):
+            resources = self.test_list[position].resources
+            queues.setdefault(resources, collections.deque()).append(position)
+        return queues
+
+    def _next_runnable(self, queues, busy):
+        # Of all groups whose resources are free, take the one whose next test comes first in the list
+        candidates = [resources for resources, queue in queues.items() if queue and not (resources & busy)]
+        if not candidates:
+            return None, None
+        resources = min(candidates, key=lambda tags: queues[tags][0])
+        return resources, queues[resources].popleft()
+
+    def run(self):
+        """
+        Run all selected tests and block until they are done
+
+        :return: dict of {status: count} for the tests that were run
+        """
+        queues = self._build_queues()
+        total = sum(len(queue) for queue in queues.values())
+        if self.logger: self.logger.status(f'Scheduling {total} tests on {self.workers} workers')
+
+        busy = set()
+        running = {}
+        counts = collections.Counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers,
+                                                   thread_name_prefix='pbk-test') as executor:
+            while True:
+                while len(running) < self.workers:
+                    resources, position = self._next_runnable(queues, busy)
+                    if position is None:
+                        break
+                    test = self.test_list[position]
+                    busy.update(resources)
+                    running[executor.submit(test.run)] = (test, resources)
+
+                if not running:
+                    break
+
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    test, resources = running.pop(future)
+                    busy.difference_update(resources)
+                    counts[test.status] += 1
+                    if self.logger: self.logger.verbose(f'Test {test} finished with status {test.status}')
+
+        if self.logger: self.logger.status(f'Scheduler finished: {dict(counts)}')
+        return dict(counts)
+
+
+class ClusterTest(TestExecutor):
+
+    def __init__(self, tests=None, window=1.0, start_delay=1.0, stage_timeout=60, timeout=600, *args, **kwargs):
+        """
+        Run one test per host as a single cluster wide test. The member tests' commands are staged on every host and
+          released at the same instant (see pbk.util.cluster.SynchronizedLaunch), then each host's output is parsed
+          by its own test and the per host series are summed into cluster throughput over aligned windows.
+
+        Member tests provide host, username, password, key_filename and transport attributes, build_command() and
+          parse_output(stdout), like FioTest does. Each host is reached with the credentials of its own member. To
+          get a cluster series the members need to produce a 'series' (e.g. FioTest with status_interval).
+
+        :param tests: list of member tests, one per host
+        :param window: width in seconds of the aggregation windows
+        :param start_delay: see SynchronizedLaunch
+        :param stage_timeout: see SynchronizedLaunch
+        :param timeout: see SynchronizedLaunch
+        """
+        super().__init__(*args, **kwargs)
+        self.tests = list(tests or [])
+        self.window = window
+        self.start_delay = start_delay
+        self.stage_timeout = stage_timeout
+        self.timeout = timeout
+
+        hosts = [test.host for test in self.tests]
+        if not hosts or len(set(hosts)) != len(hosts):
+            raise ValueError(f'ClusterTest needs member tests on distinct hosts, got: {hosts}')
+
+    def __str__(self):
+        return f'ClusterTest({[str(test) for test in self.tests]})'
+
+    @property
+    def resources(self):
+        # The cluster test needs every host of its members
+        return frozenset().union(*(test.resources for test in self.tests))
+
+    def setup(self):
+        for test in self.tests:
+            test.setup()
+
+    def teardown(self):
+        for test in self.tests:
+            test.teardown()
+
+    def execute(self):
+        self.logger.status(f'Starting execution of test: {self}')
+        credentials = {test.host: dict(username=test.username, password=test.password, key_filename=test.key_filename,
+                                       transport=test.transport) for test in self.tests}
+        launch = SynchronizedLaunch([test.host for test in self.tests], credentials=credentials,
+                                    start_delay=self.start_delay, stage_timeout=self.stage_timeout,
+                                    timeout=self.timeout, logger=self.logger)
+        launched = launch.run({test.host: test.build_command() for test in self.tests})
+
+        hosts = {}
+        for test in self.tests:
+            outcome = launched['hosts'][test.host]
+            if outcome['error'] is not None or outcome['exit_status'] != 0:
+                raise RuntimeError(f'Host {test.host} failed with exit status {outcome["exit_status"]}: '
+                                   f'{outcome["error"] or outcome["stderr"]}')
+            hosts[test.host] = test.parse_output(outcome['stdout'])
+
+        skews = [abs(outcome['skew_ns']) for outcome in launched['hosts'].values() if outcome['skew_ns'] is not None]
+        result = dict(hosts=hosts, start_ns=launched['start_ns'], max_start_skew_ns=max(skews) if skews else None,
+                      series={})
+        directions = set().union(*(host_result.get('series', {}) for host_result in hosts.values()))
+        for direction in sorted(directions):
+            result['series'][direction] = aggregate_series(
+                {host: host_result['series'][direction] for host, host_result in hosts.items()
+                 if direction in host_result.get('series', {})}, window=self.window)
+
+        self.logger.result(f'{self}: max start skew {result["max_start_skew_ns"]} ns')
+        return result
 
 
 class TestSequence(abc.ABC):
     test_list = TypeChecked(TestList, "test_list")
+    # Subclasses define the axes to sweep, e.g. {'blocksize': ['4k', '1m'], 'numjobs': [1, 4]}
+    parameter_space = None
 
-    def __init__(self):
+    # Set by open_test_list when an existing test list file was reopened
+    resumed = False
+
+    def __init__(self, filename=None, storage='journal', resume=True, retry_failed=False, **test_list_kwargs):
         """
         TestSequence supports context manager usage:
 
         with TestSequenceClass(**params) as ts:
             while ts.tests_remaining:
-                result = ts.execute_next
+                result = ts.execute_next()
+
+        When a filename is given the test list is persisted there. If the file already exists and resume is True
+          the sequence picks up where it stopped: completed tests keep their status and results and execution
+          continues with the first test that did not complete. A test that was running when the process died never
+          got its status set, so it is run again.
+
+        :param filename: file of the persisted TestList. Without one the TestList goes to a temporary file and the
+          sequence can't be resumed.
+        :param storage: storage of the TestList, see PersistentMutableSequence
+        :param resume: reopen filename if it exists. Otherwise an existing file raises FileExistsError.
+        :param retry_failed: when resuming, also run the tests that failed before. Their old results are kept until
+          the new run replaces them.
+        :param test_list_kwargs: passed to TestList, e.g. durability='group'
+        """
+        if filename is not None:
+            self.open_test_list(filename, storage=storage, resume=resume, retry_failed=retry_failed,
+                                **test_list_kwargs)
+        else:
+            self.test_list = TestList(storage=storage, **test_list_kwargs)
+            self.resumed = False
+            self._cursor = 0
+
+    def open_test_list(self, filename, storage='journal', resume=True, retry_failed=False, **test_list_kwargs):
+        """
+        Set self.test_list to a new TestList at filename or, when resuming, to the TestList persisted there
 
+        :return: True if an existing test list was reopened
+        """
+        if os.path.exists(filename):
+            if not resume:
+                raise FileExistsError(f'Test list {filename} already exists. Use resume=True to continue it.')
+            self.test_list = TestList.load(filename, storage=storage, **test_list_kwargs)
+            self.resumed = True
+            if retry_failed:
+                self.reset_failed()
+        else:
+            self.test_list = TestList(filename=filename, storage=storage, **test_list_kwargs)
+            self.resumed = False
+        self._cursor = 0
+        return self.resumed
+
+    def reset_failed(self):
+        """
+        Mark all failed tests as pending so they run again
 
+        :return: number of tests reset
         """
-        pass
+        positions = list(self.test_list.iter_indices(('failed',)))
+        with self.test_list.batch():
+            for position in positions:
+                self.test_list[position].status = 'pending'
+        self._cursor = 0
+        return len(positions)
+
+    def progress(self):
+        """
+        :return: dict of {status: count} over the whole test list
+        """
+        return {status: self.test_list.count_status(status) for status in TestExecutor.STATUSES}
+
+    @property
+    def tests_remaining(self):
+        return self.next_pending() is not None
+
+    def next_pending(self):
+        """
+        Position of the next pending test. Positions before the last one handed out are not searched again.
+        """
+        position = self.test_list.next_index(start=getattr(self, '_cursor', 0))
+        if position is None and getattr(self, '_cursor', 0):
+            # Something before the cursor may have been reset to pending
+            position = self.test_list.next_index()
+        return position
 
-    @abc.abstractmethod
     def execute_next(self):
         """
         Method to execute the next pending test
 
-        :return:
+        :return: the TestResult of the test, see TestExecutor.run. None if the test failed or no test is pending.
         """
+        position = self.next_pending()
+        if position is None:
+            return None
+        self._cursor = position + 1
+        return self.test_list[position].run()
 
-    def build_test_list(self):
+    def run(self, workers=1, design='full', **design_kwargs):
         """
-        This builds out the standard set of all combinations. I think there is a combinations function
-        in python we can use for this
+        Build the test list (unless it was resumed) and execute every pending test
 
-        :return:
+        :param workers: run tests concurrently with a TestScheduler when more than 1
+        :param design: see build_test_list
+        :return: dict of {status: count} over the whole test list
+        """
+        if not self.resumed:
+            self.build_test_list(design=design, **design_kwargs)
+            # A crash from here on resumes this list rather than building a new one
+            self.resumed = True
+
+        if workers > 1:
+            self.execute_parallel(workers=workers)
+        else:
+            while self.tests_remaining:
+                self.execute_next()
+        return self.progress()
+
+    def execute_parallel(self, workers=4, logger=None):
         """
-        raise NotImplementedError
+        Execute all pending tests of self.test_list concurrently. Tests that share a host or another resource tag
+          are serialized, see TestScheduler.
+
+        :return: dict of {status: count}
+        """
+        return TestScheduler(self.test_list, workers=workers, logger=logger).run()
+
+    @abc.abstractmethod
+    def make_test(self, point):
+        """
+        Build the TestExecutor for one point of the parameter space
+
+        :param point: dict of {axis: level}
+        :return: TestExecutor
+        """
+
+    def get_parameter_space(self):
+        """
+        :return: self.parameter_space as a ParameterSpace
+        :raises ValueError: if the sequence doesn't define a parameter_space
+        """
+        if self.parameter_space is None:
+            raise ValueError(f'{type(self).__name__} does not define a parameter_space')
+        if isinstance(self.parameter_space, ParameterSpace):
+            return self.parameter_space
+        return ParameterSpace(self.parameter_space)
+
+    def iter_test_points(self, design='full', **design_kwargs):
+        """
+        Lazily expand self.parameter_space with the given design, see pbk.util.designs.expand
+
+        :return: generator of points
+        """
+        return expand(self.get_parameter_space(), design=design, **design_kwargs)
+
+    def run_coarse_to_fine(self, score, maximize=True, **search_kwargs):
+        """
+        Build and run the tests of a coarse to fine search, see pbk.util.designs.coarse_to_fine. The points of each
+          round depend on the scores of the rounds before, so every test is appended to the test list and run as
+          soon as its point comes up. Resuming a sequence only finishes its pending tests, the search isn't
+          continued.
+
+        :param score: callable taking the TestResult of a completed test and returning its score
+        :param maximize: True if a higher score is better. Failed tests get the worst score.
+        :param search_kwargs: stride, span, top and rounds, see coarse_to_fine
+        :return: list of (point, score) for every test run
+        """
+        worst = float('-inf') if maximize else float('inf')
+
+        def evaluate(point):
+            self.test_list.append(self.make_test(point))
+            position = len(self.test_list) - 1
+            self._cursor = position + 1
+            result = self.test_list[position].run()
+            return worst if result is None else score(result)
+
+        return coarse_to_fine(self.get_parameter_space(), evaluate, maximize=maximize, **search_kwargs)
+
+    def build_test_list(self, design='full', **design_kwargs):
+        """
+        Append a test to self.test_list for every point of the design. With the default 'full' design this is the
+          standard set of all combinations. The points are generated one at a time and the appends are written to
+          the test list file in one batch.
+
+        design='coarse_to_fine' runs the tests while it builds the list instead, see run_coarse_to_fine.
+
+        :param design: see pbk.util.designs.DESIGNS, or 'coarse_to_fine'
+        :param design_kwargs: arguments of the design, e.g. samples=20 for 'latin_hypercube' or score for
+          'coarse_to_fine'
+        :return: number of tests added
+        """
+        if design == 'coarse_to_fine':
+            return len(self.run_coarse_to_fine(**design_kwargs))
+
+        count = 0
+        with self.test_list.batch():
+            for point in self.iter_test_points(design=design, **design_kwargs):
+                self.test_list.append(self.make_test(point))
+                count += 1
+        return count
 
     @abc.abstractmethod
     def setup(self):
@@ -159,6 +686,12 @@ class TestSequence(abc.ABC):
 
     def __enter__(self):
         self.setup()
-
-    def __exit__(self):
-        self.teardown()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            self.teardown()
+        finally:
+            # Make sure buffered status changes reach the test list file, especially when we are exiting on an error
+            if 'test_list' in self.__dict__:
+                self.test_list.flush()
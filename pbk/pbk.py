@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import sys
 import argparse
 
 
@@ -20,6 +21,7 @@ def parse_arguments():
     subparsers = parser.add_subparsers(title='Benchmarks',)
     add_openssl_parser_options(subparsers, [parser])
     add_fio_parser_options(subparsers, [parser])
+    add_exec_parser_options(subparsers, [parser])
 
     # Run the parser
     arguments = parser.parse_args()
@@ -28,6 +30,19 @@ def parse_arguments():
     if arguments.host != 'localhost' and arguments.username is None:
         parser.error(f'`--username` must be provided for non-localhost benchmarks')
 
+    if getattr(arguments, 'action', None) == 'exec':
+        arguments.hosts = get_exec_hosts(arguments)
+        if not arguments.hosts:
+            parser.error('`exec` needs at least one host from `--hosts` or `--hosts-file`')
+        from pbk.util.remote import is_local_host
+        if arguments.username is None and not all(is_local_host(host) for host in arguments.hosts):
+            parser.error('`--username` must be provided for `exec` on non-localhost hosts')
+        if not arguments.commands:
+            parser.error('`exec` needs at least one `--command` to run')
+
+    if getattr(arguments, 'benchmark', None) == 'fio' and arguments.device is None:
+        parser.error('`fio` needs a `--device` to benchmark')
+
     # Return the dictionary representation
     return vars(arguments)
 
@@ -60,14 +75,108 @@ def add_fio_parser_options(subparsers, parents):
 
     fio_group = fio_parser.add_argument_group(title='fio',
                                               description='Options for FIO benchmarking')
-    fio_group.add_argument('--device', help="Device to benchmark")
+    fio_group.add_argument('--device', help="Device to benchmark. A regular file also works, together with --size")
     fio_group.add_argument('--blocksize', default='4k')
-    fio_group.add_argument('--rwmixread', default=100)
-    fio_group.add_argument('--numjobs', default=1)
+    fio_group.add_argument('--rwmixread', type=int, default=100)
+    fio_group.add_argument('--numjobs', type=int, default=1)
+    fio_group.add_argument('--iodepth', type=int, default=1)
+    fio_group.add_argument('--rw', default='randrw', help="fio access pattern, e.g. randread, randwrite, randrw")
+    fio_group.add_argument('--runtime', type=int, default=60, help="Seconds to run")
+    fio_group.add_argument('--size', help="Size of the test region. Required for files that don't exist yet")
+    fio_group.add_argument('--ioengine', default='libaio')
+    fio_group.add_argument('--status-interval', type=int,
+                           help="Seconds between fio status reports. Adds a per interval series to the result")
+
+
+def run_fio(arguments):
+    import json
+    from pbk.benchmarks.fio import FioTest
+
+    test = FioTest(host=arguments['host'], username=arguments['username'], key_filename=arguments['key_filename'],
+                   device=arguments['device'], blocksize=arguments['blocksize'], rwmixread=arguments['rwmixread'],
+                   numjobs=arguments['numjobs'], iodepth=arguments['iodepth'], rw=arguments['rw'],
+                   runtime=arguments['runtime'], size=arguments['size'], ioengine=arguments['ioengine'],
+                   status_interval=arguments['status_interval'])
+    test.run()
+    if test.status != 'completed':
+        return 1
+
+    # Latency histograms are printed in their compact form
+    print(json.dumps(test.result.data, indent=2, default=lambda obj: obj.to_dict()))
+    return 0
+
+
+def add_exec_parser_options(subparsers, parents):
+    # Set up the parser for running ad-hoc commands across a fleet
+    exec_parser = subparsers.add_parser("exec",
+                                        parents=parents,
+                                        help="Run a command on many hosts concurrently and group hosts with "
+                                             "identical output",
+                                        add_help=False)
+    exec_parser.set_defaults(action='exec')
+
+    exec_group = exec_parser.add_argument_group(title='exec',
+                                                description='Options for fleet command execution')
+    exec_group.add_argument('--hosts', help="Comma separated list of hosts")
+    exec_group.add_argument('--hosts-file', help="File with one host per line. Lines starting with # are ignored")
+    exec_group.add_argument('--concurrency', type=int, default=64, help="Maximum number of hosts in flight")
+    exec_group.add_argument('--timeout', type=float, default=60, help="Per-host timeout in seconds")
+    exec_group.add_argument('--command', action='append', dest='commands',
+                            help="Command to run on every host. Can be given multiple times, all commands are sent "
+                                 "to a host in a single round trip")
+
+
+def get_exec_hosts(arguments):
+    hosts = []
+    if arguments.hosts:
+        hosts.extend(host.strip() for host in arguments.hosts.split(','))
+    if arguments.hosts_file:
+        with open(arguments.hosts_file) as hosts_file:
+            hosts.extend(line.strip() for line in hosts_file if not line.strip().startswith('#'))
+
+    return [host for host in hosts if host]
+
+
+def run_exec(arguments):
+    from pbk.util.fleet import FleetExecutor, aggregate_results
+
+    fleet = FleetExecutor(arguments['hosts'], username=arguments['username'], key_filename=arguments['key_filename'],
+                          concurrency=arguments['concurrency'], timeout=arguments['timeout'])
+    commands = arguments['commands']
+    if len(commands) > 1:
+        host_results = fleet.execute(commands=commands)
+    else:
+        host_results = fleet.execute(command=commands[0])
+
+    for host_result, hosts in aggregate_results(host_results):
+        print(f'===== {len(hosts)} host(s): {", ".join(sorted(hosts))}')
+        if host_result.error is not None:
+            print(f'ERROR: {host_result.error}')
+            continue
+
+        for command, (stdout, stderr, exit_code) in zip(commands, host_result.results):
+            if len(commands) > 1:
+                print(f'--- {command}')
+            if stdout:
+                print(stdout, end='' if stdout.endswith('\n') else '\n')
+            if stderr:
+                print(stderr, end='' if stderr.endswith('\n') else '\n', file=sys.stderr)
+            if exit_code != 0:
+                print(f'(exit code: {exit_code})')
+
+    failed = [host_result.host for host_result in host_results if not host_result.ok]
+    if failed:
+        print(f'{len(failed)} of {len(host_results)} host(s) failed', file=sys.stderr)
+    return 1 if failed else 0
 
 
 def main():
     arguments = parse_arguments()
+    if arguments.get('action') == 'exec':
+        sys.exit(run_exec(arguments))
+    if arguments.get('benchmark') == 'fio':
+        sys.exit(run_fio(arguments))
+
     print(arguments)
 
 
@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import fcntl
+import shlex
+import threading
+import contextlib
+
+# Seconds a probed executable is trusted before it is probed again
+DEFAULT_TTL = 3600
+
+
+def build_probe_command(executables):
+    """
+    One shell command that looks up every executable and prints a "name=path" line for each, with an empty path for
+      the ones that are missing
+    """
+    names = ' '.join(shlex.quote(executable) for executable in executables)
+    return f'for e in {names}; do p=$(command -v "$e") || p=; echo "$e=$p"; done'
+
+
+def probe_executables(transport, executables, timeout=60):
+    """
+    Look up executables on a host in a single round trip
+
+    :param transport: Transport of the host
+    :param executables: list of executable names
+    :return: dict of {executable: path or None}
+    """
+    executables = list(dict.fromkeys(executables))
+    if not executables:
+        return {}
+    stdout, _ = transport.send_command(build_probe_command(executables), timeout=timeout)
+    found = {}
+    for line in stdout.splitlines():
+        name, separator, path = line.partition('=')
+        if separator:
+            found[name] = path.strip() or None
+    return {executable: found.get(executable) for executable in executables}
+
+
+class CapabilityCache(object):
+
+    def __init__(self, path=None, ttl=DEFAULT_TTL):
+        """
+        Per host cache of which executables exist and where. Lookups only probe the executables that aren't cached or
+          have expired, all of them in one round trip (see probe_executables).
+
+        Entries live in memory and, when a path is given, in a JSON file shared by every process using the same
+          path. Lookups hold an exclusive flock on a sidecar lock file (path + '.lock') while they read the file,
+          probe and write the file, so captures running in separate processes for the same host probe the host once
+          between them. The file is replaced atomically on writes.
+
+        :param path: JSON file for the on disk cache, None keeps the cache in memory only
+        :param ttl: seconds an entry is valid
+        """
+        self.path = path
+        self.ttl = ttl
+        self.hosts = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'CapabilityCache(path={self.path!r}, hosts={len(self.hosts)})'
+
+    @staticmethod
+    def host_key(transport):
+        return f'{transport.name}:{transport.username}@{transport.host}'
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        Hold the lock of this process and, with a path, the flock of the lock file shared with other processes
+        """
+        with self._lock:
+            if self.path is None:
+                yield
+                return
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(f'{self.path}.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_file(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            # A damaged cache is only a reason to probe again
+            return
+        for host, entries in stored.items():
+            cached = self.hosts.setdefault(host, {})
+            for executable, entry in entries.items():
+                if executable not in cached or cached[executable]['probed_at'] < entry['probed_at']:
+                    cached[executable] = entry
+
+    def _write_file(self):
+        if self.path is None:
+            return
+        temporary = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(self.hosts, f)
+        os.replace(temporary, self.path)
+
+    def _fresh(self, host, executables, now):
+        cached = self.hosts.get(host, {})
+        return {executable: cached[executable]['path'] for executable in executables
+                if executable in cached and now - cached[executable]['probed_at'] < self.ttl}
+
+    def lookup(self, transport, executables, timeout=60):
+        """
+        :param transport: Transport of the host
+        :param executables: list of executable names
+        :return: dict of {executable: path or None}
+        """
+        executables = list(dict.fromkeys(executables))
+        host = self.host_key(transport)
+        with self._locked():
+            now = time.time()
+            paths = self._fresh(host, executables, now)
+            if len(paths) < len(executables):
+                self._read_file()
+                paths = self._fresh(host, executables, now)
+
+            missing = [executable for executable in executables if executable not in paths]
+            if missing:
+                probed = probe_executables(transport, missing, timeout=timeout)
+                probed_at = time.time()
+                self.hosts.setdefault(host, {}).update(
+                    {executable: dict(path=path, probed_at=probed_at) for executable, path in probed.items()})
+                self._write_file()
+                paths.update(probed)
+
+        return {executable: paths[executable] for executable in executables}
+
+    def invalidate(self, transport=None):
+        """
+        Forget the entries of one host, or of every host
+        """
+        with self._locked():
+            self._read_file()
+            if transport is None:
+                self.hosts.clear()
+            else:
+                self.hosts.pop(self.host_key(transport), None)
+            self._write_file()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_capability_cache(path=None, ttl=DEFAULT_TTL):
+    """
+    The CapabilityCache of this process for a path, so every SystemInfo using the same cache file shares the
+      in memory entries as well
+    """
+    with _caches_lock:
+        key = None if path is None else os.path.abspath(path)
+        if key not in _caches:
+            _caches[key] = CapabilityCache(path=key, ttl=ttl)
+        _caches[key].ttl = ttl
+        return _caches[key]
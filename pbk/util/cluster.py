@@ -0,0 +1,216 @@
+import time
+import uuid
+import shlex
+import threading
+import concurrent.futures
+
+from pbk.util.remote import get_transport
+
+READY_MARKER = 'PBK-READY'
+START_MARKER = 'PBK-START'
+# Exit codes of the staging script when the launch is called off
+ABORTED = 125
+STAGE_TIMED_OUT = 124
+
+
+def measure_clock_offset(transport, samples=3, timeout=60):
+    """
+    Offset of a host's clock to ours with a single round trip per sample. The sample with the shortest round trip
+      wins as it bounds the error best.
+
+    :return: (offset_ns, round_trip_ns) where host time = local time + offset_ns
+    """
+    best = None
+    for _ in range(samples):
+        sent = time.time_ns()
+        stdout, stderr = transport.send_command('date +%s%N', timeout=timeout)
+        received = time.time_ns()
+        remote = int(stdout.strip())
+        round_trip = received - sent
+        if best is None or round_trip < best[1]:
+            best = (remote - (sent + received) // 2, round_trip)
+    return best
+
+
+def build_staged_script(command, release_file, stage_timeout=60):
+    """
+    Script that announces it is ready, waits for the release file to hold a start time (in the host's clock,
+      nanoseconds since the epoch), sleeps until that time and then replaces itself with the command. Writing
+      'abort' to the release file makes it exit with ABORTED.
+    """
+    polls = int(stage_timeout * 100)
+    release = shlex.quote(release_file)
+    script = (f'echo {READY_MARKER}\n'
+              f'i=0; while [ ! -s {release} ]; do sleep 0.01; i=$((i+1)); '
+              f'[ $i -gt {polls} ] && exit {STAGE_TIMED_OUT}; done\n'
+              f'read start < {release}; rm -f {release}\n'
+              f'[ "$start" = abort ] && exit {ABORTED}\n'
+              f'delay=$(awk -v s="$start" -v n="$(date +%s%N)" '
+              f'\'BEGIN {{ d = (s - n) / 1e9; if (d > 0) printf "%.6f", d; else print 0 }}\')\n'
+              f'sleep "$delay"\n'
+              f'echo "{START_MARKER} $(date +%s%N)"\n'
+              f'exec sh -c {shlex.quote(command)}')
+    return f'sh -c {shlex.quote(script)}'
+
+
+class SynchronizedLaunch(object):
+
+    def __init__(self, hosts, username=None, password=None, key_filename=None, transport='auto', start_delay=1.0,
+                 stage_timeout=60, timeout=600, credentials=None, logger=None):
+        """
+        Start a command on many hosts at the same instant.
+
+        Starting hosts one SSH session at a time spreads the start over the connection setup of every host. Instead
+          each host's command is staged first: the session is opened and the host waits on a release file. Once all
+          hosts are waiting (a barrier) the controller writes the same start time, converted to each host's own
+          clock, to every release file. Each host sleeps until that time and starts its command, so the skew is
+          bounded by the clock offset estimate instead of the session setup.
+
+        :param hosts: list of hosts
+        :param transport: 'auto', 'ssh' or 'local'
+        :param start_delay: seconds between the release and the start. Must cover writing all release files.
+        :param stage_timeout: seconds to wait for all hosts to be staged, and for a staged host to be released
+        :param timeout: seconds without output before a host's command is considered hung. Its stream is closed and
+          the host's outcome gets a TimeoutError. The silent wait for the release counts too, keep it above
+          stage_timeout + start_delay.
+        :param credentials: {host: dict(username, password, key_filename, transport)} for hosts that don't use the
+          username, password, key_filename and transport above. Missing keys fall back to those.
+        :param logger:
+        """
+        self.hosts = list(dict.fromkeys(hosts))
+        self.auth = dict(username=username, password=password, key_filename=key_filename, transport=transport)
+        self.credentials = {host: dict(self.auth, **(credentials or {}).get(host, {})) for host in self.hosts}
+        self.start_delay = start_delay
+        self.stage_timeout = stage_timeout
+        self.timeout = timeout
+        self.logger = logger
+
+        self.transports = {host: get_transport(host=host, logger=logger, **self.credentials[host])
+                           for host in self.hosts}
+
+    def _run_staged(self, host, command, release_file, ready):
+        outcome = dict(host=host, stdout=[], stderr=[], exit_status=None, start_ns=None, error=None)
+        script = build_staged_script(command, release_file, self.stage_timeout)
+        try:
+            with self.transports[host].stream(script, timeout=self.timeout, mode='lines') as command_stream:
+                for stream_name, line in command_stream:
+                    if stream_name == 'stdout' and line.startswith(READY_MARKER) and not ready.is_set():
+                        ready.set()
+                    elif stream_name == 'stdout' and line.startswith(START_MARKER) and outcome['start_ns'] is None:
+                        outcome['start_ns'] = int(line.split()[1])
+                    else:
+                        outcome[stream_name].append(line)
+            outcome['exit_status'] = command_stream.exit_status
+        except Exception as e:
+            outcome['error'] = f'{type(e).__name__}: {e}'
+
+        outcome['stdout'] = ''.join(outcome['stdout'])
+        outcome['stderr'] = ''.join(outcome['stderr'])
+        return outcome
+
+    def _wait_staged(self, ready, futures):
+        """
+        Wait until every host is staged, a host's command ended before it was staged, or stage_timeout passed
+
+        :return: True if every host is staged
+        """
+        deadline = time.time() + self.stage_timeout
+        while True:
+            waiting = [host for host, event in ready.items() if not event.is_set()]
+            if not waiting:
+                return True
+            if any(futures[host].done() for host in waiting) or time.time() >= deadline:
+                return False
+            ready[waiting[0]].wait(min(0.1, max(0, deadline - time.time())))
+
+    def _write_release(self, host, release_file, value):
+        quoted = shlex.quote(release_file)
+        self.transports[host].send_command(f'echo {value} > {quoted}.tmp && mv {quoted}.tmp {quoted}',
+                                           timeout=self.stage_timeout)
+
+    def run(self, commands):
+        """
+        :param commands: {host: command} or a single command for every host
+        :return: dict(start_ns, offsets_ns, hosts={host: dict(stdout, stderr, exit_status, start_ns, skew_ns, error)})
+          start_ns is the planned start in our clock. Each host's start_ns is converted to our clock and skew_ns is
+          its distance from the planned start.
+        :raises RuntimeError: if a host failed before it was released. The other hosts are aborted.
+        :raises TimeoutError: if a host wasn't staged within stage_timeout. The other hosts are aborted.
+        """
+        if isinstance(commands, str):
+            commands = {host: commands for host in self.hosts}
+        token = uuid.uuid4().hex
+        release_files = {host: f'/tmp/pbk-release.{token}.{index}' for index, host in enumerate(self.hosts)}
+
+        # Every host holds a worker for its staged command while another worker writes its release file
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2 * len(self.hosts) or 1,
+                                                   thread_name_prefix='pbk-cluster') as executor:
+            offsets = dict(zip(self.hosts, executor.map(lambda host: measure_clock_offset(self.transports[host])[0],
+                                                        self.hosts)))
+            if self.logger: self.logger.verbose(f'Clock offsets in ns: {offsets}')
+
+            ready = {host: threading.Event() for host in self.hosts}
+            futures = {host: executor.submit(self._run_staged, host, commands[host], release_files[host],
+                                             ready[host]) for host in self.hosts}
+
+            # The barrier: every host has to be staged before any is released. A staged command only ends once it
+            #   is released, so a host whose command is done before that failed.
+            staged = self._wait_staged(ready, futures)
+            failed = {host: future.result()['error'] or f'exit status {future.result()["exit_status"]}'
+                      for host, future in futures.items() if future.done()}
+            if not staged or failed:
+                list(executor.map(lambda host: self._write_release(host, release_files[host], 'abort'),
+                                  [host for host in self.hosts if host not in failed]))
+                if failed:
+                    raise RuntimeError(f'Hosts failed before they were released: {failed}')
+                stragglers = [host for host, event in ready.items() if not event.is_set()]
+                raise TimeoutError(f'Hosts were not staged within {self.stage_timeout} seconds: {stragglers}')
+
+            start_ns = time.time_ns() + int(self.start_delay * 1e9)
+            list(executor.map(lambda host: self._write_release(host, release_files[host], start_ns + offsets[host]),
+                              self.hosts))
+            if self.logger: self.logger.status(f'Released {len(self.hosts)} hosts to start at {start_ns}')
+
+            outcomes = {host: future.result() for host, future in futures.items()}
+
+        for host, outcome in outcomes.items():
+            if outcome['start_ns'] is not None:
+                outcome['start_ns'] -= offsets[host]
+                outcome['skew_ns'] = outcome['start_ns'] - start_ns
+            else:
+                outcome['skew_ns'] = None
+        return dict(start_ns=start_ns, offsets_ns=offsets, hosts=outcomes)
+
+
+def aggregate_series(series_by_host, window=1.0, columns=('iops', 'bw_bytes')):
+    """
+    Sum per host time series into cluster totals over aligned windows. Works on series like the ones of FioTest,
+      where elapsed_s is the time since the (synchronized) start at the end of each sample.
+
+    :param series_by_host: {host: dict(elapsed_s=[...], <column>=[...])}
+    :param window: width of the windows in seconds
+    :param columns: rate columns to sum. Samples of one host that fall into the same window are averaged first.
+    :return: dict(elapsed_s=[end of each window], hosts=[number of hosts with data in the window], <column>=[...])
+    """
+    windows = {}
+    for host, series in series_by_host.items():
+        per_window = {}
+        for position, elapsed in enumerate(series['elapsed_s']):
+            # A sample ending exactly on a window boundary belongs to the window it ends
+            index = max(0, int(-(-elapsed // window)) - 1)
+            per_window.setdefault(index, []).append(position)
+        for index, positions in per_window.items():
+            totals = windows.setdefault(index, dict(hosts=0, **{column: 0.0 for column in columns}))
+            totals['hosts'] += 1
+            for column in columns:
+                values = [series[column][position] for position in positions if series[column][position] is not None]
+                if values:
+                    totals[column] += sum(values) / len(values)
+
+    aggregate = dict(elapsed_s=[], hosts=[], **{column: [] for column in columns})
+    for index in sorted(windows):
+        aggregate['elapsed_s'].append((index + 1) * window)
+        aggregate['hosts'].append(windows[index]['hosts'])
+        for column in columns:
+            aggregate[column].append(windows[index][column])
+    return aggregate
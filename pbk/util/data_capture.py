@@ -1,19 +1,136 @@
+import os
 import abc
+import mmap
 import time
+import queue
+import pickle
+import shutil
+import weakref
+import tempfile
+import asyncio
 import logging
+import threading
+import concurrent.futures
 import logging.config
 import logging.handlers
 import multiprocessing
 import multiprocessing.queues
-import multiprocessing.managers
 
 from pbk.util.perflogger import get_queued_logger
 from pbk.util.descriptors import TypeChecked
 
+# States a capture process goes through, in order. The position in the tuple is the code kept in shared memory.
+CAPTURE_STATES = ('initializing', 'setuped', 'started', 'stopped', 'teardowned')
+FAILED_STATE = -1
+# How often a waiting manager checks that the capture processes are still alive. A capture that raises reports
+#   FAILED_STATE itself, this only matters for processes that are killed.
+LIVENESS_INTERVAL = 1.0
+
+
+# Pickled results up to this size travel inside their handle, larger ones are spilled to a file
+INLINE_RESULT_LIMIT = 64 * 1024
+# Out-of-band buffers (numpy arrays) in spill files start on this boundary so they can be mapped as arrays
+SPILL_ALIGNMENT = 64
+
+
+def state_name(code):
+    return 'failed' if code == FAILED_STATE else CAPTURE_STATES[code]
+
+
+class ResultHandle(object):
+
+    def __init__(self, data=None, payload=None, path=None, pickle_size=0, buffer_spans=(), error=None):
+        """
+        Small stand in for the result of one capture that is sent over the result queue instead of the result.
+
+        A handle holds the data itself (thread and asyncio runners share memory with the manager), a small pickled
+          payload, the path of a spill file, or the error of a capture that failed before it had a result.
+
+        Spill files hold a pickle (protocol 5) followed by its out-of-band buffers. load() memory maps the file, so
+          the buffers of numpy arrays are used in place instead of being copied through a pipe and again into the
+          manager.
+
+        :param data: the result itself
+        :param payload: the pickled result
+        :param path: spill file
+        :param pickle_size: bytes of pickle at the start of the spill file
+        :param buffer_spans: list of (offset, length) of the out-of-band buffers in the spill file
+        :param error: why the capture has no result
+        """
+        self.data = data
+        self.payload = payload
+        self.path = path
+        self.pickle_size = pickle_size
+        self.buffer_spans = list(buffer_spans)
+        self.error = error
+        self._loaded = payload is None and path is None and error is None
+
+    def __repr__(self):
+        if self.error is not None:
+            return f'ResultHandle(error={self.error!r})'
+        where = f'path={self.path}' if self.path else ('inline' if self.payload is not None else 'in memory')
+        return f'ResultHandle({where})'
+
+    @classmethod
+    def spill(cls, data, directory=None, inline_limit=INLINE_RESULT_LIMIT):
+        """
+        Handle for data that crosses a process boundary
+
+        :param data: the result, anything pickleable
+        :param directory: where to write spill files. None keeps the data in memory.
+        :param inline_limit: results that pickle to at most this many bytes are kept inline
+        :return: ResultHandle
+        """
+        if directory is None:
+            return cls(data=data)
+
+        buffers = []
+        payload = pickle.dumps(data, protocol=5, buffer_callback=buffers.append)
+        if not buffers and len(payload) <= inline_limit:
+            return cls(payload=payload)
+
+        fd, path = tempfile.mkstemp(dir=directory, suffix='.result')
+        spans = []
+        with os.fdopen(fd, 'wb') as spill_file:
+            spill_file.write(payload)
+            offset = len(payload)
+            for buffer in buffers:
+                raw = buffer.raw()
+                padding = -offset % SPILL_ALIGNMENT
+                spill_file.write(b'\0' * padding)
+                offset += padding
+                spill_file.write(raw)
+                spans.append((offset, raw.nbytes))
+                offset += raw.nbytes
+        return cls(path=path, pickle_size=len(payload), buffer_spans=spans)
+
+    def load(self):
+        """
+        The result. Spill files are mapped and removed, arrays in the result keep the mapping alive.
+
+        :raises RuntimeError: if the capture failed before it had a result
+        """
+        if self.error is not None:
+            raise RuntimeError(f'Capture failed before it had a result: {self.error}')
+        if self._loaded:
+            return self.data
+        if self.payload is not None:
+            self.data = pickle.loads(self.payload)
+        else:
+            with open(self.path, 'rb') as spill_file:
+                view = memoryview(mmap.mmap(spill_file.fileno(), 0, access=mmap.ACCESS_READ))
+            self.data = pickle.loads(view[:self.pickle_size],
+                                     buffers=[view[offset:offset + length] for offset, length in self.buffer_spans])
+            os.remove(self.path)
+        self.payload = None
+        self._loaded = True
+        return self.data
+
 
 class DataCaptureManager:
 
-    def __init__(self, capture_classes, multi_params=None, log_queue=None, *args, **kwargs):
+    def __init__(self, capture_classes, multi_params=None, log_queue=None, runner='process', max_workers=None, *args,
+                 **kwargs):
         """
         Data Capture Manager will build out the captures from the provided Classes, args & kwargs, and
           multi_params. multi_params should ba dictionary where the values are iterables. DCM will build
@@ -34,9 +151,16 @@ class DataCaptureManager:
           that the capture process will need to return all pertinent data in the result_data as the multiplex
           paramater will not be recorded as it will for multi_params
 
+          Each capture runs in its own process by default. Captures that mostly wait on remote commands can use
+          runner='thread' (a thread per capture) or runner='asyncio' (one event loop thread, blocking capture
+          methods run on a pool of max_workers threads and coroutine methods are awaited directly). The capture
+          lifecycle is the same for every runner.
+
         :param capture_classes:
         :param multi_params:
         :param log_queue:
+        :param runner: 'process', 'thread' or 'asyncio', see RUNNERS
+        :param max_workers: size of the asyncio runner's thread pool
         :param args:
         :param kwargs:
         """
@@ -55,9 +179,22 @@ class DataCaptureManager:
         self.logger.debug(f'Capture classes: {self.capture_classes}')
         self.logger.debug(f'Multiplexing parameters: {self.multi_params}')
 
-        self.manager = multiprocessing.Manager()
-        self.state_events = {state: multiprocessing.Event() for state in self.state_sequence}
-        self.captures_states = []
+        if runner not in RUNNERS:
+            raise ValueError(f'Runner must be one of {list(RUNNERS)}, not: {runner}')
+        self.runner = RUNNERS[runner](max_workers=max_workers)
+
+        self.state_events = {state: self.runner.event() for state in self.state_sequence}
+        # One shared slot per capture holds its state code. Captures notify the condition whenever they change state
+        #   so waiting for a state costs no IPC round trips and no sleeps.
+        self.state_condition = self.runner.condition()
+        self.captures_states = None
+        self.capture_descriptions = []
+
+        # Results of capture processes are spilled to files here and only their handles go through the queues
+        self.spill_dir = None
+        if self.runner.spills:
+            self.spill_dir = tempfile.mkdtemp(prefix='pbk-results-')
+            self._remove_spill_dir = weakref.finalize(self, shutil.rmtree, self.spill_dir, ignore_errors=True)
 
         self.build_capture_processes()
 
@@ -75,17 +212,22 @@ class DataCaptureManager:
             sub_matrix = []
 
         for item in self.capture_matrix:
-            item['result_queue'] = multiprocessing.Queue(maxsize=len(self.capture_classes))
-            item['result_data'] = []
+            item['result_queue'] = self.runner.queue(maxsize=len(self.capture_classes))
+            item['result_handles'] = []
 
     def setup(self, wait=True, timeout=0, daemonize=False):
+        capture_count = len(self.capture_matrix) * len(self.capture_classes)
+        self.captures_states = self.runner.state_array(capture_count)
         for multi_kwargs in self.capture_matrix:
             for capture_class in self.capture_classes:
-                state_value = self.manager.Value('c', 'initializing')
-                p = DataCaptureProcess(
+                state_index = len(self.captures)
+                p = self.runner.create(
                     data_capture_class=capture_class,
-                    state_value=state_value,
+                    state_array=self.captures_states,
+                    state_index=state_index,
+                    state_condition=self.state_condition,
                     state_events=self.state_events,
+                    spill_dir=self.spill_dir,
                     log_queue=self.log_queue,
                     *self.args,
                     **multi_kwargs,
@@ -100,7 +242,8 @@ class DataCaptureManager:
                 p.start()
                 self.logger.debug('Started dcp instance')
                 self.captures.append(p)
-                self.captures_states.append(state_value)
+                described = {k: v for k, v in multi_kwargs.items() if k not in ('result_queue', 'result_handles')}
+                self.capture_descriptions.append(f'{capture_class.__name__}({described})')
 
         self.state_events['setup'].set()
         if wait:
@@ -109,7 +252,10 @@ class DataCaptureManager:
     def teardown(self, wait=True, timeout=0):
         self.state_events['teardown'].set()
         if wait:
-            self._wait_for_state('teardowned', timeout=timeout)
+            try:
+                self._wait_for_state('teardowned', timeout=timeout)
+            finally:
+                self.runner.close()
 
     def start(self, wait=True, timeout=0):
         self.state_events['start'].set()
@@ -122,48 +268,95 @@ class DataCaptureManager:
             self._wait_for_state('stopped', timeout=timeout)
 
     def _wait_for_state(self, state, timeout=0):
-        start_time = time.time()
-        while True:
-            states = self._get_states()  # Use a set to combine like states.
-            if len(states) == 1 and {state}.issuperset(states):
-                break
-            if timeout > 0 and (time.time() - start_time >= timeout):
-                self.logger.warning(f'Hit timeout of {timeout} waiting for all captures to get to state "{state}"')
-            time.sleep(.5)
+        """
+        Block until every capture process reached the state
+
+        :param state: one of CAPTURE_STATES
+        :param timeout: seconds to wait, 0 waits forever
+        :raises TimeoutError: listing the captures that didn't reach the state in time
+        :raises RuntimeError: if a capture process failed or died
+        """
+        code = CAPTURE_STATES.index(state)
+        deadline = time.time() + timeout if timeout > 0 else None
+        with self.state_condition:
+            while True:
+                if all(self.captures_states[index] >= code for index in range(len(self.captures))):
+                    self.logger.debug(f'All captures reached state "{state}"')
+                    return
+
+                failed = [index for index, process in enumerate(self.captures)
+                          if self.captures_states[index] == FAILED_STATE
+                          or (not process.is_alive() and self.captures_states[index] < code)]
+                if failed:
+                    raise RuntimeError(f'Captures failed before reaching state "{state}": '
+                                       f'{self._describe(failed)}')
+
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    stragglers = [index for index in range(len(self.captures)) if self.captures_states[index] < code]
+                    raise TimeoutError(f'Hit timeout of {timeout} seconds waiting for all captures to get to state '
+                                       f'"{state}". Stragglers: {self._describe(stragglers)}')
+
+                self.state_condition.wait(LIVENESS_INTERVAL if remaining is None else min(remaining,
+                                                                                          LIVENESS_INTERVAL))
+
+    def _describe(self, indices):
+        return ', '.join(f'{self.capture_descriptions[index]} in state '
+                         f'"{state_name(self.captures_states[index])}"' for index in indices)
 
     def _get_states(self):
-        states = {v.get() for v in self.captures_states}
+        states = {state_name(self.captures_states[index]) for index in range(len(self.captures))}
         self.logger.debug(f'Got states: {states}')
         return states
 
+    def _receive_results(self):
+        """
+        Collect the handles of every capture that has stopped or failed. A capture puts exactly one handle, its
+          result or a failure marker, before it reports "stopped" or "failed", so the number of those captures of a
+          set is the number of handles to wait for.
+        """
+        class_count = len(self.capture_classes)
+        for set_index, capture_set in enumerate(self.capture_matrix):
+            indices = range(set_index * class_count, min((set_index + 1) * class_count, len(self.captures)))
+            finished = sum(1 for index in indices
+                           if self.captures_states[index] >= CAPTURE_STATES.index('stopped')
+                           or self.captures_states[index] == FAILED_STATE)
+            while len(capture_set['result_handles']) < finished:
+                capture_set['result_handles'].append(capture_set['result_queue'].get())
+
     @property
-    def result_data(self):
-        for capture_set in self.capture_matrix:
-            while capture_set['result_queue'].qsize() > 0:
-                capture_set['result_data'].append(capture_set['result_queue'].get())
+    def result_handles(self):
+        """
+        Like result_data but with a ResultHandle in place of each result, nothing is loaded
+        """
+        if self.captures_states is not None:
+            self._receive_results()
+        return [{k: v for k, v in capture_set.items() if k != 'result_queue'} for capture_set in self.capture_matrix]
 
+    @property
+    def result_data(self):
         result_data = []
-        for capture_set in self.capture_matrix:
-            result_data.append({k: v for k, v in capture_set.items() if k not in ('result_queue',)})
+        for capture_set in self.result_handles:
+            handles = capture_set.pop('result_handles')
+            capture_set['result_data'] = [handle.load() for handle in handles]
+            result_data.append(capture_set)
 
         return result_data
 
 
-class DataCaptureProcess(multiprocessing.Process):
+class CaptureLifecycle(object):
     """
-    This class will wrap a DataCapture object in a process and execute the 4 methods based on
-    event inputs (setup, start, stop, teardown). Right now these need to be executed in
-    sequential order. Future work might be done to support running the functions in an arbitrary
-    sequence.
+    Drives a DataCapture object through its 4 methods based on event inputs (setup, start, stop, teardown). Right
+    now these need to be executed in sequential order. Future work might be done to support running the functions
+    in an arbitrary sequence. The subclasses decide where this runs: a process, a thread or an asyncio task.
     """
 
     log_queue = TypeChecked(multiprocessing.queues.Queue, 'log_queue', allow_none=False)
 
-    def __init__(self, data_capture_class=None, state_value=None, state_events=None, result_queue=None, log_queue=None,
-                 *args, **kwargs):
-        super().__init__()
-
-        required_kwargs = [data_capture_class, state_value, state_events, result_queue, log_queue]
+    def _init_lifecycle(self, data_capture_class=None, state_array=None, state_index=None, state_condition=None,
+                        state_events=None, result_queue=None, spill_dir=None, log_queue=None, *args, **kwargs):
+        required_kwargs = [data_capture_class, state_array, state_index, state_condition, state_events, result_queue,
+                           log_queue]
         for kw in required_kwargs:
             if kw is None:
                 raise ValueError(f'Keywords: {required_kwargs} are required for DataCapture classes')
@@ -181,7 +374,9 @@ class DataCaptureProcess(multiprocessing.Process):
         self.args = args
         self.kwargs = kwargs
 
-        self.state_value = state_value
+        self.state_array = state_array
+        self.state_index = state_index
+        self.state_condition = state_condition
 
         self.setup_event = state_events['setup']
         self.start_event = state_events['start']
@@ -189,37 +384,281 @@ class DataCaptureProcess(multiprocessing.Process):
         self.teardown_event = state_events['teardown']
 
         self.result_queue = result_queue
+        self.spill_dir = spill_dir
+        self.result_sent = False
+
+    def set_state(self, state):
+        with self.state_condition:
+            self.state_array[self.state_index] = FAILED_STATE if state == 'failed' else CAPTURE_STATES.index(state)
+            self.state_condition.notify_all()
+
+    def put_result(self, handle):
+        self.result_queue.put(handle)
+        self.result_sent = True
+
+    def fail(self, error):
+        """
+        Report a failed capture. A capture that hasn't sent its result yet sends a failure marker in its place first,
+          the manager expects a handle from every capture that stopped or failed.
+        """
+        if not self.result_sent:
+            self.put_result(ResultHandle(error=f'{type(error).__name__}: {error}'))
+        self.set_state('failed')
 
     def run(self):
-        logger = logging.getLogger('root')
+        logger = get_queued_logger(self.log_queue)
+        try:
+            self._run(logger)
+        except BaseException as e:
+            logger.exception(f'DCP for {self.DataCapture} failed')
+            self.fail(e)
+            raise
+
+    def _run(self, logger):
         logger.verboser('Starting to wait for setup_event in DCP')
         self.setup_event.wait()
         logger.verboser('Got setup event in DCP')
         dc = self.DataCapture(log_queue=self.log_queue, *self.args, **self.kwargs)
         dc.setup()
-        self.state_value.set('setuped')
+        self.set_state('setuped')
 
         self.start_event.wait()
         logger.verboser('Got start event in DCP')
         dc.start()
-        self.state_value.set('started')
+        self.set_state('started')
 
         self.stop_event.wait()
         logger.verboser('Got stop event in DCP')
         dc.stop()
-        self.state_value.set('stopped')
-
-        self.result_queue.put(dc.data)
-        logger.status('DCP put result in result queue')
-        logger.debug(f'Data: {dc.data}')
+        handle = ResultHandle.spill(dc.data, self.spill_dir)
+        self.put_result(handle)
+        logger.status(f'DCP put {handle} in result queue')
+        self.set_state('stopped')
 
         self.teardown_event.wait()
         logger.verboser('Got teardown event in DCP')
         dc.teardown()
-        self.state_value.set('teardowned')
+        self.set_state('teardowned')
         logger.verboser('End of run() in DCP')
 
 
+class DataCaptureProcess(CaptureLifecycle, multiprocessing.Process):
+    """
+    Runs the capture lifecycle in its own process
+    """
+
+    def __init__(self, *args, **kwargs):
+        multiprocessing.Process.__init__(self)
+        self._init_lifecycle(*args, **kwargs)
+
+
+class DataCaptureThread(CaptureLifecycle, threading.Thread):
+    """
+    Runs the capture lifecycle in a thread of the manager's process
+    """
+
+    def __init__(self, *args, **kwargs):
+        threading.Thread.__init__(self)
+        self._init_lifecycle(*args, **kwargs)
+
+
+class DataCaptureTask(CaptureLifecycle):
+    """
+    Runs the capture lifecycle as a task on an asyncio event loop. DataCapture methods that are coroutine functions
+      are awaited, blocking methods run on the loop's default executor.
+    """
+
+    def __init__(self, loop=None, *args, **kwargs):
+        self._init_lifecycle(*args, **kwargs)
+        self.loop = loop
+        self.future = None
+        self.daemon = True
+        self.name = f'DataCaptureTask-{self.state_index}'
+
+    def start(self):
+        self.future = asyncio.run_coroutine_threadsafe(self._run_async(), self.loop)
+
+    def is_alive(self):
+        return self.future is not None and not self.future.done()
+
+    def join(self, timeout=None):
+        if self.future is not None:
+            concurrent.futures.wait([self.future], timeout=timeout)
+
+    async def _call(self, method):
+        if asyncio.iscoroutinefunction(method):
+            return await method()
+        return await self.loop.run_in_executor(None, method)
+
+    async def _run_async(self):
+        logger = get_queued_logger(self.log_queue)
+        try:
+            await self.setup_event.wait()
+            dc = await self.loop.run_in_executor(
+                None, lambda: self.DataCapture(log_queue=self.log_queue, *self.args, **self.kwargs))
+            await self._call(dc.setup)
+            self.set_state('setuped')
+
+            await self.start_event.wait()
+            await self._call(dc.start)
+            self.set_state('started')
+
+            await self.stop_event.wait()
+            await self._call(dc.stop)
+            self.put_result(ResultHandle(data=await self.loop.run_in_executor(None, lambda: dc.data)))
+            logger.status('DCP put result in result queue')
+            self.set_state('stopped')
+
+            await self.teardown_event.wait()
+            await self._call(dc.teardown)
+            self.set_state('teardowned')
+        except BaseException as e:
+            logger.exception(f'DCP for {self.DataCapture} failed')
+            self.fail(e)
+            raise
+
+
+class AsyncStateEvent(object):
+
+    def __init__(self, loop):
+        """
+        Event that is set from any thread and awaited on the loop
+        """
+        self.loop = loop
+
+        async def create():
+            return asyncio.Event()
+        self._event = asyncio.run_coroutine_threadsafe(create(), loop).result()
+
+    def set(self):
+        self.loop.call_soon_threadsafe(self._event.set)
+
+    def is_set(self):
+        return self._event.is_set()
+
+    async def wait(self):
+        await self._event.wait()
+
+
+class CaptureRunner(abc.ABC):
+    """
+    A runner provides the synchronization primitives for a DataCaptureManager and creates the objects that run the
+      capture lifecycles
+    """
+
+    # Whether results cross a process boundary and are spilled to files
+    spills = False
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+
+    @abc.abstractmethod
+    def event(self):
+        """
+        :return: an event the manager sets and the capture lifecycles wait on, one per lifecycle step
+        """
+
+    @abc.abstractmethod
+    def condition(self):
+        """
+        :return: a condition the lifecycles notify whenever they change their state code in the state array
+        """
+
+    @abc.abstractmethod
+    def state_array(self, size):
+        """
+        :param size: number of captures
+        :return: a mutable sequence of size ints holding the state code of each capture, initially 0
+        """
+
+    @abc.abstractmethod
+    def queue(self, maxsize=0):
+        """
+        :param maxsize: most items the queue holds, 0 for no limit
+        :return: a queue the lifecycles put their ResultHandles on and the manager reads them from
+        """
+
+    @abc.abstractmethod
+    def create(self, *args, **kwargs):
+        """
+        :return: an object with start() and is_alive() that runs the capture lifecycle
+        """
+
+    def close(self):
+        """
+        Release what the runner holds, e.g. an event loop thread. Called when the captures are torn down.
+        """
+
+
+class ProcessRunner(CaptureRunner):
+    spills = True
+
+    def event(self):
+        return multiprocessing.Event()
+
+    def condition(self):
+        return multiprocessing.Condition()
+
+    def state_array(self, size):
+        return multiprocessing.Array('i', size, lock=False)
+
+    def queue(self, maxsize=0):
+        return multiprocessing.Queue(maxsize=maxsize)
+
+    def create(self, *args, **kwargs):
+        return DataCaptureProcess(*args, **kwargs)
+
+
+class ThreadRunner(CaptureRunner):
+
+    def event(self):
+        return threading.Event()
+
+    def condition(self):
+        return threading.Condition()
+
+    def state_array(self, size):
+        return [0] * size
+
+    def queue(self, maxsize=0):
+        return queue.Queue(maxsize=maxsize)
+
+    def create(self, *args, **kwargs):
+        return DataCaptureThread(*args, **kwargs)
+
+
+class AsyncioRunner(ThreadRunner):
+
+    def __init__(self, max_workers=None):
+        super().__init__(max_workers=max_workers)
+        self.loop = asyncio.new_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                              thread_name_prefix='pbk-capture')
+        self.loop.set_default_executor(self.executor)
+        self.thread = threading.Thread(target=self.loop.run_forever, name='pbk-capture-loop', daemon=True)
+        self.thread.start()
+
+    def event(self):
+        return AsyncStateEvent(self.loop)
+
+    def create(self, *args, **kwargs):
+        return DataCaptureTask(self.loop, *args, **kwargs)
+
+    def close(self):
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.executor.shutdown(wait=False)
+
+
+RUNNERS = {
+    'process': ProcessRunner,
+    'thread': ThreadRunner,
+    'asyncio': AsyncioRunner,
+}
+
+
 class DataCapture(abc.ABC):
     log_queue = TypeChecked(multiprocessing.queues.Queue, 'log_queue', allow_none=False)
 
@@ -0,0 +1,224 @@
+import random
+import operator
+import itertools
+import functools
+import collections
+
+DESIGNS = ('full', 'latin_hypercube', 'fractional', 'coarse')
+
+
+class ParameterSpace(object):
+
+    def __init__(self, axes):
+        """
+        A parameter space is an ordered set of axes, each with an ordered list of levels:
+
+            space = ParameterSpace({'blocksize': ['4k', '64k', '1m'], 'numjobs': [1, 2, 4, 8]})
+
+        Points are dicts of {axis: level}. Nothing is materialized: iterating yields points one at a time and
+          point(i) decodes the i-th point of the full factorial directly. Levels should be listed in a meaningful
+          order (e.g. increasing size) as the refinement designs treat neighbouring levels as neighbouring values.
+
+        :param axes: dict (or list of (name, levels) pairs) of axis name to levels
+        """
+        items = axes.items() if isinstance(axes, dict) else axes
+        self.axes = collections.OrderedDict((name, list(levels)) for name, levels in items)
+        for name, levels in self.axes.items():
+            if not levels:
+                raise ValueError(f'Axis "{name}" has no levels')
+
+    def __repr__(self):
+        return f'ParameterSpace({dict(self.axes)})'
+
+    def __len__(self):
+        return functools.reduce(operator.mul, self.shape, 1)
+
+    def __iter__(self):
+        return full_factorial(self)
+
+    @property
+    def names(self):
+        return list(self.axes)
+
+    @property
+    def shape(self):
+        return [len(levels) for levels in self.axes.values()]
+
+    def point_from_indices(self, indices):
+        return collections.OrderedDict(
+            (name, levels[index]) for (name, levels), index in zip(self.axes.items(), indices))
+
+    def indices_of(self, point):
+        """
+        Level indices of a point, the inverse of point_from_indices
+        """
+        return tuple(levels.index(point[name]) for name, levels in self.axes.items())
+
+    def point(self, index):
+        """
+        The index-th point of the full factorial in iteration order (last axis varies fastest)
+        """
+        if not 0 <= index < len(self):
+            raise IndexError(f'Point {index} is outside of a space with {len(self)} points')
+        indices = []
+        for size in reversed(self.shape):
+            index, remainder = divmod(index, size)
+            indices.append(remainder)
+        return self.point_from_indices(reversed(indices))
+
+    def subspace(self, axes):
+        """
+        Space with the levels of some axes replaced. Axes not given keep all of their levels.
+        """
+        return ParameterSpace([(name, axes.get(name, levels)) for name, levels in self.axes.items()])
+
+
+def full_factorial(space):
+    """
+    Generator of every combination of levels
+    """
+    for levels in itertools.product(*space.axes.values()):
+        yield collections.OrderedDict(zip(space.names, levels))
+
+
+def latin_hypercube(space, samples, seed=None):
+    """
+    Latin hypercube sample of a space. Each axis is split into `samples` equal strata and every stratum of every axis
+      is hit exactly once, so each level of each axis is covered in proportion to its share of the axis no matter
+      how few samples are taken. Duplicate points (possible when samples exceeds the number of levels of the axes)
+      are only yielded once.
+
+    :param space: ParameterSpace
+    :param samples: number of strata per axis, an upper bound for the number of points
+    :param seed: seed for a reproducible design
+    :return: generator of points
+    """
+    rng = random.Random(seed)
+    strata = []
+    for size in space.shape:
+        order = list(range(samples))
+        rng.shuffle(order)
+        strata.append([min(size - 1, int((stratum + rng.random()) * size / samples)) for stratum in order])
+
+    seen = set()
+    for indices in zip(*strata):
+        if indices not in seen:
+            seen.add(indices)
+            yield space.point_from_indices(indices)
+
+
+def fractional_factorial(space, fraction=2, offset=0):
+    """
+    Generalized 1/fraction fractional factorial. A point is kept when the sum of its level indices is congruent to
+      offset modulo fraction. The axis with the most levels is the generator: every combination of the other axes is
+      still run, each with an evenly spread 1/fraction of the generator's levels. The design is produced directly,
+      without walking the skipped points.
+
+    :param space: ParameterSpace
+    :param fraction: run 1/fraction of the full factorial. Must not exceed the levels of the largest axis.
+    :param offset: selects which of the `fraction` complementary blocks to run
+    :return: generator of points
+    """
+    shape = space.shape
+    generator = max(range(len(shape)), key=lambda axis: shape[axis])
+    if not 1 <= fraction <= shape[generator]:
+        raise ValueError(f'Fraction must be between 1 and {shape[generator]} for this space, got {fraction}')
+
+    other_axes = [range(size) for axis, size in enumerate(shape) if axis != generator]
+    for others in itertools.product(*other_axes):
+        start = (offset - sum(others)) % fraction
+        for index in range(start, shape[generator], fraction):
+            indices = list(others)
+            indices.insert(generator, index)
+            yield space.point_from_indices(indices)
+
+
+def coarse_space(space, stride=2):
+    """
+    Every stride-th level of each axis, always keeping the first and last level. The first pass of a coarse to fine
+      search.
+    """
+    axes = {}
+    for name, levels in space.axes.items():
+        picked = levels[::stride]
+        if picked[-1] != levels[-1]:
+            picked.append(levels[-1])
+        axes[name] = picked
+    return space.subspace(axes)
+
+
+def refine_space(space, scored_points, span=1, top=1, maximize=True):
+    """
+    The region of a space around the best scoring points so far, the next pass of a coarse to fine search. For each
+      of the `top` best points every axis is narrowed to the levels within `span` positions of the point's level.
+      The regions of the top points are merged per axis.
+
+    :param space: the full ParameterSpace
+    :param scored_points: iterable of (point, score)
+    :param span: number of neighbouring levels to include on each side
+    :param top: number of best points to refine around
+    :param maximize: True if a higher score is better
+    :return: ParameterSpace
+    """
+    ranked = sorted(scored_points, key=lambda scored: scored[1], reverse=maximize)[:top]
+    if not ranked:
+        raise ValueError('At least one scored point is required to refine a space')
+
+    keep = collections.defaultdict(set)
+    for point, _ in ranked:
+        for (name, levels), index in zip(space.axes.items(), space.indices_of(point)):
+            keep[name].update(range(max(0, index - span), min(len(levels), index + span + 1)))
+
+    return space.subspace({name: [space.axes[name][i] for i in sorted(indices)] for name, indices in keep.items()})
+
+
+def coarse_to_fine(space, evaluate, stride=2, span=1, top=1, rounds=2, maximize=True):
+    """
+    Adaptive search: run a coarse grid, then repeatedly run the full factorial of the region around the best points.
+      Points are only evaluated once across rounds.
+
+    :param space: ParameterSpace
+    :param evaluate: callable taking a point and returning its score
+    :param stride: stride of the coarse grid, see coarse_space
+    :param span: see refine_space
+    :param top: see refine_space
+    :param rounds: number of refinement rounds after the coarse grid
+    :param maximize: True if a higher score is better
+    :return: list of (point, score) for every evaluated point
+    """
+    scores = collections.OrderedDict()
+
+    def run(points):
+        for point in points:
+            key = space.indices_of(point)
+            if key not in scores:
+                scores[key] = (point, evaluate(point))
+
+    run(coarse_space(space, stride))
+    for _ in range(rounds):
+        run(refine_space(space, scores.values(), span=span, top=top, maximize=maximize))
+
+    return list(scores.values())
+
+
+def expand(space, design='full', **kwargs):
+    """
+    Generator of the points of a design
+
+    :param space: ParameterSpace or a dict of {axis: levels}
+    :param design: one of DESIGNS. 'full' and 'coarse' take no arguments, 'latin_hypercube' requires `samples`
+      (and takes `seed`), 'fractional' takes `fraction` and `offset`, 'coarse' takes `stride`
+    :return: generator of points
+    """
+    if not isinstance(space, ParameterSpace):
+        space = ParameterSpace(space)
+
+    if design == 'full':
+        return full_factorial(space)
+    if design == 'latin_hypercube':
+        return latin_hypercube(space, **kwargs)
+    if design == 'fractional':
+        return fractional_factorial(space, **kwargs)
+    if design == 'coarse':
+        return full_factorial(coarse_space(space, **kwargs))
+    raise ValueError(f'Unknown design "{design}", expected one of {DESIGNS}')
@@ -0,0 +1,164 @@
+import time
+import asyncio
+import functools
+import collections
+import concurrent.futures
+
+from pbk.util.remote import get_transport
+
+
+class HostResult(object):
+
+    def __init__(self, host, results=None, error=None, elapsed=None):
+        """
+        The outcome of running a command (or a command set) on a single host of a fleet
+
+        :param host:
+        :param results: list of (stdout, stderr, exit_code) tuples, one per command
+        :param error: string describing why the host failed (connection error, timeout, ...) or None
+        :param elapsed: wall clock seconds spent on this host, including waiting on the connection
+        """
+        self.host = host
+        self.results = results if results is not None else []
+        self.error = error
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        return f'HostResult(host={self.host!r}, error={self.error!r}, elapsed={self.elapsed}, results={self.results})'
+
+    @property
+    def ok(self):
+        return self.error is None and all(exit_code == 0 for _, _, exit_code in self.results)
+
+    @property
+    def output_key(self):
+        """
+        Hashable representation of everything the host returned. Hosts with the same output_key returned
+          identical output.
+        """
+        return self.error, tuple(self.results)
+
+
+class FleetExecutor(object):
+
+    def __init__(self, hosts, username=None, password=None, key_filename=None, concurrency=64, timeout=60,
+                 logger=None, transport='auto'):
+        """
+        FleetExecutor runs a command, or a set of commands, on many hosts at once. Hosts are driven from an asyncio
+          event loop and at most `concurrency` hosts are in flight at any time.
+
+        paramiko is a blocking library so each in-flight host occupies a worker thread while its command runs. The
+          threads share the pooled connections from pbk.util.remote so a host that is touched repeatedly only pays
+          for the SSH handshake once. Local hosts run through a LocalTransport.
+
+        :param hosts: iterable of host names or addresses
+        :param username:
+        :param password:
+        :param key_filename:
+        :param concurrency: maximum number of hosts with a command in flight
+        :param timeout: per-host timeout in seconds. Includes connecting and running all commands.
+        :param logger:
+        :param transport: 'auto', 'ssh' or 'local'. With 'auto' local hosts skip SSH
+        """
+        self.hosts = list(dict.fromkeys(hosts))
+        self.username = username
+        self.password = password
+        self.key_filename = key_filename
+        self.concurrency = max(1, int(concurrency))
+        self.timeout = timeout
+        self.logger = logger
+        self.transport = transport
+
+        self.auth = dict(username=self.username, password=self.password, key_filename=self.key_filename)
+
+    def _run_host(self, host, command=None, commands=None):
+        # The deadline stops the command itself, the wait_for in _execute_host only stops waiting for it
+        deadline = time.monotonic() + self.timeout
+        transport = get_transport(host=host, transport=self.transport, **self.auth)
+        if commands is not None:
+            return transport.send_commands(commands, timeout=self.timeout, deadline=deadline)
+        return [transport.run(command, timeout=self.timeout, deadline=deadline)]
+
+    async def _execute_host(self, host, semaphore, executor, command=None, commands=None):
+        async with semaphore:
+            start_time = time.time()
+            loop = asyncio.get_running_loop()
+            call = functools.partial(self._run_host, host, command=command, commands=commands)
+            try:
+                results = await asyncio.wait_for(loop.run_in_executor(executor, call), self.timeout)
+                return HostResult(host, results=results, elapsed=time.time() - start_time)
+            except asyncio.TimeoutError:
+                error = f'Timed out after {self.timeout} seconds'
+            except Exception as e:
+                error = f'{type(e).__name__}: {e}'
+
+            if self.logger: self.logger.warning(f'Host {host} failed: {error}')
+            return HostResult(host, error=error, elapsed=time.time() - start_time)
+
+    async def as_completed(self, command=None, commands=None):
+        """
+        Asynchronous generator that yields a HostResult for each host as soon as the host finishes
+
+            async for host_result in fleet.as_completed('uname -r'):
+                ...
+
+        :param command: a single command to run on every host
+        :param commands: a list of commands to run on every host in one round trip
+        :return:
+        """
+        if (command is None) == (commands is None):
+            raise ValueError('Exactly one of command or commands is required')
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency,
+                                                         thread_name_prefix='pbk-fleet')
+        tasks = [asyncio.ensure_future(self._execute_host(host, semaphore, executor, command, commands))
+                 for host in self.hosts]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
+            # Threads of a timed out host are not waited on. They end once the deadline in _run_host closes the
+            #   channel or kills the process of the host's command.
+            executor.shutdown(wait=False)
+
+    async def gather(self, command=None, commands=None):
+        return [host_result async for host_result in self.as_completed(command=command, commands=commands)]
+
+    def execute(self, command=None, commands=None):
+        """
+        Blocking convenience wrapper around as_completed.
+
+        :return: list of HostResult in completion order
+        """
+        return asyncio.run(self.gather(command=command, commands=commands))
+
+
+def aggregate_results(host_results):
+    """
+    Group hosts that returned identical output
+
+    :param host_results: iterable of HostResult
+    :return: list of (HostResult, [hosts]) with the largest group first. The HostResult is a representative of the
+      group.
+    """
+    groups = collections.OrderedDict()
+    for host_result in host_results:
+        key = host_result.output_key
+        if key not in groups:
+            groups[key] = (host_result, [])
+        groups[key][1].append(host_result.host)
+
+    return sorted(groups.values(), key=lambda group: len(group[1]), reverse=True)
+
+
+def fleet_execute(hosts, command=None, commands=None, username=None, password=None, key_filename=None,
+                  concurrency=64, timeout=60, logger=None, transport='auto'):
+    """
+    Run a command or command set across hosts and return the list of HostResult
+    """
+    fleet = FleetExecutor(hosts, username=username, password=password, key_filename=key_filename,
+                          concurrency=concurrency, timeout=timeout, logger=logger, transport=transport)
+    return fleet.execute(command=command, commands=commands)
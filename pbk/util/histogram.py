@@ -0,0 +1,199 @@
+import numpy as np
+
+
+class LatencyHistogram(object):
+
+    def __init__(self, sub_bucket_bits=7, max_bits=44, counts=None):
+        """
+        Log-linear latency histogram backed by a numpy array. Values below 2**sub_bucket_bits get a bucket each, above
+          that every power of two is split into 2**(sub_bucket_bits - 1) linear buckets, so the relative error of any
+          recorded value is below 2**-(sub_bucket_bits - 1) (under 1.6% with the default of 7).
+
+        Histograms with the same layout merge by adding their arrays, which is how percentiles across jobs, hosts
+          and repetitions are computed correctly (averaging percentiles is not). Values are integers, e.g. latencies
+          in nanoseconds. With max_bits=44 values up to about 4.8 hours in ns are supported, larger values are
+          clamped into the last bucket.
+
+        :param sub_bucket_bits: precision, see above
+        :param max_bits: values must be below 2**max_bits
+        :param counts: existing bucket counts, used when restoring a histogram
+        """
+        if not 1 <= sub_bucket_bits < max_bits:
+            raise ValueError(f'sub_bucket_bits must be between 1 and max_bits, got {sub_bucket_bits}')
+        self.sub_bucket_bits = sub_bucket_bits
+        self.max_bits = max_bits
+        self.sub_bucket_count = 1 << sub_bucket_bits
+        self.half_count = self.sub_bucket_count >> 1
+        size = self.sub_bucket_count + (max_bits - sub_bucket_bits) * self.half_count
+        if counts is None:
+            self.counts = np.zeros(size, dtype=np.uint64)
+        else:
+            self.counts = np.asarray(counts, dtype=np.uint64)
+            if self.counts.shape != (size,):
+                raise ValueError(f'Expected {size} counts for this layout, got {self.counts.shape}')
+
+    def __repr__(self):
+        return (f'LatencyHistogram(total={self.total}, p50={self.percentile(50)}, p99={self.percentile(99)}, '
+                f'max={self.max()})')
+
+    @property
+    def layout(self):
+        return self.sub_bucket_bits, self.max_bits
+
+    @property
+    def total(self):
+        return int(self.counts.sum())
+
+    def index_of(self, values):
+        """
+        Bucket indices of an array of values
+        """
+        values = np.clip(np.asarray(values, dtype=np.int64), 0, (1 << self.max_bits) - 1)
+        # frexp gives values = mantissa * 2**exponent with the mantissa in [0.5, 1), so exponent is the bit length.
+        #   This is exact for integers below 2**53.
+        _, bit_length = np.frexp(values.astype(np.float64))
+        shift = np.maximum(bit_length - self.sub_bucket_bits, 0)
+        mantissa = values >> shift
+        return np.where(shift == 0, values, self.sub_bucket_count + (shift - 1) * self.half_count +
+                        (mantissa - self.half_count))
+
+    def bucket_bounds(self):
+        """
+        :return: (lower, upper) arrays with the inclusive lower and exclusive upper value of every bucket
+        """
+        indices = np.arange(len(self.counts), dtype=np.int64)
+        linear = indices < self.sub_bucket_count
+        shift = np.where(linear, 0, (indices - self.sub_bucket_count) // self.half_count + 1)
+        mantissa = np.where(linear, indices, (indices - self.sub_bucket_count) % self.half_count + self.half_count)
+        lower = mantissa << shift
+        return lower, lower + (np.int64(1) << shift)
+
+    def bucket_values(self):
+        """
+        Representative value of every bucket: the value itself for the exact buckets, the midpoint otherwise
+        """
+        lower, upper = self.bucket_bounds()
+        return np.where(upper - lower == 1, lower, (lower + upper) / 2)
+
+    def record(self, values, counts=1):
+        """
+        Add values to the histogram
+
+        :param values: a value or an array of values
+        :param counts: how many times each value occurred, a number or an array matching values
+        """
+        indices = np.atleast_1d(self.index_of(values))
+        weights = np.broadcast_to(np.asarray(counts, dtype=np.float64), indices.shape)
+        self.counts += np.bincount(indices, weights=weights, minlength=len(self.counts)).astype(np.uint64)
+
+    @classmethod
+    def from_fio_bins(cls, bins, sub_bucket_bits=7, max_bits=44):
+        """
+        Build a histogram from the 'bins' of a clat_ns, slat_ns or lat_ns object of fio's json+ output
+
+        :param bins: dict of {latency in ns (str or int): count}
+        """
+        histogram = cls(sub_bucket_bits=sub_bucket_bits, max_bits=max_bits)
+        if bins:
+            values = np.fromiter((int(value) for value in bins.keys()), dtype=np.int64, count=len(bins))
+            counts = np.fromiter((int(count) for count in bins.values()), dtype=np.float64, count=len(bins))
+            histogram.record(values, counts)
+        return histogram
+
+    def _check_layout(self, other):
+        if self.layout != other.layout:
+            raise ValueError(f'Can not combine histograms with layouts {self.layout} and {other.layout}')
+
+    def copy(self):
+        return LatencyHistogram(self.sub_bucket_bits, self.max_bits, counts=self.counts.copy())
+
+    def merge(self, other):
+        """
+        Add the counts of another histogram with the same layout to this one
+
+        :return: self
+        """
+        self._check_layout(other)
+        self.counts += other.counts
+        return self
+
+    def __add__(self, other):
+        return self.copy().merge(other)
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def __sub__(self, other):
+        """
+        Counts recorded in self but not in other, e.g. the latencies of one interval from two cumulative histograms
+        """
+        self._check_layout(other)
+        difference = self.counts.astype(np.int64) - other.counts.astype(np.int64)
+        return LatencyHistogram(self.sub_bucket_bits, self.max_bits, counts=np.maximum(difference, 0))
+
+    def __eq__(self, other):
+        return (isinstance(other, LatencyHistogram) and self.layout == other.layout
+                and np.array_equal(self.counts, other.counts))
+
+    @classmethod
+    def merge_all(cls, histograms):
+        """
+        :param histograms: iterable of histograms with the same layout
+        :return: a new histogram with the sum of all counts, or None if there are no histograms
+        """
+        merged = None
+        for histogram in histograms:
+            merged = histogram.copy() if merged is None else merged.merge(histogram)
+        return merged
+
+    def percentiles(self, percentiles):
+        """
+        :param percentiles: list of percentiles between 0 and 100
+        :return: list of the bucket values at the percentiles, None for an empty histogram
+        """
+        total = self.total
+        if total == 0:
+            return [None for _ in percentiles]
+        cumulative = np.cumsum(self.counts)
+        # The smallest bucket with at least percentile% of the values at or below it
+        ranks = np.maximum(np.ceil(np.asarray(percentiles, dtype=np.float64) / 100 * total), 1)
+        indices = np.searchsorted(cumulative, ranks, side='left')
+        values = self.bucket_values()[indices]
+        return [float(value) for value in values]
+
+    def percentile(self, percentile):
+        return self.percentiles([percentile])[0]
+
+    def mean(self):
+        total = self.total
+        if total == 0:
+            return None
+        return float((self.counts * self.bucket_values()).sum() / total)
+
+    def max(self):
+        nonzero = np.flatnonzero(self.counts)
+        return float(self.bucket_values()[nonzero[-1]]) if len(nonzero) else None
+
+    def to_dict(self):
+        """
+        Compact, JSON serializable form: only the non-empty buckets are kept and their indices are delta encoded
+        """
+        indices = np.flatnonzero(self.counts)
+        deltas = np.diff(indices, prepend=0)
+        return dict(sub_bucket_bits=self.sub_bucket_bits, max_bits=self.max_bits, index_deltas=deltas.tolist(),
+                    counts=self.counts[indices].tolist())
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls(sub_bucket_bits=data['sub_bucket_bits'], max_bits=data['max_bits'])
+        indices = np.cumsum(np.asarray(data['index_deltas'], dtype=np.int64))
+        histogram.counts[indices] = np.asarray(data['counts'], dtype=np.uint64)
+        return histogram
+
+    def __getstate__(self):
+        # Persist the sparse form, most buckets of a latency histogram are empty
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        restored = self.from_dict(state)
+        self.__dict__.update(restored.__dict__)
@@ -1,14 +1,636 @@
 import os
+import abc
 import json
 import pickle
+import struct
+import sqlite3
+import weakref
 import tempfile
+import threading
+import contextlib
 
-from collections import MutableSequence
+from collections.abc import MutableSequence
+
+
+def _encode_index(index):
+    # Slices aren't JSON serializable, store them as a tagged list
+    if isinstance(index, slice):
+        return ['slice', index.start, index.stop, index.step]
+    return index
+
+
+def _decode_index(index):
+    if isinstance(index, (list, tuple)) and len(index) == 4 and index[0] == 'slice':
+        return slice(*index[1:])
+    return index
+
+
+def apply_mutation(data, op, index, obj):
+    """
+    Apply a single journaled mutation to a list
+
+    :param data: list to mutate in place
+    :param op: 'set', 'del' or 'insert'
+    :param index: int or slice
+    :param obj: the value for 'set' and 'insert'
+    :return:
+    """
+    if op == 'set':
+        data[index] = obj
+    elif op == 'del':
+        del data[index]
+    elif op == 'insert':
+        data.insert(index, obj)
+    else:
+        raise ValueError(f'Unknown mutation "{op}"')
+
+
+# How hard a write is pushed towards the disk:
+#   none: leave it in the file object's buffer, the OS gets it eventually
+#   flush: hand it to the OS after every write (survives a crash of this process)
+#   fsync: flush and fsync after every write (survives a crash of the machine)
+#   group: writes are collected in memory and a background thread commits them with a single fsync every
+#          group_commit_ms milliseconds
+DURABILITIES = ('none', 'flush', 'fsync', 'group')
+
+
+class SequenceStorage(abc.ABC):
+
+    def __init__(self, filename, method='pickle', durability='flush'):
+        """
+        A SequenceStorage decides how a PersistentMutableSequence gets to disk. The sequence calls record() once for
+          every mutation (or record_many() for a batch of them) and save() when it wants a full copy written.
+
+        :param filename:
+        :param method: 'pickle' or 'json'
+        :param durability: one of DURABILITIES
+        """
+        if durability not in DURABILITIES:
+            raise ValueError(f'Durability "{durability}" is not one of: {DURABILITIES}')
+
+        self.filename = filename
+        self.method = method
+        self.durability = durability
+
+    @property
+    def binary(self):
+        return self.method == 'pickle'
+
+    def _dump(self, obj, open_file):
+        if self.method == 'json':
+            json.dump(obj, open_file)
+        elif self.method == 'pickle':
+            pickle.dump(obj, open_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _load(self, open_file):
+        if self.method == 'json':
+            return json.load(open_file)
+        elif self.method == 'pickle':
+            return pickle.load(open_file)
+
+    def _sync(self, open_file):
+        if self.durability == 'none':
+            return
+        open_file.flush()
+        if self.durability in ('fsync', 'group'):
+            os.fsync(open_file.fileno())
+
+    def _write_snapshot(self, snapshot):
+        """
+        Write a snapshot next to the target and move it into place so a crash never leaves a half written file
+        """
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        file_descriptor, temp_name = tempfile.mkstemp(dir=directory, prefix='.pbk-snapshot-')
+        try:
+            with os.fdopen(file_descriptor, 'wb' if self.binary else 'w') as open_file:
+                self._dump(snapshot, open_file)
+                self._sync(open_file)
+            os.replace(temp_name, self.filename)
+        except BaseException:
+            os.remove(temp_name)
+            raise
+
+    def _read_snapshot(self):
+        if not os.path.exists(self.filename) or os.path.getsize(self.filename) == 0:
+            return None
+        with open(self.filename, 'rb' if self.binary else 'r') as open_file:
+            return self._load(open_file)
+
+    @abc.abstractmethod
+    def load(self, on_member_loaded=None):
+        """
+        Rebuild the stored sequence
+
+        :param on_member_loaded: storages that load members lazily call this for each member as it is loaded
+        :return: the container of members (a list unless the storage loads lazily), or None if nothing has been
+          stored yet
+        """
+
+    def wrap(self, data, on_member_loaded=None):
+        """
+        Turn a fresh list of members into the container the sequence works on
+        """
+        return data
+
+    @abc.abstractmethod
+    def save(self, data):
+        """
+        Write the full sequence
+        """
+
+    @abc.abstractmethod
+    def record(self, op, index, obj, data):
+        """
+        Persist a single mutation. data is the sequence after the mutation was applied.
+        """
+
+    def record_many(self, records, data):
+        """
+        Persist a list of (op, index, obj) mutations in one go. data is the sequence after all of them were applied.
+        """
+        for op, index, obj in records:
+            self.record(op, index, obj, data)
+
+    def close(self):
+        pass
+
+    def files(self):
+        return [self.filename]
+
+
+class SnapshotStorage(SequenceStorage):
+    """
+    Rewrites the whole sequence on every mutation. Simple and fine for short sequences.
+    """
+
+    def load(self, on_member_loaded=None):
+        snapshot = self._read_snapshot()
+        return None if snapshot is None else list(snapshot['data'])
+
+    def save(self, data):
+        self._write_snapshot(dict(seq=0, data=list(data)))
+
+    def record(self, op, index, obj, data):
+        self.save(data)
+
+    def record_many(self, records, data):
+        if records:
+            self.save(data)
+
+
+class JournalStorage(SequenceStorage):
+
+    def __init__(self, filename, method='pickle', durability='flush', compact_threshold=8 * 1024 * 1024):
+        """
+        Appends one small record per mutation to <filename>.journal instead of rewriting the sequence. Once the
+          journal grows past compact_threshold bytes it is rotated and a fresh snapshot is written by a background
+          thread.
+
+        Every record carries a sequence number and every snapshot stores the last sequence number it contains.
+          Loading replays the snapshot plus any journal records newer than it, so a crash at any point of a
+          compaction loses nothing and applies nothing twice. A torn record at the end of a journal (crash during
+          an append) is ignored and cut off when loading, so later appends start on a record boundary.
+
+        :param filename:
+        :param method: 'pickle' or 'json'
+        :param durability: one of DURABILITIES
+        :param compact_threshold: journal size in bytes that triggers a compaction
+        """
+        super().__init__(filename, method, durability)
+        self.compact_threshold = compact_threshold
+        self.journal_filename = f'{filename}.journal'
+        self.rotated_filename = f'{filename}.journal.old'
+
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._journal = None
+        self._compaction = None
+
+    def _open_journal(self):
+        if self._journal is None:
+            self._journal = open(self.journal_filename, 'ab' if self.binary else 'a')
+        return self._journal
+
+    def _read_journal(self, filename):
+        """
+        :return: (list of records, offset just past the last complete record)
+        """
+        if not os.path.exists(filename):
+            return [], 0
+
+        records = []
+        end = 0
+        with open(filename, 'rb') as open_file:
+            if self.method == 'pickle':
+                while True:
+                    try:
+                        records.append(pickle.load(open_file))
+                    except (EOFError, pickle.UnpicklingError, ValueError, struct.error, AttributeError, IndexError):
+                        break
+                    end = open_file.tell()
+            else:
+                for line in open_file:
+                    # A record only counts once its newline is written
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        break
+                    end += len(line)
+        return records, end
+
+    def load(self, on_member_loaded=None):
+        self.wait()
+        snapshot = self._read_snapshot()
+        if snapshot is None and not os.path.exists(self.journal_filename):
+            return None
+
+        data = [] if snapshot is None else list(snapshot['data'])
+        snapshot_seq = 0 if snapshot is None else snapshot['seq']
+        self._seq = snapshot_seq
+
+        for filename in (self.rotated_filename, self.journal_filename):
+            records, end = self._read_journal(filename)
+            for seq, op, index, obj in records:
+                if seq <= snapshot_seq:
+                    continue
+                apply_mutation(data, op, _decode_index(index), obj)
+                self._seq = seq
+            if filename == self.journal_filename and os.path.exists(filename) and os.path.getsize(filename) > end:
+                # Drop the torn record a crash during an append left behind, new records would land after it and
+                #   be unreadable
+                os.truncate(filename, end)
+
+        if os.path.exists(self.rotated_filename):
+            # A compaction didn't finish. Fold everything into a new snapshot so the next rotation can't clobber
+            #   records that only live in the rotated journal.
+            self.save(data)
+
+        return data
+
+    def save(self, data):
+        """
+        Synchronous compaction: write a snapshot of data and start a new journal
+        """
+        self.wait()
+        with self._lock:
+            self._close_journal()
+            self._write_snapshot(dict(seq=self._seq, data=list(data)))
+            for filename in (self.journal_filename, self.rotated_filename):
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+    def record(self, op, index, obj, data):
+        self.record_many([(op, index, obj)], data)
+
+    def record_many(self, records, data):
+        if not records:
+            return
+
+        with self._lock:
+            payload = []
+            for op, index, obj in records:
+                self._seq += 1
+                record = [self._seq, op, _encode_index(index), obj]
+                if self.method == 'json':
+                    payload.append(json.dumps(record) + '\n')
+                else:
+                    payload.append(pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL))
+
+            journal = self._open_journal()
+            journal.write(''.join(payload) if self.method == 'json' else b''.join(payload))
+            self._sync(journal)
+
+            if journal.tell() >= self.compact_threshold and self._compaction is None:
+                self._start_compaction(data)
+
+    def _start_compaction(self, data):
+        # Called with the lock held. Serialize the snapshot now, while the members can't change underneath us, and
+        #   leave the expensive part (writing it out) to the background thread.
+        self._close_journal()
+        os.replace(self.journal_filename, self.rotated_filename)
+        if self.binary:
+            payload = pickle.dumps(dict(seq=self._seq, data=list(data)), protocol=pickle.HIGHEST_PROTOCOL)
+        else:
+            payload = json.dumps(dict(seq=self._seq, data=list(data)))
+
+        self._compaction = threading.Thread(target=self._compact, args=(payload,), name='pbk-journal-compaction',
+                                            daemon=True)
+        self._compaction.start()
+
+    def _compact(self, payload):
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        file_descriptor, temp_name = tempfile.mkstemp(dir=directory, prefix='.pbk-snapshot-')
+        try:
+            with os.fdopen(file_descriptor, 'wb' if self.binary else 'w') as open_file:
+                open_file.write(payload)
+                self._sync(open_file)
+            os.replace(temp_name, self.filename)
+            # Only drop the rotated journal once the snapshot covering it is in place
+            os.remove(self.rotated_filename)
+        finally:
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+            with self._lock:
+                self._compaction = None
+
+    def _close_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def wait(self):
+        """
+        Block until a running background compaction is done
+        """
+        compaction = self._compaction
+        if compaction is not None:
+            compaction.join()
+
+    def close(self):
+        self.wait()
+        with self._lock:
+            if self._journal is not None:
+                self._journal.flush()
+            self._close_journal()
+
+    def files(self):
+        return [self.filename, self.journal_filename, self.rotated_filename]
+
+
+class SQLiteRows(object):
+
+    def __init__(self, storage, on_member_loaded=None):
+        """
+        List-like view of the rows of a SQLiteStorage. Members are unpickled only when they are accessed and are
+          kept in a weak cache, so memory is bounded by the members the caller is actually holding on to.
+
+        Container changes (set, insert, delete) are written to the database right away, inside the storage's
+          open transaction. The storage commits them.
+
+        :param storage: SQLiteStorage
+        :param on_member_loaded: called with every member when it is materialized
+        """
+        self.storage = storage
+        self.on_member_loaded = on_member_loaded
+        self._cache = weakref.WeakValueDictionary()
+        self._positions = weakref.WeakKeyDictionary()
+        self._len = storage.execute('SELECT COUNT(*) FROM members').fetchone()[0]
+
+    def __len__(self):
+        return self._len
+
+    def _normalize(self, index, for_insert=False):
+        if index < 0:
+            index += self._len
+        if for_insert:
+            return min(max(index, 0), self._len)
+        if not 0 <= index < self._len:
+            raise IndexError('SQLiteRows index out of range')
+        return index
+
+    def _materialize(self, position):
+        try:
+            return self._cache[position]
+        except KeyError:
+            pass
+
+        blob, = self.storage.execute('SELECT data FROM members WHERE position = ?', (position,)).fetchone()
+        obj = self.storage.loads(blob)
+        if self.on_member_loaded is not None:
+            self.on_member_loaded(obj)
+        self._cache_obj(position, obj)
+        return obj
+
+    def _cache_obj(self, position, obj):
+        try:
+            self._positions[obj] = position
+            self._cache[position] = obj
+        except TypeError:
+            # Not every type can be weakly referenced (eg: dicts, ints) or hashed (a class with __eq__ but no
+            #   __hash__), those are simply loaded again next time
+            pass
+
+    def _uncache(self, position):
+        obj = self._cache.pop(position, None)
+        if obj is not None:
+            self._positions.pop(obj, None)
+
+    def _shift_cache(self, start, offset):
+        shifted = {position + offset if position >= start else position: obj
+                   for position, obj in list(self._cache.items())}
+        self._cache = weakref.WeakValueDictionary(shifted)
+        self._positions = weakref.WeakKeyDictionary({obj: position for position, obj in shifted.items()})
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._materialize(position) for position in range(*index.indices(self._len))]
+        return self._materialize(self._normalize(index))
+
+    def __iter__(self):
+        for position in range(self._len):
+            yield self._materialize(position)
+
+    def __setitem__(self, index, obj):
+        if isinstance(index, slice):
+            raise TypeError('SQLiteRows does not support slice assignment')
+        position = self._normalize(index)
+        self.storage.replace_row(position, obj)
+        self._uncache(position)
+        self._cache_obj(position, obj)
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            for position in sorted(range(*index.indices(self._len)), reverse=True):
+                del self[position]
+            return
+
+        position = self._normalize(index)
+        self.storage.execute('DELETE FROM members WHERE position = ?', (position,))
+        self.storage.shift_positions(position + 1, -1)
+        self._uncache(position)
+        self._shift_cache(position + 1, -1)
+        self._len -= 1
+
+    def insert(self, index, obj):
+        position = self._normalize(index, for_insert=True)
+        if position < self._len:
+            self.storage.shift_positions(position, 1)
+            self._shift_cache(position, 1)
+        self.storage.write_row(position, obj, insert=True)
+        self._cache_obj(position, obj)
+        self._len += 1
+
+    def index_of(self, obj):
+        """
+        Position of a materialized member by identity. A member that was never materialized can't be held by the
+          caller, so only the cache needs to be searched.
+        """
+        try:
+            position = self._positions.get(obj)
+        except TypeError:
+            return None
+        if position is None or self._cache.get(position) is not obj:
+            return None
+        return position
+
+
+class SQLiteStorage(SequenceStorage):
+    # synchronous pragma for each durability. WAL mode with synchronous=NORMAL only syncs on checkpoints.
+    SYNCHRONOUS = dict(none='OFF', flush='NORMAL', fsync='FULL', group='FULL')
+
+    def __init__(self, filename, method='pickle', durability='flush', index_attribute='status'):
+        """
+        Keeps one row per member in a SQLite database with an indexed column holding the value of each member's
+          index_attribute (the status of a test). Members are loaded lazily (see SQLiteRows) and questions like
+          "where is the next pending member" or "how many are completed" are answered by the database without
+          loading the sequence.
+
+        Every record() is committed right away. record_many() commits a whole batch in one transaction.
+
+        :param filename: path of the SQLite database
+        :param method: how members are serialized into their row: 'pickle' or 'json'
+        :param durability: one of DURABILITIES
+        :param index_attribute: member attribute stored in the indexed column
+        """
+        super().__init__(filename, method, durability)
+        self.index_attribute = index_attribute
+        self._lock = threading.RLock()
+        # Members SQLiteRows replaced since the last record_many, by id. Their 'set' records are already written.
+        self._replaced = {}
+
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(f'PRAGMA synchronous={self.SYNCHRONOUS[durability]}')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS members '
+                                 '(position INTEGER PRIMARY KEY, indexed TEXT, data BLOB NOT NULL)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS members_indexed ON members (indexed, position)')
+        self._connection.commit()
+
+    def execute(self, sql, parameters=()):
+        with self._lock:
+            return self._connection.execute(sql, parameters)
+
+    def dumps(self, obj):
+        if self.method == 'json':
+            return json.dumps(obj)
+        return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, blob):
+        if self.method == 'json':
+            return json.loads(blob)
+        return pickle.loads(blob)
+
+    def _indexed_value(self, obj):
+        # Read straight from __dict__, a descriptor may raise for attributes that were never set
+        value = getattr(obj, '__dict__', {}).get(self.index_attribute)
+        if value is None and isinstance(obj, dict):
+            value = obj.get(self.index_attribute)
+        return None if value is None else str(value)
+
+    def write_row(self, position, obj, insert=False):
+        verb = 'INSERT' if insert else 'REPLACE'
+        self.execute(f'{verb} INTO members (position, indexed, data) VALUES (?, ?, ?)',
+                     (position, self._indexed_value(obj), self.dumps(obj)))
+
+    def replace_row(self, position, obj):
+        """
+        Write a member set by the container. The 'set' record that follows it in record_many is skipped.
+        """
+        with self._lock:
+            self.write_row(position, obj)
+            self._replaced[id(obj)] = obj
+
+    def shift_positions(self, start, offset):
+        """
+        Move every row at or after start by offset. Done in two steps through negative positions so the primary key
+          is never violated halfway through the update.
+        """
+        with self._lock:
+            self._connection.execute('UPDATE members SET position = -(position + ?) - 1 WHERE position >= ?',
+                                     (offset, start))
+            self._connection.execute('UPDATE members SET position = -position - 1 WHERE position < 0')
+
+    def load(self, on_member_loaded=None):
+        return SQLiteRows(self, on_member_loaded=on_member_loaded)
+
+    def wrap(self, data, on_member_loaded=None):
+        with self._lock:
+            self._connection.execute('DELETE FROM members')
+            self._connection.executemany('INSERT INTO members (position, indexed, data) VALUES (?, ?, ?)',
+                                         ((position, self._indexed_value(obj), self.dumps(obj))
+                                          for position, obj in enumerate(data)))
+            self._connection.commit()
+        return SQLiteRows(self, on_member_loaded=on_member_loaded)
+
+    def save(self, data):
+        with self._lock:
+            if not isinstance(data, SQLiteRows):
+                self.wrap(data)
+            self._connection.commit()
+
+    def record(self, op, index, obj, data):
+        self.record_many([(op, index, obj)], data)
+
+    def record_many(self, records, data):
+        with self._lock:
+            for op, index, obj in records:
+                # Container changes were already written by SQLiteRows, only member state changes need a write.
+                #   The first 'set' of a replaced member is the container's own record, a later one is a state change.
+                if op != 'set' or not isinstance(index, int) or self._replaced.pop(id(obj), None) is not None:
+                    continue
+                self.write_row(index % len(data), obj)
+            self._replaced.clear()
+            self._connection.commit()
+
+    def first_with_value(self, values, start=0):
+        values = [str(value) for value in values]
+        placeholders = ', '.join('?' * len(values))
+        row = self.execute(f'SELECT MIN(position) FROM members WHERE indexed IN ({placeholders}) AND position >= ?',
+                           (*values, start)).fetchone()
+        return row[0]
+
+    def count_with_value(self, value):
+        return self.execute('SELECT COUNT(*) FROM members WHERE indexed = ?', (str(value),)).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
+
+    def files(self):
+        return [self.filename, f'{self.filename}-wal', f'{self.filename}-shm']
+
+
+STORAGES = {'snapshot': SnapshotStorage, 'journal': JournalStorage, 'sqlite': SQLiteStorage}
 
 
 class PersistentMutableSequence(MutableSequence, list):
 
-    def __init__(self, init_sequence=None, filename=None, method='pickle'):
+    def __init__(self, init_sequence=None, filename=None, method='pickle', storage='snapshot', load=False,
+                 durability='flush', group_commit_ms=100, **storage_kwargs):
+        """
+        A list that keeps a copy of itself on disk.
+
+        storage='snapshot' rewrites the whole container on every mutation. storage='journal' appends one record per
+          mutation and compacts in the background, see JournalStorage. storage='sqlite' keeps one row per member in
+          a SQLite database and loads members lazily, see SQLiteStorage.
+
+        Writes can be coalesced with the batch() context manager or with durability='group', in which case a
+          background thread commits whatever changed every group_commit_ms milliseconds. A member that changes many
+          times between two commits is written once.
+
+        :param init_sequence: initial members. Ignored when an existing file is loaded
+        :param filename: where to persist. A temporary file is used if not provided
+        :param method: 'pickle' or 'json'
+        :param storage: 'snapshot', 'journal' or 'sqlite'
+        :param load: rebuild the sequence from filename if it has been persisted before
+        :param durability: 'none', 'flush', 'fsync' or 'group'. See DURABILITIES
+        :param group_commit_ms: commit interval for durability='group'
+        :param storage_kwargs: passed to the storage class, eg: compact_threshold for journal storage or
+          index_attribute for sqlite storage
+        """
         super().__init__()
         supported_persist_methods = ['pickle', 'json']
         if method in supported_persist_methods:
@@ -17,51 +639,263 @@ class PersistentMutableSequence(MutableSequence, list):
             raise NotImplementedError(f'{method} is not a supported persist method. '
                                       f'Use one of: {supported_persist_methods}')
 
+        if storage not in STORAGES:
+            raise NotImplementedError(f'{storage} is not a supported storage. Use one of: {list(STORAGES.keys())}')
+
         if filename is None:
-            self.file_descriptor, self.filename = tempfile.mkstemp()
+            file_descriptor, self.filename = tempfile.mkstemp()
+            os.close(file_descriptor)
         else:
-            self.file_descriptor = None
             self.filename = filename
+        self.file_descriptor = None
 
-        # ._data is our container. We use a list as it does everything we need
-        if init_sequence is not None:
-            self._data = list(init_sequence)
-        else:
-            self._data = []
+        self.storage_name = storage
+        self.durability = durability
+        self.group_commit_ms = group_commit_ms
+        self._storage = STORAGES[storage](self.filename, method=method, durability=durability, **storage_kwargs)
+
+        # Positions of members by id() so a member can find itself in O(1). None means it needs a rebuild.
+        self._positions = None
+
+        # Write coalescing. _pending holds container mutations in order, _dirty holds members whose state changed.
+        self._persist_lock = threading.RLock()
+        self._batch_depth = 0
+        self._pending = []
+        self._dirty = {}
+        self._flusher = None
+        self._flusher_stop = threading.Event()
+
+        loaded = self._storage.load(on_member_loaded=self._on_member_loaded) if load else None
+        if loaded is not None:
+            self._data = loaded
+            if isinstance(loaded, list):
+                for member in loaded:
+                    self._on_member_loaded(member)
+            return
+
+        # ._data is our container. We use a list as it does everything we need, unless the storage brings its own
+        init_sequence = list(init_sequence) if init_sequence is not None else []
+        self._data = self._storage.wrap(init_sequence, on_member_loaded=self._on_member_loaded)
 
         self.persist()
 
+    @classmethod
+    def load(cls, filename, method='pickle', storage='snapshot', **kwargs):
+        """
+        Reopen a persisted sequence
+        """
+        if not os.path.exists(filename):
+            raise FileNotFoundError(filename)
+        return cls(filename=filename, method=method, storage=storage, load=True, **kwargs)
+
+    def _on_member_loaded(self, member):
+        """
+        Hook for subclasses to fix up a member after it was loaded from disk
+        """
+
     def __repr__(self):
         return repr((self._data, self.filename))
 
+    def __len__(self):
+        return len(self._data)
+
+    def __getitem__(self, index):
+        return self._data[index]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __contains__(self, obj):
+        return obj in self._data
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    __hash__ = None
+
+    @property
+    def _coalescing(self):
+        return self._batch_depth > 0 or self.durability == 'group'
+
+    def _record(self, op, index, obj):
+        if self._coalescing:
+            self._pending.append((op, index, obj))
+            self._start_flusher()
+        else:
+            self._storage.record(op, index, obj, self._data)
+
     def __setitem__(self, index, obj):
-        self._data[index] = obj
-        self.persist()
+        with self._persist_lock:
+            if hasattr(self._data, 'index_of'):
+                # The container tracks positions itself, looking up the old member could mean loading it
+                pass
+            elif self._positions is not None and isinstance(index, int):
+                self._positions.pop(id(self._data[index]), None)
+                self._positions[id(obj)] = index % len(self._data)
+            else:
+                self._positions = None
+            self._data[index] = obj
+            self._record('set', index, obj)
 
     def __delitem__(self, index):
-        del self._data[index]
-        self.persist()
+        with self._persist_lock:
+            last = len(self._data) - 1
+            if hasattr(self._data, 'index_of'):
+                # See __setitem__
+                pass
+            elif self._positions is not None and isinstance(index, int) and self._data \
+                    and index % len(self._data) == last:
+                self._positions.pop(id(self._data[last]), None)
+            else:
+                self._positions = None
+            del self._data[index]
+            self._record('del', index, None)
 
     def insert(self, index, obj):
-        self._data.insert(index, obj)
-        self.persist()
+        with self._persist_lock:
+            # Appending is by far the most common insert and doesn't move anyone else
+            if self._positions is not None and index >= len(self._data):
+                self._positions[id(obj)] = len(self._data)
+            else:
+                self._positions = None
+            self._data.insert(index, obj)
+            self._record('insert', index, obj)
 
-    def persist(self):
-        if self.file_descriptor is not None:
-            open_file = os.fdopen(self.file_descriptor, 'w')
-        else:
-            open_file = open(self.filename, 'w')
+    def index_of(self, obj):
+        """
+        Position of obj by identity, or None if obj is not a member
+        """
+        if hasattr(self._data, 'index_of'):
+            return self._data.index_of(obj)
+        if self._positions is None:
+            self._positions = {id(member): position for position, member in enumerate(self._data)}
+        position = self._positions.get(id(obj))
+        if position is None or position >= len(self._data) or self._data[position] is not obj:
+            return None
+        return position
 
-        if self.persist_method is 'json':
-            json.dump(self, open_file)
-        elif self.persist_method is 'pickle':
-            pickle.dump(self, open_file)
+    def persist_item(self, obj):
+        """
+        Persist a change to the state of a member. With journal storage this writes a single record for the
+          member instead of the whole sequence. Inside a batch, or with durability='group', the member is only
+          marked dirty and written once at the next flush.
+        """
+        with self._persist_lock:
+            position = self.index_of(obj)
+            if position is None:
+                return
 
-        open_file.flush()
-        open_file.close()
+            if self._coalescing:
+                self._dirty[id(obj)] = obj
+                self._start_flusher()
+                return
+
+            self._storage.record('set', position, obj, self._data)
+
+    def _member_value(self, member, attribute):
+        value = getattr(member, '__dict__', {}).get(attribute)
+        if value is None and isinstance(member, dict):
+            value = member.get(attribute)
+        return value
+
+    def find_status(self, statuses, start=0, attribute='status'):
+        """
+        Position of the first member at or after start whose status is one of statuses, or None. With sqlite storage
+          this is an indexed query that doesn't load any members.
+
+        :param statuses: a status or list of statuses
+        :param start:
+        :param attribute: member attribute to compare
+        """
+        statuses = [statuses] if isinstance(statuses, str) else list(statuses)
+        self.flush()
+        if hasattr(self._storage, 'first_with_value') and attribute == self._storage.index_attribute:
+            return self._storage.first_with_value(statuses, start)
+
+        for position in range(start, len(self._data)):
+            if self._member_value(self._data[position], attribute) in statuses:
+                return position
+        return None
+
+    def count_status(self, status, attribute='status'):
+        """
+        Number of members with the given status. With sqlite storage this doesn't load any members.
+        """
+        self.flush()
+        if hasattr(self._storage, 'count_with_value') and attribute == self._storage.index_attribute:
+            return self._storage.count_with_value(status)
+        return sum(1 for member in self._data if self._member_value(member, attribute) == status)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Coalesce all changes made inside the block into a single write when the outermost batch exits
+
+            with test_list.batch():
+                for test in test_list:
+                    test.status = 'pending'
+        """
+        with self._persist_lock:
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self._persist_lock:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self.flush()
+
+    def flush(self):
+        """
+        Write out everything that is pending. Container mutations go first, in order, followed by one record per
+          dirty member at its current position.
+        """
+        with self._persist_lock:
+            records = self._pending
+            dirty = self._dirty
+            self._pending = []
+            self._dirty = {}
+
+            for obj in dirty.values():
+                position = self.index_of(obj)
+                if position is not None:
+                    records.append(('set', position, obj))
+
+            self._storage.record_many(records, self._data)
+
+    def _start_flusher(self):
+        if self.durability != 'group' or self._flusher is not None:
+            return
+        self._flusher_stop.clear()
+        self._flusher = threading.Thread(target=self._flush_loop, name='pbk-group-commit', daemon=True)
+        self._flusher.start()
+
+    def _flush_loop(self):
+        while not self._flusher_stop.wait(self.group_commit_ms / 1000):
+            if self._pending or self._dirty:
+                self.flush()
+        self.flush()
+
+    def persist(self):
+        with self._persist_lock:
+            # A full save covers everything that's pending
+            self._pending = []
+            self._dirty = {}
+            self._storage.save(self._data)
+
+    def close(self):
+        if self._flusher is not None:
+            self._flusher_stop.set()
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
+        self._storage.close()
 
     def remove_file(self):
-        os.remove(self.filename)
+        self.close()
+        for filename in self._storage.files():
+            if os.path.exists(filename):
+                os.remove(filename)
         self.file_descriptor = None
         self.filename = None
 
@@ -1,92 +1,864 @@
+import os
+import abc
+import time
+import uuid
+import codecs
+import shlex
+import atexit
 import select
 import socket
-import functools
+import getpass
+import selectors
+import threading
+import subprocess
 import paramiko
 
 
-def send_ssh_command(command=None, host='127.0.0.1', username='root', password=None, key_filename=None,
-                     logger=None, timeout=60):
+# Largest read from a channel in one go and the longest line a CommandStream buffers before splitting it
+CHUNK_SIZE = 65536
+MAX_LINE_LENGTH = 1024 * 1024
+
+# Key types we try, in order, when loading a private key file
+KEY_CLASSES = (paramiko.RSAKey, paramiko.ECDSAKey, paramiko.Ed25519Key)
+
+_key_cache = {}
+_key_cache_lock = threading.Lock()
+
+
+def load_private_key(key_filename):
     """
-    The code comes from here: https://stackoverflow.com/questions/23504126/
-    do-you-have-to-check-exit-status-ready-if-you-are-going-to-check-recv-ready
+    Parse a private key file once and keep the parsed key around. The cache is keyed by the absolute path and the
+      modification time of the file so a rotated key gets picked up without restarting the process.
+
+    :param key_filename:
+    :return: paramiko.PKey
+    """
+    path = os.path.abspath(os.path.expanduser(key_filename))
+    cache_key = (path, os.stat(path).st_mtime)
+    with _key_cache_lock:
+        if cache_key in _key_cache:
+            return _key_cache[cache_key]
+
+    errors = []
+    for key_class in KEY_CLASSES:
+        try:
+            pkey = key_class.from_private_key_file(path)
+            break
+        except paramiko.SSHException as e:
+            errors.append(f'{key_class.__name__}: {e}')
+    else:
+        raise paramiko.SSHException(f'Unable to load private key {path}: {errors}')
+
+    with _key_cache_lock:
+        _key_cache[cache_key] = pkey
+    return pkey
+
+
+class SSHConnectionPool(object):
+    """
+    A process-local pool of connected paramiko.SSHClient instances keyed by (host, username, key_filename). Passwords
+      are only used to connect and are never part of a key, so they don't end up in keys, reprs or logs.
+
+    Every command sent through the pool opens a new exec channel on an already authenticated transport instead of
+      doing a full TCP + SSH handshake. Idle connections are kept alive with SSH keepalives and are closed once they
+      have been idle for longer than idle_timeout, which is checked whenever a connection is acquired or released.
+      Connections whose transport has died are dropped and reconnected on next use.
+
+    The pool is safe to use from multiple threads. After a fork the child process starts with an empty pool; paramiko
+      transports run their own thread which does not survive a fork.
+    """
+
+    def __init__(self, idle_timeout=300, keepalive_interval=30, connect_timeout=30):
+        self.idle_timeout = idle_timeout
+        self.keepalive_interval = keepalive_interval
+        self.connect_timeout = connect_timeout
+
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._pid = os.getpid()
+
+    @staticmethod
+    def pool_key(host, username, password=None, key_filename=None):
+        """
+        The pool always connects to port 22, the host identifies the server. password is accepted for the
+          signature's sake and ignored: an authenticated connection serves any later request for the same account.
+        """
+        if key_filename is not None:
+            key_filename = os.path.abspath(os.path.expanduser(key_filename))
+        return host, username, key_filename
+
+    def _check_pid(self):
+        # Connections inherited from a parent process are not usable. Don't close them, that would send a disconnect
+        #   over a socket the parent is still using.
+        if os.getpid() != self._pid:
+            self._connections = {}
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+
+    @staticmethod
+    def _is_alive(client):
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def _connect(self, host, username, password=None, key_filename=None):
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        if password is not None:
+            client.connect(host, username=username, password=password, timeout=self.connect_timeout,
+                           allow_agent=False, look_for_keys=False)
+        elif key_filename is not None:
+            client.connect(host, username=username, pkey=load_private_key(key_filename),
+                           timeout=self.connect_timeout, allow_agent=False, look_for_keys=False)
+        else:
+            raise SyntaxError(f'Need either password or ssh key file to send command')
+
+        if self.keepalive_interval:
+            client.get_transport().set_keepalive(self.keepalive_interval)
+        return client
+
+    def acquire(self, host, username, password=None, key_filename=None):
+        """
+        Get a connected client for the given host and credentials. Every acquire() needs a matching release()
+
+        :return: paramiko.SSHClient
+        """
+        key = self.pool_key(host, username, password, key_filename)
+        self._check_pid()
+        self.evict()
+
+        with self._lock:
+            entry = self._connections.get(key)
+            if entry is not None and self._is_alive(entry['client']):
+                entry['in_use'] += 1
+                entry['last_used'] = time.time()
+                return entry['client']
+
+        # Connecting can take a while, don't hold the lock while we do it
+        client = self._connect(host, username, password, key_filename)
+        with self._lock:
+            entry = self._connections.get(key)
+            if entry is not None and self._is_alive(entry['client']):
+                # Another thread beat us to it. Use theirs so we keep one transport per key.
+                client.close()
+            else:
+                if entry is not None:
+                    entry['client'].close()
+                entry = dict(client=client, in_use=0, last_used=time.time())
+                self._connections[key] = entry
+            entry['in_use'] += 1
+            return entry['client']
+
+    def release(self, host, username, password=None, key_filename=None):
+        key = self.pool_key(host, username, password, key_filename)
+        with self._lock:
+            entry = self._connections.get(key)
+            if entry is not None:
+                entry['in_use'] = max(0, entry['in_use'] - 1)
+                entry['last_used'] = time.time()
+        # Evict here too, a process that stops acquiring would otherwise keep its idle connections forever
+        self.evict()
+
+    def discard(self, host, username, password=None, key_filename=None):
+        """
+        Close and forget the connection for the given key. Used when a transport fails in the middle of a command
+        """
+        key = self.pool_key(host, username, password, key_filename)
+        with self._lock:
+            entry = self._connections.pop(key, None)
+        if entry is not None:
+            entry['client'].close()
+
+    def evict(self):
+        """
+        Close connections that are dead or that have been idle longer than idle_timeout
+        """
+        now = time.time()
+        evicted = []
+        with self._lock:
+            for key, entry in list(self._connections.items()):
+                idle = entry['in_use'] == 0 and now - entry['last_used'] > self.idle_timeout
+                if idle or not self._is_alive(entry['client']):
+                    evicted.append(self._connections.pop(key))
+
+        for entry in evicted:
+            entry['client'].close()
+
+    def close_all(self):
+        with self._lock:
+            entries = list(self._connections.values())
+            self._connections = {}
+
+        for entry in entries:
+            entry['client'].close()
+
+    def __len__(self):
+        return len(self._connections)
+
+
+connection_pool = SSHConnectionPool()
+atexit.register(connection_pool.close_all)
+
+
+def _exec_pooled(command, host, username, password=None, key_filename=None, pool=None):
     """
+    Open an exec channel for command on a pooled connection. If the pooled transport went away between the liveness
+      check and opening the channel we reconnect once.
+
+    :return: (stdin, stdout, stderr) paramiko channel files
+    """
+    pool = connection_pool if pool is None else pool
+    for attempt in range(2):
+        client = pool.acquire(host, username, password, key_filename)
+        try:
+            return client.exec_command(command)
+        except (paramiko.SSHException, EOFError, socket.error):
+            pool.release(host, username, password, key_filename)
+            pool.discard(host, username, password, key_filename)
+            if attempt:
+                raise
+
+
+def run_ssh_command(command=None, host='127.0.0.1', username='root', password=None, key_filename=None,
+                    logger=None, timeout=60, pool=None, pooled=True, deadline=None):
+    """
+    Run a command over a pooled (or a dedicated, when pooled=False) connection. Unlike send_ssh_command this also
+      returns the exit status of the command.
+
+    :param timeout: seconds without output before the command is considered hung
+    :param deadline: time.monotonic() by which the command has to be done, None for no limit
+    :raises TimeoutError: when the timeout or the deadline passes
+
+    :return: (stdout, stderr, exit_status)
+    """
+    command = _join_command(command)
+    if pooled:
+        pool = connection_pool if pool is None else pool
+    else:
+        pool = SSHConnectionPool(keepalive_interval=0)
+
+    stdin, stdout, stderr = _exec_pooled(command, host, username, password, key_filename, pool=pool)
+    try:
+        return _read_channel(stdin, stdout, stderr, timeout=timeout, logger=logger, command=command,
+                             deadline=deadline)
+    finally:
+        pool.release(host, username, password, key_filename)
+        if not pooled:
+            pool.close_all()
+
+
+def _join_command(command):
     if hasattr(command, '__iter__') and not isinstance(command, str):
         command = [str(part) for part in command]
         command = ' '.join(command)
+    return command
 
-    conn = paramiko.SSHClient()
-    conn.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    if password is not None:
-        conn.connect(host, username=username, password=password)
-    elif key_filename is not None:
-        pkey = paramiko.RSAKey.from_private_key_file(key_filename)
-        conn.connect(host, username=username, pkey=pkey)
-    else:
-        raise SyntaxError(f'Need either password or ssh key file to send command')
-    stdin, stdout, stderr = conn.exec_command(command)
 
-    if logger: logger.info(f'Sent command: {command}')
+def send_ssh_command(command=None, host='127.0.0.1', username='root', password=None, key_filename=None,
+                     logger=None, timeout=60, pool=None, pooled=True, deadline=None):
+    """
+    The code comes from here: https://stackoverflow.com/questions/23504126/
+    do-you-have-to-check-exit-status-ready-if-you-are-going-to-check-recv-ready
+
+    By default the command runs on a connection from the process-wide connection_pool. Pass pooled=False to get
+      a dedicated connection that is closed when the command completes.
+    """
+    ret_stdout, ret_stderr, _ = run_ssh_command(command, host, username, password, key_filename, logger=logger,
+                                                timeout=timeout, pool=pool, pooled=pooled, deadline=deadline)
+    return ret_stdout, ret_stderr
+
+
+BATCH_MARKER = 'PBK-BATCH'
+
+
+def build_batch_script(commands, token=None):
+    """
+    Wrap a list of commands in a single POSIX shell script. Each command runs in its own subshell (so an `exit` in
+      one command doesn't end the batch) and is surrounded by begin/end marker lines on both stdout and stderr. The
+      end marker on stdout carries the exit code of the command.
+
+    :param commands: list of commands. Each command can be a string or a list of arguments
+    :param token: unique string for the markers. A random one is generated if not provided
+    :return: (script, token)
+    """
+    token = uuid.uuid4().hex if token is None else token
+    lines = []
+    for index, command in enumerate(commands):
+        begin = f'{BATCH_MARKER}:{token}:{index}:begin'
+        end = f'{BATCH_MARKER}:{token}:{index}:end'
+        lines.append(f"printf '%s\\n' '{begin}'; printf '%s\\n' '{begin}' >&2")
+        lines.append(f'( {_join_command(command)}\n) </dev/null')
+        lines.append(f"__pbk_rc=$?; printf '\\n%s:%s\\n' '{end}' \"$__pbk_rc\"; printf '\\n%s\\n' '{end}' >&2")
+
+    return 'sh -c ' + shlex.quote('\n'.join(lines)), token
+
+
+def parse_batch_output(stdout, stderr, count, token):
+    """
+    Split the output of a script from build_batch_script back into per-command results. Commands that never
+      produced an end marker (the batch was killed or timed out) get whatever output was captured and an exit code
+      of None.
+
+    :return: list of (stdout, stderr, exit_code) tuples, one per command
+    """
+    def _split(output, index, with_code):
+        begin = f'{BATCH_MARKER}:{token}:{index}:begin\n'
+        end = f'\n{BATCH_MARKER}:{token}:{index}:end'
+        start = output.find(begin)
+        if start < 0:
+            return '', None
+        start += len(begin)
+        stop = output.find(end, start)
+        if stop < 0:
+            return output[start:], None
 
+        exit_code = None
+        if with_code:
+            code = output[stop + len(end):].split('\n', 1)[0].lstrip(':')
+            exit_code = int(code) if code.lstrip('-').isdigit() else None
+        return output[start:stop], exit_code
+
+    results = []
+    for index in range(count):
+        cmd_stdout, exit_code = _split(stdout, index, with_code=True)
+        cmd_stderr, _ = _split(stderr, index, with_code=False)
+        results.append((cmd_stdout, cmd_stderr, exit_code))
+
+    return results
+
+
+def send_ssh_commands(commands=None, host='127.0.0.1', username='root', password=None, key_filename=None,
+                      logger=None, timeout=60, pool=None, pooled=True, deadline=None):
+    """
+    Run a list of commands in a single remote shell invocation. This costs one round trip regardless of how many
+      commands are sent.
+
+    :param commands: list of commands. Each command can be a string or a list of arguments
+    :return: list of (stdout, stderr, exit_code) tuples in the same order as commands
+    """
+    commands = list(commands)
+    if not commands:
+        return []
+
+    script, token = build_batch_script(commands)
+    stdout, stderr, _ = run_ssh_command(script, host, username, password, key_filename, logger=logger,
+                                        timeout=timeout, pool=pool, pooled=pooled, deadline=deadline)
+    return parse_batch_output(stdout, stderr, len(commands), token)
+
+
+def _time_left(timeout, deadline, last_output):
+    """
+    Seconds to wait for more output before the idle timeout or the deadline passes
+
+    :param timeout: seconds without output that are allowed, None or 0 for no limit
+    :param deadline: time.monotonic() by which the command has to be done, None for no limit
+    :param last_output: time.monotonic() of the last output (or of the start)
+    :return: seconds, or None to wait without a limit
+    :raises TimeoutError: when a limit has passed
+    """
+    now = time.monotonic()
+    limits = []
+    if timeout:
+        limits.append((last_output + timeout, f'No output for {timeout} seconds'))
+    if deadline is not None:
+        limits.append((deadline, 'Deadline passed before the command completed'))
+    if not limits:
+        return None
+    limit, reason = min(limits)
+    if limit <= now:
+        raise TimeoutError(reason)
+    return limit - now
+
+
+def _iter_channel(stdin, stdout, stderr, timeout=60, chunk_size=CHUNK_SIZE, deadline=None):
+    """
+    Generator over the raw output of an exec channel. Yields ('stdout', bytes) and ('stderr', bytes) tuples as data
+      arrives and returns once the remote command has exited and the buffers are drained. At most chunk_size bytes
+      are read at a time so memory use is bounded by what the consumer holds on to.
+
+    When no output arrives for timeout seconds, or the deadline passes, the channel is closed and TimeoutError is
+      raised.
+
+    :param timeout: seconds without output before the command is considered hung, None or 0 to wait forever
+    :param deadline: time.monotonic() by which the command has to be done, None for no limit
+    """
     # get the shared channel for stdout/stderr/stdin
     channel = stdout.channel
     stdin.close()
     channel.shutdown_write()
 
-    # read stdout/stderr in order to prevent read block hangs
-    stdout_chunks = [stdout.channel.recv(len(stdout.channel.in_buffer))]
-    stderr_chunks = []
-
-    # chunked read to prevent stalls
-    while not channel.closed or channel.recv_ready() or channel.recv_stderr_ready():
-        # stop if channel was closed prematurely, and there is no data in the buffers.
-        got_chunk = False
-        readq, _, _ = select.select([stdout.channel], [], [], timeout)
-        for c in readq:
-            if c.recv_ready():
-                stdout_chunks.append(stdout.channel.recv(len(c.in_buffer)))
-                got_chunk = True
-            if c.recv_stderr_ready():
-                # make sure to read stderr to prevent stall
-                stderr_chunks.append(stderr.channel.recv_stderr(len(c.in_stderr_buffer)))
-                got_chunk = True
-        '''
-        1) make sure that there are at least 2 cycles with no data in the input buffers in 
-             order to not exit too early (i.e. cat on a >200k file).
-        2) if no data arrived in the last loop, check if we already received the exit code
-        3) check if input buffers are empty
-        4) exit the loop
-        '''
-        if not got_chunk \
-                and stdout.channel.exit_status_ready() \
-                and not stderr.channel.recv_stderr_ready() \
-                and not stdout.channel.recv_ready():
-            # indicate that we're not going to read from this channel anymore
-            stdout.channel.shutdown_read()
-            # close the channel
-            stdout.channel.close()
-            break  # exit as remote side is finished and our bufferes are empty
-
-    # close all the pseudofiles
-    stdout.close()
-    stderr.close()
-
-    ret_stdout = ''.join([chunk.decode() for chunk in stdout_chunks])
-    ret_stderr = ''.join([chunk.decode() for chunk in stderr_chunks])
+    try:
+        last_output = time.monotonic()
+        # chunked read to prevent stalls
+        while not channel.closed or channel.recv_ready() or channel.recv_stderr_ready():
+            # stop if channel was closed prematurely, and there is no data in the buffers.
+            got_chunk = False
+            readq, _, _ = select.select([channel], [], [], _time_left(timeout, deadline, last_output))
+            for c in readq:
+                if c.recv_ready():
+                    yield 'stdout', c.recv(min(len(c.in_buffer), chunk_size))
+                    got_chunk = True
+                if c.recv_stderr_ready():
+                    # make sure to read stderr to prevent stall
+                    yield 'stderr', c.recv_stderr(min(len(c.in_stderr_buffer), chunk_size))
+                    got_chunk = True
+            if got_chunk:
+                last_output = time.monotonic()
+            '''
+            1) make sure that there are at least 2 cycles with no data in the input buffers in 
+                 order to not exit too early (i.e. cat on a >200k file).
+            2) if no data arrived in the last loop, check if we already received the exit code
+            3) check if input buffers are empty
+            4) exit the loop
+            '''
+            if not got_chunk \
+                    and channel.exit_status_ready() \
+                    and not channel.recv_stderr_ready() \
+                    and not channel.recv_ready():
+                break  # exit as remote side is finished and our bufferes are empty
+    finally:
+        # indicate that we're not going to read from this channel anymore and close it. If the consumer stopped
+        #   early this also tells the remote side to stop sending.
+        channel.shutdown_read()
+        channel.close()
 
-    return ret_stdout, ret_stderr
+        # close all the pseudofiles
+        stdout.close()
+        stderr.close()
+
+
+class CommandStream(object):
+    MODES = ('lines', 'text', 'bytes')
+
+    def __init__(self, chunks, exit_status=None, on_close=None, mode='lines', encoding='utf-8', errors='replace',
+                 max_line_length=MAX_LINE_LENGTH):
+        """
+        Iterator over the output of a running command. Output is yielded as (stream_name, data) tuples where
+          stream_name is 'stdout' or 'stderr' as soon as it arrives.
+
+          mode='bytes': data is the raw chunk
+          mode='text': data is decoded text. Decoding is incremental per stream so multibyte characters split
+            across chunks are decoded correctly
+          mode='lines': data is a single decoded line including the trailing newline. A line longer than
+            max_line_length is yielded in pieces of max_line_length so a stream without newlines can't grow
+            without bound
+
+        After the stream is exhausted exit_status holds the exit status of the command (None if it never exited).
+
+            with stream_ssh_command('fio ...', **auth) as stream:
+                for stream_name, line in stream:
+                    ...
+
+        :param chunks: iterator of (stream_name, bytes)
+        :param exit_status: callable returning the exit status of the command or None
+        :param on_close: callable run once when the stream is exhausted or closed
+        :param mode:
+        :param encoding:
+        :param errors: error handler for decoding
+        :param max_line_length:
+        """
+        if mode not in self.MODES:
+            raise ValueError(f'Mode "{mode}" is not one of: {self.MODES}')
+
+        self.mode = mode
+        self.encoding = encoding
+        self.errors = errors
+        self.max_line_length = max_line_length
+        self.exit_status = None
+
+        self._chunks = chunks
+        self._get_exit_status = exit_status
+        self._on_close = on_close
+        self._closed = False
+        self._decoders = {}
+        self._partial_lines = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __iter__(self):
+        try:
+            for stream_name, chunk in self._chunks:
+                if self.mode == 'bytes':
+                    yield stream_name, chunk
+                elif self.mode == 'text':
+                    text = self._decode(stream_name, chunk)
+                    if text:
+                        yield stream_name, text
+                else:
+                    for line in self._split_lines(stream_name, self._decode(stream_name, chunk)):
+                        yield stream_name, line
+
+            if self.mode != 'bytes':
+                for stream_name in list(self._decoders.keys()):
+                    text = self._decode(stream_name, b'', final=True)
+                    if self.mode == 'text':
+                        if text:
+                            yield stream_name, text
+                    else:
+                        for line in self._split_lines(stream_name, text, final=True):
+                            yield stream_name, line
+        finally:
+            self.close()
+
+    def _decode(self, stream_name, chunk, final=False):
+        if stream_name not in self._decoders:
+            self._decoders[stream_name] = codecs.getincrementaldecoder(self.encoding)(errors=self.errors)
+        return self._decoders[stream_name].decode(chunk, final)
+
+    def _split_lines(self, stream_name, text, final=False):
+        partial = self._partial_lines.pop(stream_name, '') + text
+        lines = partial.splitlines(keepends=True)
+        # A trailing \r is held back too, the \n of a \r\n may be in the next chunk
+        if lines and not final and not lines[-1].endswith('\n'):
+            partial = lines.pop()
+        else:
+            partial = ''
+
+        while len(partial) > self.max_line_length:
+            lines.append(partial[:self.max_line_length])
+            partial = partial[self.max_line_length:]
+
+        if partial:
+            self._partial_lines[stream_name] = partial
+        return lines
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if hasattr(self._chunks, 'close'):
+            self._chunks.close()
+        if self._get_exit_status is not None:
+            self.exit_status = self._get_exit_status()
+        if self._on_close is not None:
+            self._on_close()
+
+
+def stream_ssh_command(command=None, host='127.0.0.1', username='root', password=None, key_filename=None,
+                       logger=None, timeout=60, pool=None, mode='lines', encoding='utf-8', errors='replace',
+                       max_line_length=MAX_LINE_LENGTH, deadline=None):
+    """
+    Start a command on a pooled connection and return a CommandStream over its output. The pooled connection is
+      released when the stream is exhausted or closed.
+
+    :param timeout: seconds without output before the stream raises TimeoutError, None or 0 to wait forever
+    :param deadline: time.monotonic() by which the command has to be done, None for no limit
+
+    :param mode: 'lines', 'text' or 'bytes'. See CommandStream
+    :return: CommandStream
+    """
+    command = _join_command(command)
+    pool = connection_pool if pool is None else pool
+
+    stdin, stdout, stderr = _exec_pooled(command, host, username, password, key_filename, pool=pool)
+    if logger: logger.info(f'Sent command: {command}')
+
+    channel = stdout.channel
+
+    def close_channel():
+        # A stream that is closed before it was iterated never runs the finally of _iter_channel
+        channel.close()
+        pool.release(host, username, password, key_filename)
+
+    return CommandStream(_iter_channel(stdin, stdout, stderr, timeout=timeout, deadline=deadline),
+                         exit_status=lambda: channel.recv_exit_status() if channel.exit_status_ready() else None,
+                         on_close=close_channel,
+                         mode=mode, encoding=encoding, errors=errors, max_line_length=max_line_length)
+
+
+def _read_channel(stdin, stdout, stderr, timeout=60, logger=None, command=None, deadline=None):
+    """
+    Drain the stdout and stderr of an exec channel until the remote command has exited
+
+    :return: (stdout, stderr, exit_status)
+    """
+    if logger: logger.info(f'Sent command: {command}')
+
+    channel = stdout.channel
+    chunks = dict(stdout=[], stderr=[])
+    for stream_name, chunk in _iter_channel(stdin, stdout, stderr, timeout=timeout, deadline=deadline):
+        chunks[stream_name].append(chunk)
+
+    exit_status = channel.recv_exit_status() if channel.exit_status_ready() else None
+
+    # Join before decoding so multibyte characters split across chunks decode properly
+    ret_stdout = b''.join(chunks['stdout']).decode()
+    ret_stderr = b''.join(chunks['stderr']).decode()
+
+    return ret_stdout, ret_stderr, exit_status
+
+
+def _iter_process(process, timeout=60, chunk_size=CHUNK_SIZE, deadline=None):
+    """
+    Local counterpart of _iter_channel. Yields ('stdout', bytes) and ('stderr', bytes) tuples from a subprocess
+      started with stdout and stderr pipes until both pipes hit EOF. If the consumer stops early, no output arrives
+      for timeout seconds or the deadline passes the process is killed.
+    """
+    selector = selectors.DefaultSelector()
+    selector.register(process.stdout, selectors.EVENT_READ, 'stdout')
+    selector.register(process.stderr, selectors.EVENT_READ, 'stderr')
+    try:
+        last_output = time.monotonic()
+        while selector.get_map():
+            for key, _ in selector.select(_time_left(timeout, deadline, last_output)):
+                chunk = os.read(key.fileobj.fileno(), chunk_size)
+                if chunk:
+                    last_output = time.monotonic()
+                    yield key.data, chunk
+                else:
+                    selector.unregister(key.fileobj)
+        # Both pipes are closed but the process may still be running
+        try:
+            process.wait(_time_left(None, deadline, last_output))
+        except subprocess.TimeoutExpired:
+            raise TimeoutError('Deadline passed before the command completed')
+    finally:
+        selector.close()
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+
+class Transport(abc.ABC):
+    name = None
+
+    def __init__(self, host=None, username=None, password=None, key_filename=None, logger=None):
+        """
+        A Transport runs commands on a single host. Everything above this layer (batching, streaming, fleet
+          execution, benchmark executors) works the same regardless of how the commands get to the host.
+
+        Subclasses only need to implement stream(). Every other method is built on top of it.
+
+        :param host:
+        :param username:
+        :param password:
+        :param key_filename:
+        :param logger:
+        """
+        self.host = host
+        self.username = username
+        self.password = password
+        self.key_filename = key_filename
+        self.logger = logger
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(host={self.host!r}, username={self.username!r})'
+
+    @abc.abstractmethod
+    def stream(self, command, timeout=60, mode='lines', encoding='utf-8', errors='replace',
+               max_line_length=MAX_LINE_LENGTH, deadline=None):
+        """
+        Start a command and return a CommandStream over its output. The stream raises TimeoutError and stops the
+          command when no output arrives for timeout seconds or when the deadline passes.
+
+        :param timeout: seconds without output, None or 0 to wait forever
+        :param deadline: time.monotonic() by which the command has to be done, None for no limit
+        :return: CommandStream
+        """
+
+    def run(self, command, timeout=60, deadline=None):
+        """
+        Run a command to completion
+
+        :return: (stdout, stderr, exit_status)
+        """
+        chunks = dict(stdout=[], stderr=[])
+        with self.stream(command, timeout=timeout, mode='bytes', deadline=deadline) as command_stream:
+            for stream_name, chunk in command_stream:
+                chunks[stream_name].append(chunk)
+
+        return b''.join(chunks['stdout']).decode(), b''.join(chunks['stderr']).decode(), command_stream.exit_status
+
+    def send_command(self, command, timeout=60, deadline=None):
+        """
+        Same return signature as send_ssh_command
+
+        :return: (stdout, stderr)
+        """
+        stdout, stderr, _ = self.run(command, timeout=timeout, deadline=deadline)
+        return stdout, stderr
+
+    def send_commands(self, commands, timeout=60, deadline=None):
+        """
+        Run a list of commands in a single invocation. See send_ssh_commands
+
+        :return: list of (stdout, stderr, exit_code) tuples
+        """
+        commands = list(commands)
+        if not commands:
+            return []
+
+        script, token = build_batch_script(commands)
+        stdout, stderr, _ = self.run(script, timeout=timeout, deadline=deadline)
+        return parse_batch_output(stdout, stderr, len(commands), token)
+
+
+class SSHTransport(Transport):
+    name = 'ssh'
+
+    def __init__(self, host=None, username=None, password=None, key_filename=None, logger=None, pool=None):
+        """
+        Runs commands over pooled SSH connections
+        """
+        super().__init__(host, username, password, key_filename, logger)
+        if not (password or key_filename):
+            raise Exception(f'Please provide either a password or key filename')
+        self.pool = pool
+
+    def stream(self, command, timeout=60, mode='lines', encoding='utf-8', errors='replace',
+               max_line_length=MAX_LINE_LENGTH, deadline=None):
+        return stream_ssh_command(command, self.host, self.username, self.password, self.key_filename,
+                                  logger=self.logger, timeout=timeout, pool=self.pool, mode=mode, encoding=encoding,
+                                  errors=errors, max_line_length=max_line_length, deadline=deadline)
+
+    def run(self, command, timeout=60, deadline=None):
+        return run_ssh_command(command, self.host, self.username, self.password, self.key_filename,
+                               logger=self.logger, timeout=timeout, pool=self.pool, deadline=deadline)
+
+    def __getstate__(self):
+        # Pools hold live sockets. A transport sent to another process uses that process' default pool.
+        state = self.__dict__.copy()
+        state['pool'] = None
+        return state
+
+
+class LocalTransport(Transport):
+    name = 'local'
+
+    def __init__(self, host='localhost', username=None, password=None, key_filename=None, logger=None,
+                 shell='/bin/sh'):
+        """
+        Runs commands as subprocesses of this process. No encryption, no handshake, no credentials needed.
+
+        :param shell: shell used to interpret commands
+        """
+        super().__init__(host, username, password, key_filename, logger)
+        self.shell = shell
+
+    def stream(self, command, timeout=60, mode='lines', encoding='utf-8', errors='replace',
+               max_line_length=MAX_LINE_LENGTH, deadline=None):
+        command = _join_command(command)
+        if self.logger: self.logger.info(f'Running local command: {command}')
+        process = subprocess.Popen(command, shell=True, executable=self.shell, stdin=subprocess.DEVNULL,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        def stop_process():
+            # A stream that is closed before it was iterated never runs the finally of _iter_process
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+            process.stderr.close()
+
+        return CommandStream(_iter_process(process, timeout=timeout, deadline=deadline),
+                             exit_status=process.poll, on_close=stop_process,
+                             mode=mode, encoding=encoding, errors=errors, max_line_length=max_line_length)
+
+
+LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1')
+TRANSPORTS = ('auto', 'ssh', 'local')
+
+
+def is_local_host(host, username=None):
+    """
+    A host is handled locally when it names this machine and the commands would run as the current user. Asking for
+      a different user on localhost still goes through SSH so the commands run with that user's permissions.
+    """
+    if host not in LOCAL_HOSTS and host != socket.gethostname():
+        return False
+    return username is None or username == getpass.getuser()
+
+
+def get_transport(host='127.0.0.1', username=None, password=None, key_filename=None, logger=None,
+                  transport='auto'):
+    """
+    Get the Transport for a host. With transport='auto' a LocalTransport is used when is_local_host() is true and
+      an SSHTransport otherwise.
+
+    :param username: None for the current user, like SystemConnection
+    :param transport: 'auto', 'ssh' or 'local'
+    :return: Transport
+    """
+    if transport not in TRANSPORTS:
+        raise ValueError(f'Transport "{transport}" is not one of: {TRANSPORTS}')
+
+    if transport == 'local' or (transport == 'auto' and is_local_host(host, username)):
+        return LocalTransport(host, username, password, key_filename, logger)
+    return SSHTransport(host, username, password, key_filename, logger)
+
+
+def send_command(command=None, host='127.0.0.1', username=None, password=None, key_filename=None, logger=None,
+                 timeout=60, transport='auto'):
+    """
+    Transport agnostic send_ssh_command
+
+    :return: (stdout, stderr)
+    """
+    return get_transport(host, username, password, key_filename, logger, transport).send_command(command, timeout)
+
+
+def run_command(command=None, host='127.0.0.1', username=None, password=None, key_filename=None, logger=None,
+                timeout=60, transport='auto'):
+    """
+    Transport agnostic run_ssh_command
+
+    :return: (stdout, stderr, exit_status)
+    """
+    return get_transport(host, username, password, key_filename, logger, transport).run(command, timeout)
+
+
+def send_commands(commands=None, host='127.0.0.1', username=None, password=None, key_filename=None, logger=None,
+                  timeout=60, transport='auto'):
+    """
+    Transport agnostic send_ssh_commands
+
+    :return: list of (stdout, stderr, exit_code) tuples
+    """
+    return get_transport(host, username, password, key_filename, logger, transport).send_commands(commands, timeout)
+
+
+def stream_command(command=None, host='127.0.0.1', username=None, password=None, key_filename=None, logger=None,
+                   timeout=60, transport='auto', mode='lines', **kwargs):
+    """
+    Transport agnostic stream_ssh_command
+
+    :return: CommandStream
+    """
+    return get_transport(host, username, password, key_filename, logger, transport).stream(
+        command, timeout=timeout, mode=mode, **kwargs)
 
 
 def linux_which(executable=None, host='127.0.0.1', username='root', password=None, key_filename=None,
-                logger=None, timeout=60):
+                logger=None, timeout=60, transport='auto'):
     cmd = f'which {executable}'
-    stdout, stderr = send_ssh_command(cmd, host, username, password, key_filename, logger, timeout)
+    stdout, stderr = send_command(cmd, host, username, password, key_filename, logger, timeout, transport)
 
-    if stdout is '':
+    if stdout == '':
         return None
     else:
         return stdout.strip()
 
 
+def linux_which_all(executables=None, host='127.0.0.1', username='root', password=None, key_filename=None,
+                    logger=None, timeout=60, transport='auto'):
+    """
+    Batched version of linux_which. All executables are looked up in a single round trip.
+
+    :return: dict of {executable: path or None}
+    """
+    executables = list(dict.fromkeys(executables))
+    results = send_commands([f'which {executable}' for executable in executables], host, username, password,
+                            key_filename, logger, timeout, transport)
+
+    return {executable: (stdout.strip() or None) if exit_code == 0 else None
+            for executable, (stdout, _, exit_code) in zip(executables, results)}
+
+
 def remote_os_type_windows(host='127.0.0.1'):
     """
     This function will look to see which ports are accepting connections and make a decision based on that. For
@@ -116,22 +888,26 @@ class SystemConnection(object):
     """
     This baseclass will be used whenever a process needs to connect to a remote system. It verifies that the right
     connection parameters are passed and uses an instance of LogQueue to pass messages to the master logger.
+
+    Commands for a local host (see is_local_host) run through a LocalTransport and don't need credentials.
     """
 
-    def __init__(self, host=None, username=None, password=None, key_filename=None, *args, **kwargs):
+    def __init__(self, host=None, username=None, password=None, key_filename=None, transport='auto', *args,
+                 **kwargs):
         super().__init__()
 
+        local = transport == 'local' or (transport == 'auto' and host is not None and is_local_host(host, username))
         if hasattr(self, 'required_kwargs'):
             # We may have this defined in a subclass before super.__init__ is called
-            self.required_kwargs += [host, username]
+            self.required_kwargs += [host] if local else [host, username]
         else:
-            self.required_kwargs = [host, username]
+            self.required_kwargs = [host] if local else [host, username]
 
         for kw in self.required_kwargs:
             if kw is None:
                 raise Exception(f'Key word {kw} is required')
 
-        if not (password or key_filename):
+        if not (password or key_filename or local):
             raise Exception(f'Please provide either a password or key filename')
 
         self.host = host
@@ -141,5 +917,7 @@ class SystemConnection(object):
 
         # Convenience mappings
         self.auth = dict(host=self.host, username=self.username, password=self.password, key_filename=self.key_filename)
-        self.send_command = functools.partial(
-            send_ssh_command, host=host, username=username, password=password, key_filename=key_filename)
+        self.transport = get_transport(transport='local' if local else 'ssh', **self.auth)
+        self.send_command = self.transport.send_command
+        self.send_commands = self.transport.send_commands
+        self.stream_command = self.transport.stream
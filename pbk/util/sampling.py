@@ -0,0 +1,419 @@
+import shlex
+import threading
+import collections
+
+from pbk.util.remote import get_transport, is_local_host
+from pbk.util.timeseries import TimeSeries
+from pbk.util.data_capture import DataCapture
+
+SAMPLE_MARKER = 'PBK-SAMPLE'
+FILE_MARKER = 'PBK-FILE'
+END_MARKER = 'PBK-END'
+PID_MARKER = 'PBK-PID'
+
+CPU_FIELDS = ('user', 'nice', 'system', 'idle', 'iowait', 'irq', 'softirq', 'steal')
+DISKSTAT_FIELDS = ('reads', 'reads_merged', 'sectors_read', 'read_ms', 'writes', 'writes_merged', 'sectors_written',
+                   'write_ms', 'in_flight', 'io_ms', 'weighted_io_ms')
+NET_DEV_FIELDS = ('rx_bytes', 'rx_packets', 'rx_errors', 'rx_drops', 'tx_bytes', 'tx_packets', 'tx_errors',
+                  'tx_drops')
+SECTOR_SIZE = 512
+
+
+def parse_proc_stat(content):
+    """
+    :return: dict(cpu={name: [CPU_FIELDS in jiffies]}, context_switches, interrupts, procs_running, procs_blocked)
+    """
+    stat = dict(cpu={})
+    for line in content.splitlines():
+        fields = line.split()
+        if not fields:
+            continue
+        if fields[0].startswith('cpu'):
+            values = [int(value) for value in fields[1:1 + len(CPU_FIELDS)]]
+            stat['cpu'][fields[0]] = values + [0] * (len(CPU_FIELDS) - len(values))
+        elif fields[0] == 'ctxt':
+            stat['context_switches'] = int(fields[1])
+        elif fields[0] == 'intr':
+            stat['interrupts'] = int(fields[1])
+        elif fields[0] in ('procs_running', 'procs_blocked'):
+            stat[fields[0]] = int(fields[1])
+    return stat
+
+
+def parse_diskstats(content):
+    """
+    :return: {device: [DISKSTAT_FIELDS]}
+    """
+    disks = {}
+    for line in content.splitlines():
+        fields = line.split()
+        if len(fields) >= 3 + len(DISKSTAT_FIELDS):
+            disks[fields[2]] = [int(value) for value in fields[3:3 + len(DISKSTAT_FIELDS)]]
+    return disks
+
+
+def parse_meminfo(content):
+    """
+    :return: {field: value}, values are in kB except for the page counts (e.g. HugePages_Total)
+    """
+    memory = {}
+    for line in content.splitlines():
+        name, _, value = line.partition(':')
+        if value.split():
+            memory[name.strip()] = int(value.split()[0])
+    return memory
+
+
+def parse_net_dev(content):
+    """
+    :return: {interface: [NET_DEV_FIELDS]}
+    """
+    interfaces = {}
+    for line in content.splitlines():
+        name, separator, values = line.partition(':')
+        fields = values.split()
+        if not separator or len(fields) < 16:
+            continue
+        interfaces[name.strip()] = [int(fields[index]) for index in (0, 1, 2, 3, 8, 9, 10, 11)]
+    return interfaces
+
+
+def parse_interrupts(content):
+    """
+    :return: {irq: count summed over all CPUs}
+    """
+    lines = content.splitlines()
+    if not lines:
+        return {}
+    cpu_count = len(lines[0].split())
+    interrupts = {}
+    for line in lines[1:]:
+        name, separator, values = line.partition(':')
+        if not separator:
+            continue
+        counts = []
+        for value in values.split()[:cpu_count]:
+            if not value.isdigit():
+                break
+            counts.append(int(value))
+        if counts:
+            interrupts[name.strip()] = sum(counts)
+    return interrupts
+
+
+SOURCES = collections.OrderedDict([
+    ('/proc/stat', parse_proc_stat),
+    ('/proc/diskstats', parse_diskstats),
+    ('/proc/meminfo', parse_meminfo),
+    ('/proc/net/dev', parse_net_dev),
+    ('/proc/interrupts', parse_interrupts),
+])
+
+
+def build_sampling_script(interval=1.0, sources=tuple(SOURCES)):
+    """
+    Shell script that prints its pid and then a sample of every source each interval until it gets SIGTERM, when it
+      prints one last sample and exits. Each sample is framed as:
+
+        PBK-SAMPLE <microseconds since the epoch>
+        PBK-FILE <path>
+        <content of path>
+        ...
+        PBK-END
+
+    The sleep runs in the background so the trap fires as soon as the signal arrives.
+    """
+    files = ' '.join(shlex.quote(source) for source in sources)
+    script = (f'sample() {{ echo "{SAMPLE_MARKER} $(date +%s%6N)"; '
+              f'for f in {files}; do echo "{FILE_MARKER} $f"; cat "$f"; done; echo {END_MARKER}; }}\n'
+              f'trap \'sample; exit 0\' TERM\n'
+              f'echo "{PID_MARKER} $$"\n'
+              f'while :; do sample; sleep {interval} & wait $!; done')
+    return f'sh -c {shlex.quote(script)}'
+
+
+class SampleParser(object):
+
+    def __init__(self, sources=SOURCES):
+        """
+        Incremental parser of the output of build_sampling_script. Lines are fed one at a time and complete samples
+          are returned as dict(timestamp_us=int, <path>=parsed content). A sample that is cut short (the script was
+          signalled while printing it) is dropped.
+        """
+        self.sources = sources
+        self.pid = None
+        self._sample = None
+        self._path = None
+        self._lines = []
+
+    def _close_file(self):
+        if self._path is not None and self._path in self.sources:
+            self._sample[self._path] = self.sources[self._path](''.join(self._lines))
+        self._path = None
+        self._lines = []
+
+    def feed(self, line):
+        """
+        :return: a complete sample or None
+        """
+        if line.startswith(SAMPLE_MARKER):
+            self._sample = dict(timestamp_us=int(line.split()[1]))
+            self._path = None
+            self._lines = []
+        elif self._sample is None:
+            if line.startswith(PID_MARKER):
+                self.pid = int(line.split()[1])
+        elif line.startswith(FILE_MARKER):
+            self._close_file()
+            self._path = line.split(maxsplit=1)[1].strip()
+        elif line.rstrip('\n') == END_MARKER:
+            self._close_file()
+            sample, self._sample = self._sample, None
+            return sample
+        else:
+            self._lines.append(line)
+        return None
+
+
+def _rate(current, previous, seconds, scale=1):
+    if current is None or previous is None or current < previous or seconds <= 0:
+        # A counter that is missing on one side or went backwards (reset or wrap) has no rate for this interval
+        return None
+    return (current - previous) * scale / seconds
+
+
+def _series(names, intervals):
+    return {name: [None] * intervals for name in names}
+
+
+def compute_deltas(samples):
+    """
+    Turn consecutive samples into per interval rates and utilizations. Gauges (memory, running processes) take the
+      value at the end of each interval. Devices, interfaces and IRQs that only exist in some samples get None for
+      the intervals they are missing from.
+
+    :param samples: list of samples from SampleParser in time order
+    :return: dict(timestamp_us=[end of each interval], interval_s=[...], cpu={cpu: {<field>_pct: [...],
+      busy_pct: [...]}}, system={...}, disk={device: {...}}, memory={field: [...]}, net={interface: {...}},
+      interrupts={irq: [per second]})
+    """
+    intervals = max(0, len(samples) - 1)
+    system = _series(('context_switches_per_s', 'interrupts_per_s', 'procs_running', 'procs_blocked'), intervals)
+    deltas = dict(timestamp_us=[], interval_s=[], cpu={}, system=system, disk={}, memory={}, net={}, interrupts={})
+
+    for position, (previous, current) in enumerate(zip(samples, samples[1:])):
+        seconds = (current['timestamp_us'] - previous['timestamp_us']) / 1e6
+        deltas['timestamp_us'].append(current['timestamp_us'])
+        deltas['interval_s'].append(seconds)
+
+        stat, previous_stat = current.get('/proc/stat', {}), previous.get('/proc/stat', {})
+        for cpu, jiffies in stat.get('cpu', {}).items():
+            before = previous_stat.get('cpu', {}).get(cpu)
+            if before is None:
+                continue
+            used = [after - prior for after, prior in zip(jiffies, before)]
+            total = sum(used)
+            series = deltas['cpu'].setdefault(cpu, _series([f'{field}_pct' for field in CPU_FIELDS] + ['busy_pct'],
+                                                           intervals))
+            if total <= 0:
+                continue
+            for field, value in zip(CPU_FIELDS, used):
+                series[f'{field}_pct'][position] = 100 * value / total
+            idle = used[CPU_FIELDS.index('idle')] + used[CPU_FIELDS.index('iowait')]
+            series['busy_pct'][position] = 100 * (total - idle) / total
+
+        system['context_switches_per_s'][position] = _rate(stat.get('context_switches'),
+                                                           previous_stat.get('context_switches'), seconds)
+        system['interrupts_per_s'][position] = _rate(stat.get('interrupts'), previous_stat.get('interrupts'),
+                                                     seconds)
+        system['procs_running'][position] = stat.get('procs_running')
+        system['procs_blocked'][position] = stat.get('procs_blocked')
+
+        disks, previous_disks = current.get('/proc/diskstats', {}), previous.get('/proc/diskstats', {})
+        for device, after in disks.items():
+            before = previous_disks.get(device)
+            if before is None:
+                continue
+            counters = dict(zip(DISKSTAT_FIELDS, after))
+            prior = dict(zip(DISKSTAT_FIELDS, before))
+            series = deltas['disk'].setdefault(device, _series(
+                ('read_iops', 'write_iops', 'read_bytes_per_s', 'write_bytes_per_s', 'utilization_pct', 'in_flight'),
+                intervals))
+            series['read_iops'][position] = _rate(counters['reads'], prior['reads'], seconds)
+            series['write_iops'][position] = _rate(counters['writes'], prior['writes'], seconds)
+            series['read_bytes_per_s'][position] = _rate(counters['sectors_read'], prior['sectors_read'], seconds,
+                                                         SECTOR_SIZE)
+            series['write_bytes_per_s'][position] = _rate(counters['sectors_written'], prior['sectors_written'],
+                                                          seconds, SECTOR_SIZE)
+            # io_ms counts the milliseconds the device had requests in flight
+            series['utilization_pct'][position] = _rate(counters['io_ms'], prior['io_ms'], seconds, 0.1)
+            series['in_flight'][position] = counters['in_flight']
+
+        for field, value in current.get('/proc/meminfo', {}).items():
+            deltas['memory'].setdefault(field, [None] * intervals)[position] = value
+
+        interfaces, previous_interfaces = current.get('/proc/net/dev', {}), previous.get('/proc/net/dev', {})
+        for interface, after in interfaces.items():
+            before = previous_interfaces.get(interface)
+            if before is None:
+                continue
+            series = deltas['net'].setdefault(interface, _series([f'{field}_per_s' for field in NET_DEV_FIELDS],
+                                                                 intervals))
+            for field, value, prior in zip(NET_DEV_FIELDS, after, before):
+                series[f'{field}_per_s'][position] = _rate(value, prior, seconds)
+
+        interrupts, previous_interrupts = current.get('/proc/interrupts', {}), previous.get('/proc/interrupts', {})
+        for irq, count in interrupts.items():
+            rate = _rate(count, previous_interrupts.get(irq), seconds)
+            if rate is not None:
+                deltas['interrupts'].setdefault(irq, [None] * intervals)[position] = rate
+
+    return deltas
+
+
+def raw_counters(samples):
+    """
+    The counters of every sample after the first, aligned with the intervals of compute_deltas. Devices,
+      interfaces and IRQs get None for the samples they are missing from.
+
+    :param samples: list of samples from SampleParser in time order
+    :return: dict(cpu={cpu: {<field>_jiffies: [...]}}, system={context_switches: [...], interrupts: [...]},
+      disk={device: {field: [...]}}, net={interface: {field: [...]}}, interrupt_counts={irq: [...]})
+    """
+    intervals = max(0, len(samples) - 1)
+    counters = dict(cpu={}, system=_series(('context_switches', 'interrupts'), intervals), disk={}, net={},
+                    interrupt_counts={})
+    disk_fields = [field for field in DISKSTAT_FIELDS if field != 'in_flight']
+
+    for position, current in enumerate(samples[1:]):
+        stat = current.get('/proc/stat', {})
+        for cpu, jiffies in stat.get('cpu', {}).items():
+            series = counters['cpu'].setdefault(cpu, _series([f'{field}_jiffies' for field in CPU_FIELDS], intervals))
+            for field, value in zip(CPU_FIELDS, jiffies):
+                series[f'{field}_jiffies'][position] = value
+        counters['system']['context_switches'][position] = stat.get('context_switches')
+        counters['system']['interrupts'][position] = stat.get('interrupts')
+
+        for device, values in current.get('/proc/diskstats', {}).items():
+            series = counters['disk'].setdefault(device, _series(disk_fields, intervals))
+            for field, value in zip(DISKSTAT_FIELDS, values):
+                if field in series:
+                    series[field][position] = value
+
+        for interface, values in current.get('/proc/net/dev', {}).items():
+            series = counters['net'].setdefault(interface, _series(NET_DEV_FIELDS, intervals))
+            for field, value in zip(NET_DEV_FIELDS, values):
+                series[field][position] = value
+
+        for irq, count in current.get('/proc/interrupts', {}).items():
+            counters['interrupt_counts'].setdefault(irq, [None] * intervals)[position] = count
+
+    return counters
+
+
+class ProcSamplingCapture(DataCapture):
+
+    def __init__(self, host=None, username=None, password=None, key_filename=None, transport='auto', interval=1.0,
+                 sources=tuple(SOURCES), buffer_size=86400, timeout=None, columnar=False, *args, **kwargs):
+        """
+        Samples /proc counters of a host at a fixed interval between start() and stop().
+
+        A single long lived command on the host prints every source each interval with a microsecond timestamp, so
+          sampling costs no new SSH sessions. A thread parses the stream into a ring buffer of the last buffer_size
+          samples. Rates and utilizations are computed here (see compute_deltas) from the raw counters and the
+          timestamps, so an interval that ran long is still measured correctly. stop() signals the sampler, which
+          takes one last sample so the final interval ends at the stop.
+
+        Requires GNU date (for %N) on the host.
+
+        :param host:
+        :param username:
+        :param password:
+        :param key_filename:
+        :param transport: 'auto', 'ssh' or 'local'
+        :param interval: seconds between samples
+        :param sources: files to sample, keys of SOURCES
+        :param buffer_size: samples kept, the oldest are dropped first
+        :param timeout: seconds without output before the stream is considered hung. Defaults to 10 intervals.
+        :param columnar: return a TimeSeries under 'series' instead of nested lists. It holds the rates as gauges
+          and the raw counters (see raw_counters) as counter columns, which are delta encoded when stored.
+        :param args:
+        :param kwargs:
+        """
+        super().__init__(*args, **kwargs)
+        unknown = [source for source in sources if source not in SOURCES]
+        if unknown:
+            raise ValueError(f'Unknown sources: {unknown}. Available sources: {list(SOURCES)}')
+
+        local = transport == 'local' or (transport == 'auto' and is_local_host(host, username))
+        if key_filename is None and password is None and not local:
+            raise Exception('ProcSamplingCapture requires a password or SSH key file')
+
+        self.auth = dict(host=host, username=username, password=password, key_filename=key_filename)
+        self.transport_name = transport
+        self.interval = interval
+        self.sources = collections.OrderedDict((source, SOURCES[source]) for source in sources)
+        self.timeout = timeout if timeout is not None else max(10 * interval, 10)
+        self.columnar = columnar
+
+        self.transport = None
+        self.samples = collections.deque(maxlen=buffer_size)
+        self.sample_count = 0
+        self.parser = None
+        self.error = None
+        self._pid_ready = threading.Event()
+        self._reader = None
+
+    def setup(self):
+        self.transport = get_transport(transport=self.transport_name, **self.auth)
+
+    def _read(self, command_stream):
+        try:
+            with command_stream:
+                for stream_name, line in command_stream:
+                    if stream_name == 'stderr':
+                        self.logger.warning(f'Sampler on {self.auth["host"]}: {line.rstrip()}')
+                        continue
+                    sample = self.parser.feed(line)
+                    if self.parser.pid is not None:
+                        self._pid_ready.set()
+                    if sample is not None:
+                        self.samples.append(sample)
+                        self.sample_count += 1
+        except Exception as e:
+            self.error = f'{type(e).__name__}: {e}'
+            self.logger.error(f'Sampling on {self.auth["host"]} failed: {self.error}')
+        finally:
+            self._pid_ready.set()
+
+    def start(self):
+        self.samples.clear()
+        self.sample_count = 0
+        self.parser = SampleParser(self.sources)
+        self._pid_ready.clear()
+        command_stream = self.transport.stream(build_sampling_script(self.interval, list(self.sources)),
+                                               timeout=self.timeout, mode='lines')
+        self._reader = threading.Thread(target=self._read, args=(command_stream,), daemon=True,
+                                        name=f'pbk-sampler-{self.auth["host"]}')
+        self._reader.start()
+        if not self._pid_ready.wait(self.timeout) or self.parser.pid is None:
+            raise RuntimeError(f'Sampler on {self.auth["host"]} did not start: {self.error}')
+
+    def stop(self):
+        if self._reader is None:
+            return
+        self.transport.send_command(f'kill -TERM {self.parser.pid}', timeout=self.timeout)
+        self._reader.join(self.timeout)
+        if self._reader.is_alive():
+            self.logger.warning(f'Sampler on {self.auth["host"]} did not stop within {self.timeout} seconds')
+        self._reader = None
+
+    @property
+    def data(self):
+        samples = list(self.samples)
+        deltas = compute_deltas(samples)
+        if self.columnar:
+            deltas = dict(series=TimeSeries.from_dict(deltas, counters=raw_counters(samples)))
+        deltas.update(host=self.auth['host'], samples=len(samples), dropped=self.sample_count - len(samples),
+                      error=self.error)
+        return {self.__class__.__name__: deltas}
@@ -0,0 +1,76 @@
+import math
+import bisect
+import statistics
+
+# Two sided critical values of Student's t distribution by degrees of freedom. Values between the listed degrees of
+#   freedom are interpolated linearly in 1/df, which is accurate to a few parts in a thousand.
+T_TABLE_DF = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27,
+              28, 29, 30, 40, 60, 120]
+T_TABLE = {
+    0.90: [6.314, 2.920, 2.353, 2.132, 2.015, 1.943, 1.895, 1.860, 1.833, 1.812, 1.796, 1.782, 1.771, 1.761, 1.753,
+           1.746, 1.740, 1.734, 1.729, 1.725, 1.721, 1.717, 1.714, 1.711, 1.708, 1.706, 1.703, 1.701, 1.699, 1.697,
+           1.684, 1.671, 1.658, 1.645],
+    0.95: [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228, 2.201, 2.179, 2.160, 2.145, 2.131,
+           2.120, 2.110, 2.101, 2.093, 2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042,
+           2.021, 2.000, 1.980, 1.960],
+    0.99: [63.657, 9.925, 5.841, 4.604, 4.032, 3.707, 3.499, 3.355, 3.250, 3.169, 3.106, 3.055, 3.012, 2.977, 2.947,
+           2.921, 2.898, 2.878, 2.861, 2.845, 2.831, 2.819, 2.807, 2.797, 2.787, 2.779, 2.771, 2.763, 2.756, 2.750,
+           2.704, 2.660, 2.617, 2.576],
+}
+CONFIDENCES = tuple(sorted(T_TABLE))
+
+
+def t_critical(df, confidence=0.95):
+    """
+    Two sided critical value of Student's t distribution
+
+    :param df: degrees of freedom, at least 1
+    :param confidence: one of CONFIDENCES
+    :return: float
+    """
+    if confidence not in T_TABLE:
+        raise ValueError(f'Confidence must be one of {CONFIDENCES}, got {confidence}')
+    if df < 1:
+        raise ValueError(f'At least one degree of freedom is required, got {df}')
+
+    values = T_TABLE[confidence]
+    if df >= T_TABLE_DF[-1]:
+        # Between the last table entry and the normal distribution (the final value, df = infinity)
+        upper, normal = values[-2], values[-1]
+        return normal + (upper - normal) * T_TABLE_DF[-1] / df
+
+    position = bisect.bisect_left(T_TABLE_DF, df)
+    if T_TABLE_DF[position] == df:
+        return values[position]
+    low_df, high_df = T_TABLE_DF[position - 1], T_TABLE_DF[position]
+    fraction = (1 / low_df - 1 / df) / (1 / low_df - 1 / high_df)
+    return values[position - 1] + (values[position] - values[position - 1]) * fraction
+
+
+def summarize(samples, confidence=0.95):
+    """
+    Mean, spread and the confidence interval of the mean of a list of samples
+
+    :param samples: list of numbers
+    :param confidence: one of CONFIDENCES
+    :return: dict with count, mean, stdev, variance, ci_low, ci_high, ci_half_width and relative_ci_width. The
+      spread and interval values are None with fewer than 2 samples. relative_ci_width is the full width of the
+      interval divided by the absolute mean.
+    """
+    count = len(samples)
+    summary = dict(count=count, mean=None, stdev=None, variance=None, ci_low=None, ci_high=None,
+                   ci_half_width=None, relative_ci_width=None, confidence=confidence)
+    if count == 0:
+        return summary
+
+    mean = statistics.fmean(samples)
+    summary['mean'] = mean
+    if count < 2:
+        return summary
+
+    variance = statistics.variance(samples, xbar=mean)
+    half_width = t_critical(count - 1, confidence) * math.sqrt(variance / count)
+    summary.update(stdev=math.sqrt(variance), variance=variance, ci_low=mean - half_width,
+                   ci_high=mean + half_width, ci_half_width=half_width,
+                   relative_ci_width=2 * half_width / abs(mean) if mean else (0.0 if not half_width else math.inf))
+    return summary
@@ -1,21 +1,148 @@
 #!/usr/bin/env python3.6
 
+import os
+import re
 import sys
-import functools
+import json
+import time
+import threading
 import multiprocessing
 
 from pbk.util.mp import SystemConnectionProcess
-from pbk.util.remote import send_ssh_command, linux_which
+from pbk.util.remote import get_transport, is_local_host
+from pbk.util.capabilities import DEFAULT_TTL, get_capability_cache
 from pbk.util.perflogger import LoggedObject, get_queued_logger
 from pbk.util.data_capture import DataCapture
 
+# Values that tell whether cached system info is still current, and the command printing them as key=value lines.
+#   partitions is a checksum of /proc/partitions as partition changes don't touch the mtime of /sys/block.
+FINGERPRINT_COMMAND = ('echo "boot_id=$(cat /proc/sys/kernel/random/boot_id 2>/dev/null)"; '
+                       'echo "kernel_release=$(uname -r)"; '
+                       'echo "dmi_mtime=$(stat -c %Y /sys/class/dmi/id 2>/dev/null)"; '
+                       'echo "block_mtime=$(stat -c %Y /sys/block 2>/dev/null)"; '
+                       'echo "partitions=$(cksum < /proc/partitions 2>/dev/null)"')
+FINGERPRINT_KEYS = ('boot_id', 'kernel_release', 'dmi_mtime', 'block_mtime', 'partitions')
+# The fingerprint values each section depends on. A section is only collected again when one of its values changed,
+#   sections that aren't listed depend on every value.
+SECTION_FINGERPRINTS = {
+    'dmidecode': ('boot_id', 'dmi_mtime'),
+    'uname': ('boot_id', 'kernel_release'),
+    'parted': ('boot_id', 'block_mtime', 'partitions'),
+    'lspci': ('boot_id',),
+    'modinfo': ('boot_id', 'kernel_release'),
+}
+
+
+def get_fingerprint(transport, timeout=60):
+    """
+    :return: dict of FINGERPRINT_KEYS to strings. Values the host can't provide are empty.
+    """
+    stdout, _ = transport.send_command(FINGERPRINT_COMMAND, timeout=timeout)
+    values = dict(line.split('=', 1) for line in stdout.splitlines() if '=' in line)
+    return {key: values.get(key, '').strip() for key in FINGERPRINT_KEYS}
+
+
+class SystemInfoCache(object):
+
+    def __init__(self, cache_dir):
+        """
+        On disk cache of SystemInfo sections, one JSON file per host. Each section is stored with the fingerprint
+          values it depends on (SECTION_FINGERPRINTS) and is valid as long as those values are unchanged. A reboot
+          invalidates everything, a new disk only parted. A section that depends on a value the host can't provide
+          (e.g. no /sys/class/dmi) is never cached, an empty value would match forever.
+
+        :param cache_dir: directory of the cache files, created if needed
+        """
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __repr__(self):
+        return f'SystemInfoCache({self.cache_dir!r})'
+
+    def _path(self, host_key):
+        return os.path.join(self.cache_dir, re.sub(r'[^A-Za-z0-9_.-]', '_', host_key) + '.json')
+
+    def load(self, host_key):
+        """
+        :return: {section: dict(fingerprint, collected_at, data)}
+        """
+        try:
+            with open(self._path(host_key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, host_key, sections):
+        path = self._path(host_key)
+        temporary = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(sections, f)
+        os.replace(temporary, path)
+
+    @staticmethod
+    def section_fingerprint(section, fingerprint):
+        """
+        :return: the fingerprint values the section depends on, None if any of them is empty and the section can't
+          be cached
+        """
+        values = {key: fingerprint.get(key, '') for key in SECTION_FINGERPRINTS.get(section, FINGERPRINT_KEYS)}
+        return values if all(values.values()) else None
+
+    def valid_sections(self, host_key, fingerprint):
+        """
+        :return: {section: data} of the cached sections that match the fingerprint
+        """
+        valid = {}
+        for section, entry in self.load(host_key).items():
+            section_fingerprint = self.section_fingerprint(section, fingerprint)
+            if section_fingerprint is not None and entry['fingerprint'] == section_fingerprint:
+                valid[section] = entry['data']
+        return valid
+
+    def store(self, host_key, fingerprint, sections):
+        """
+        :param sections: {section: data} collected while the host had this fingerprint. Sections that can't be
+          cached are dropped from the cache instead.
+        """
+        cached = self.load(host_key)
+        now = time.time()
+        for section, data in sections.items():
+            section_fingerprint = self.section_fingerprint(section, fingerprint)
+            if section_fingerprint is None:
+                cached.pop(section, None)
+            else:
+                cached[section] = dict(fingerprint=section_fingerprint, collected_at=now, data=data)
+        self._write(host_key, cached)
+
+    def invalidate(self, host_key, sections=None):
+        """
+        Drop some sections of a host, or all of them
+        """
+        if sections is None:
+            cached = {}
+        else:
+            cached = {section: entry for section, entry in self.load(host_key).items() if section not in sections}
+        self._write(host_key, cached)
+
 
 class SystemInfo(LoggedObject):
 
-    def __init__(self, host, username, password=None, key_filename=None, auto_get=False, *args, **kwargs):
+    def __init__(self, host, username, password=None, key_filename=None, auto_get=False, transport='auto',
+                 runner='process', capability_cache_file=None, capability_ttl=DEFAULT_TTL, cache_dir=None, *args,
+                 **kwargs):
         """
         This class will connect to a system (currently linux only) and run various system tools
-        to get system information.
+        to get system information. Local hosts are queried without SSH unless transport='ssh' is given.
+
+        The getters run in a process each by default. With runner='thread' they run as threads instead, which is
+        cheaper when the work is waiting on remote commands and is required when running inside a daemonic process.
+
+        The prerequisites of all getters are probed in one command and kept in a per host capability cache (see
+        pbk.util.capabilities). Getters with a missing prerequisite are skipped. Give a capability_cache_file to
+        share the cache between processes, e.g. the capture processes of a DataCaptureManager.
+
+        With a cache_dir the collected sections are kept on disk (see SystemInfoCache). get_all() then first reads a
+        cheap fingerprint of the host and only runs the getters whose sections changed since they were cached.
 
         The auto_get flag is enabled by following specific conventions for method nameing:
             Methods should be named like "get_<linux tool name>"
@@ -27,54 +154,103 @@ class SystemInfo(LoggedObject):
         :param password:
         :param key_filename:
         :param auto_get:
+        :param transport: 'auto', 'ssh' or 'local'
+        :param runner: 'process' or 'thread'
+        :param capability_cache_file: JSON file of the capability cache, None keeps it in memory
+        :param capability_ttl: seconds before a cached prerequisite is probed again
+        :param cache_dir: directory of the SystemInfoCache, None collects everything every time
         :param args:
         :param kwargs:
         """
         super().__init__(*args, **kwargs)
+        if runner not in ('process', 'thread'):
+            raise ValueError(f'Runner must be "process" or "thread", not: {runner}')
+        self.runner = runner
         self.system_info = {}
         self.auth = dict(host=host, username=username, password=password, key_filename=key_filename)
-        self.send_command = functools.partial(send_ssh_command, **self.auth)
-
-        self.prerequisites = []
+        self.transport = get_transport(transport=transport, **self.auth)
+        self.send_command = self.transport.send_command
+        self.send_commands = self.transport.send_commands
+        self.info_cache = SystemInfoCache(cache_dir) if cache_dir is not None else None
+        self.host_key = f'{self.transport.name}:{username}@{host}'
+        self.cached_sections = []
+
+        self.capability_cache = get_capability_cache(capability_cache_file, capability_ttl)
         self.get_classes = [v for k, v in sys.modules[__name__].__dict__.items()
                             if k.startswith('Get')
                             and issubclass(v, GetInfo)
                             and k != 'GetInfo']
 
+        self.prerequisites = []
         for cls in self.get_classes:
             self.prerequisites.extend(cls.prerequisites)
 
         self.logger.verboser(f'System info prerequisites: {self.prerequisites}')
-        for prereq in self.prerequisites:
-            if linux_which(prereq, host, username, password, key_filename) is None:
-                self.logger.warning(f'Prerequisite "{prereq}" is not met')
+        self.capabilities = self.capability_cache.lookup(self.transport, self.prerequisites)
+        self.skipped_classes = []
+        for cls in list(self.get_classes):
+            missing = [prereq for prereq in cls.prerequisites if self.capabilities.get(prereq) is None]
+            if missing:
+                self.logger.warning(f'Skipping {cls.__name__} on host {host}, prerequisites not met: {missing}')
+                self.get_classes.remove(cls)
+                self.skipped_classes.append(cls)
 
         if auto_get:
             self.get_all()
 
     def get_all(self):
         self.logger.status(f'Getting System Info data from all configured sources on host {self.auth["host"]}')
+        get_classes = self.get_classes
+        fingerprint = None
+        self.cached_sections = []
+        if self.info_cache is not None:
+            fingerprint = get_fingerprint(self.transport)
+            cached = self.info_cache.valid_sections(self.host_key, fingerprint)
+            get_classes = [cls for cls in self.get_classes if cls.section not in cached]
+            self.cached_sections = [cls.section for cls in self.get_classes if cls.section in cached]
+            self.system_info.update({section: cached[section] for section in self.cached_sections})
+            self.logger.verbose(f'Using cached sections {self.cached_sections} for host {self.auth["host"]}')
+
         process_pool = []
         data_queue = multiprocessing.Queue()
-        for cls in self.get_classes:
-            process_pool.append(cls(data_queue, **self.auth, log_queue=self.log_queue))
+        for cls in get_classes:
+            process_pool.append(cls(data_queue, **self.auth, transport=self.transport.name, log_queue=self.log_queue))
+
+        if self.runner == 'thread':
+            # The getters are only used for their run() method, no process is started
+            process_pool = [threading.Thread(target=p.run, name=p.name, daemon=True) for p in process_pool]
 
         for p in process_pool:
             p.daemon = True
             p.start()
-            self.logger.verboser(f'Started SysInfo getter process: {p.name}')
+            self.logger.verboser(f'Started SysInfo getter {self.runner}: {p.name}')
 
         self.logger.verboser('Joining SysInfo getter processes')
         [p.join() for p in process_pool]
-        for i in range(len(self.get_classes)):
-            self.system_info.update(data_queue.get())
+        collected = {}
+        for i in range(len(process_pool)):
+            collected.update(data_queue.get())
+        self.system_info.update(collected)
+
+        if self.info_cache is not None:
+            # Sections that failed to collect are not cached so the next call tries again
+            self.info_cache.store(self.host_key, fingerprint,
+                                  {section: data for section, data in collected.items() if data is not None})
 
         self.logger.verbose('Getting all SysInfo is complete')
 
+    def invalidate_cache(self, sections=None):
+        """
+        Force some sections, or all of them, to be collected again on the next get_all()
+        """
+        if self.info_cache is not None:
+            self.info_cache.invalidate(self.host_key, sections)
+
 
 class SystemInfoCapture(DataCapture):
 
-    def __init__(self, host=None, username=None, password=None, key_filename=None, *args, **kwargs):
+    def __init__(self, host=None, username=None, password=None, key_filename=None, transport='auto',
+                 runner='process', *args, **kwargs):
         """
         SystemInfoCapture is slightly different than most DataCapture classes. It will capture data at start
         but stop() doesn't do anything. We don't check differences between start and stop because it doesn't
@@ -84,6 +260,8 @@ class SystemInfoCapture(DataCapture):
         :param username:
         :param password:
         :param key_filename:
+        :param transport: 'auto', 'ssh' or 'local'
+        :param runner: how SystemInfo runs its getters, 'process' or 'thread'
         :param args:
         :param kwargs:
         """
@@ -92,8 +270,11 @@ class SystemInfoCapture(DataCapture):
         self.username = username
         self.password = password
         self.key_filename = key_filename
+        self.transport = transport
+        self.runner = runner
 
-        if key_filename is None and password is None:
+        local = transport == 'local' or (transport == 'auto' and is_local_host(host, username))
+        if key_filename is None and password is None and not local:
             raise Exception('SystemInfo requires a password or SSH key file')
 
         self.si = None
@@ -105,7 +286,8 @@ class SystemInfoCapture(DataCapture):
         Setup here is just initializing the SystemInfo instance
         :return:
         """
-        self.si = SystemInfo(self.host, self.username, self.password, self.key_filename, *self.args, **self.kwargs)
+        self.si = SystemInfo(self.host, self.username, self.password, self.key_filename, transport=self.transport,
+                             runner=self.runner, *self.args, **self.kwargs)
         self.logger.debug(f'Made instance of SI with args: {self.args} and kwargs: {self.kwargs}')
 
     def start(self):
@@ -114,6 +296,8 @@ class SystemInfoCapture(DataCapture):
 
 
 class GetInfo(SystemConnectionProcess):
+    # Key of the getter's result in SystemInfo.system_info and in the SystemInfoCache
+    section = None
 
     def __init__(self, result_queue=None, *args, **kwargs):
         self.required_kwargs = [result_queue]
@@ -122,6 +306,7 @@ class GetInfo(SystemConnectionProcess):
 
 
 class GetDmidecode(GetInfo):
+    section = 'dmidecode'
     prerequisites = ['dmidecode']
 
     def run(self):
@@ -143,6 +328,7 @@ class GetDmidecode(GetInfo):
 
 
 class GetModinfo(GetInfo):
+    section = 'modinfo'
     prerequisites = ['modprobe', 'modinfo']
 
     def run(self):
@@ -152,6 +338,7 @@ class GetModinfo(GetInfo):
 
 
 class GetLspci(GetInfo):
+    section = 'lspci'
     prerequisites = ['lspci']
 
     def run(self):
@@ -161,6 +348,7 @@ class GetLspci(GetInfo):
 
 
 class GetUname(GetInfo):
+    section = 'uname'
     prerequisites = ['uname']
 
     def run(self):
@@ -180,8 +368,8 @@ class GetUname(GetInfo):
                            m='machine', p='processor', i='hardware-platform', o='operating-system')
         uname_result = {}
 
-        for flag, name in uname_flags.items():
-            stdout, _ = self.send_command(f'uname -{flag}')
+        results = self.send_commands([f'uname -{flag}' for flag in uname_flags])
+        for name, (stdout, _, _) in zip(uname_flags.values(), results):
             uname_result[name] = stdout.strip()
 
         self.result_queue.put({'uname': uname_result})
@@ -189,6 +377,7 @@ class GetUname(GetInfo):
 
 
 class GetParted(GetInfo):
+    section = 'parted'
     prerequisites = ['parted']
 
     def run(self):
@@ -0,0 +1,476 @@
+import os
+import json
+import shutil
+
+import numpy as np
+
+KINDS = ('gauge', 'counter')
+ENCODINGS = ('delta', 'raw')
+INDEX_FILE = 'index.json'
+# Delta order of the timestamps (delta-of-delta) and of counters when encoded
+TIMESTAMP_ORDER = 2
+COUNTER_ORDER = 1
+
+
+def delta_encode(values, order=1):
+    """
+    Delta encode an integer array. order=1 keeps the first value followed by the differences, order=2
+      (delta-of-delta) also keeps the first difference followed by the differences of the differences. Regular
+      timestamps and steadily increasing counters become runs of small numbers.
+
+    :return: int64 array
+    """
+    encoded = np.array(values, dtype=np.int64)
+    for start in range(order):
+        encoded[start + 1:] = np.diff(encoded[start:])
+    return encoded
+
+
+def delta_decode(encoded, order=1):
+    """
+    Inverse of delta_encode
+    """
+    values = np.array(encoded, dtype=np.int64)
+    for start in reversed(range(order)):
+        np.cumsum(values[start:], out=values[start:])
+    return values
+
+
+def smallest_int_dtype(values):
+    """
+    The smallest signed integer dtype that holds every value of an array
+    """
+    if len(values) == 0:
+        return np.dtype(np.int8)
+    low, high = int(values.min()), int(values.max())
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def encode_column(values, order=1):
+    """
+    Delta encode an integer column for storage. The first order values of the encoding are absolute (an epoch
+      timestamp, a counter reading) and would force 64 bits on the whole array, so they are returned apart as the
+      bases and only the deltas after them are sized with smallest_int_dtype.
+
+    :return: (array of deltas, list of base values)
+    """
+    encoded = delta_encode(values, order=order)
+    deltas = encoded[order:]
+    return deltas.astype(smallest_int_dtype(deltas)), encoded[:order].tolist()
+
+
+def decode_column(deltas, bases, order=1):
+    """
+    Inverse of encode_column
+
+    :return: int64 array
+    """
+    return delta_decode(np.concatenate([np.asarray(bases, dtype=np.int64), np.asarray(deltas, dtype=np.int64)]),
+                        order=order)
+
+
+class TimeSeries(object):
+
+    def __init__(self, kinds=None, capacity=1024):
+        """
+        Column oriented time series: one int64 array of timestamps (microseconds since the epoch) and one array per
+          column, grown by doubling as rows are appended.
+
+        Columns are gauges or counters. Gauges are float64 with NaN for missing values and are averaged when
+          downsampling. Counters are int64, a missing value repeats the previous one (the counter didn't move) and
+          downsampling keeps the last value of each window. Counters and timestamps are delta encoded when stored.
+
+        :param kinds: {column: 'gauge' or 'counter'}. Columns that first appear in append() are gauges.
+        :param capacity: initial number of rows
+        """
+        self.capacity = max(1, capacity)
+        self.length = 0
+        self.kinds = {}
+        self._timestamps = np.zeros(self.capacity, dtype=np.int64)
+        self._columns = {}
+        for name, kind in (kinds or {}).items():
+            self.add_column(name, kind)
+
+    def __repr__(self):
+        return f'TimeSeries(rows={len(self)}, columns={len(self._columns)})'
+
+    def __len__(self):
+        return self.length
+
+    def __contains__(self, name):
+        return name in self._columns
+
+    def __getitem__(self, name):
+        return self.column(name)
+
+    @property
+    def names(self):
+        return list(self._columns)
+
+    @property
+    def timestamps(self):
+        return self._timestamps[:self.length]
+
+    def column(self, name):
+        return self._columns[name][:self.length]
+
+    @property
+    def nbytes(self):
+        return self.timestamps.nbytes + sum(self.column(name).nbytes for name in self.names)
+
+    def add_column(self, name, kind='gauge', values=None):
+        """
+        Add a column. Rows before it existed are NaN for a gauge and 0 for a counter unless values are given.
+        """
+        if kind not in KINDS:
+            raise ValueError(f'Kind must be one of {KINDS}, got {kind}')
+        if name in self._columns:
+            raise ValueError(f'Column "{name}" already exists')
+        if kind == 'gauge':
+            column = np.full(self.capacity, np.nan, dtype=np.float64)
+        else:
+            column = np.zeros(self.capacity, dtype=np.int64)
+        if values is not None:
+            column[:self.length] = values
+        self.kinds[name] = kind
+        self._columns[name] = column
+
+    def _grow(self, rows):
+        if rows <= self.capacity:
+            return
+        capacity = max(rows, 2 * self.capacity)
+        self._timestamps = np.resize(self._timestamps, capacity)
+        for name, column in self._columns.items():
+            grown = np.full(capacity, np.nan if self.kinds[name] == 'gauge' else 0, dtype=column.dtype)
+            grown[:self.length] = column[:self.length]
+            self._columns[name] = grown
+        self.capacity = capacity
+
+    def append(self, timestamp_us, values):
+        """
+        Add a row
+
+        :param timestamp_us: microseconds since the epoch, not before the previous row
+        :param values: {column: value}
+        """
+        if self.length and timestamp_us < self._timestamps[self.length - 1]:
+            raise ValueError(f'Timestamp {timestamp_us} is before the last row at {self.timestamps[-1]}')
+        self._grow(self.length + 1)
+        row = self.length
+        self._timestamps[row] = timestamp_us
+        for name, value in values.items():
+            if name not in self._columns:
+                self.add_column(name)
+            self._columns[name][row] = np.nan if value is None and self.kinds[name] == 'gauge' else value
+        for name, column in self._columns.items():
+            if self.kinds[name] == 'counter' and name not in values and row:
+                column[row] = column[row - 1]
+        self.length += 1
+
+    @classmethod
+    def from_arrays(cls, timestamps, columns, kinds=None):
+        """
+        :param timestamps: array of microseconds since the epoch
+        :param columns: {column: array}
+        :param kinds: {column: kind}, gauge by default
+        """
+        kinds = kinds or {}
+        series = cls(capacity=len(timestamps))
+        series._timestamps[:len(timestamps)] = timestamps
+        series.length = len(timestamps)
+        for name, values in columns.items():
+            series.add_column(name, kinds.get(name, 'gauge'), values)
+        return series
+
+    @classmethod
+    def from_dict(cls, data, timestamp_key='timestamp_us', separator='/', counters=None):
+        """
+        Build a series from nested dicts of equal length lists, like the rates of ProcSamplingCapture. Nested keys
+          are joined with separator, e.g. cpu/cpu0/busy_pct. Values that aren't lists of the length of the
+          timestamps are ignored.
+
+        :param data: the gauge columns and the timestamps. None becomes NaN.
+        :param counters: nested dicts of counter columns in the same form, without timestamps. None repeats the
+          previous value, or is 0 before the first one.
+        """
+        timestamps = data[timestamp_key]
+        columns = {}
+        kinds = {}
+
+        def flatten(prefix, value, kind):
+            if isinstance(value, dict):
+                for key, item in value.items():
+                    flatten(f'{prefix}{separator}{key}' if prefix else str(key), item, kind)
+            elif isinstance(value, list) and len(value) == len(timestamps) and prefix != timestamp_key:
+                if prefix in columns:
+                    raise ValueError(f'Column "{prefix}" is both a gauge and a counter')
+                kinds[prefix] = kind
+                if kind == 'gauge':
+                    columns[prefix] = np.array([np.nan if item is None else item for item in value], dtype=np.float64)
+                    return
+                column = np.zeros(len(value), dtype=np.int64)
+                for row, item in enumerate(value):
+                    column[row] = item if item is not None else (column[row - 1] if row else 0)
+                columns[prefix] = column
+
+        flatten('', data, 'gauge')
+        flatten('', counters or {}, 'counter')
+        return cls.from_arrays(np.asarray(timestamps, dtype=np.int64), columns, kinds)
+
+    def to_dict(self):
+        """
+        JSON serializable form, NaN becomes None
+        """
+        columns = {}
+        for name in self.names:
+            column = self.column(name)
+            if self.kinds[name] == 'gauge':
+                columns[name] = [None if np.isnan(value) else float(value) for value in column]
+            else:
+                columns[name] = column.tolist()
+        return dict(timestamp_us=self.timestamps.tolist(), kinds=dict(self.kinds), columns=columns)
+
+    def __getstate__(self):
+        # Only the used rows, the spare capacity is not worth pickling
+        return dict(timestamps=self.timestamps.copy(), kinds=dict(self.kinds),
+                    columns={name: self.column(name).copy() for name in self.names})
+
+    def __setstate__(self, state):
+        restored = self.from_arrays(state['timestamps'], state['columns'], state['kinds'])
+        self.__dict__.update(restored.__dict__)
+
+    def select(self, start_us=None, end_us=None, columns=None):
+        """
+        Rows with start_us <= timestamp < end_us and a subset of the columns
+        """
+        timestamps = self.timestamps
+        low = 0 if start_us is None else np.searchsorted(timestamps, start_us, side='left')
+        high = len(timestamps) if end_us is None else np.searchsorted(timestamps, end_us, side='left')
+        names = self.names if columns is None else columns
+        return self.from_arrays(timestamps[low:high], {name: self.column(name)[low:high] for name in names},
+                                {name: self.kinds[name] for name in names})
+
+    def downsample(self, interval_us):
+        """
+        One row per window of interval_us, windows are aligned to multiples of interval_us. The timestamp of a row is
+          that of the last sample in its window. Gauges are averaged ignoring NaN, counters keep their last value.
+        """
+        if self.length == 0:
+            return self.from_arrays([], {name: [] for name in self.names}, self.kinds)
+
+        windows = self.timestamps // interval_us
+        starts = np.flatnonzero(np.diff(windows, prepend=windows[0] - 1))
+        ends = np.append(starts[1:], self.length) - 1
+        columns = {}
+        for name in self.names:
+            column = self.column(name)
+            if self.kinds[name] == 'counter':
+                columns[name] = column[ends]
+            else:
+                present = ~np.isnan(column)
+                sums = np.add.reduceat(np.where(present, column, 0), starts)
+                counts = np.add.reduceat(present.astype(np.int64), starts)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    columns[name] = np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+        return self.from_arrays(self.timestamps[ends], columns, self.kinds)
+
+    def encode(self):
+        """
+        Compact arrays of this series: timestamps are delta-of-delta encoded and counters delta encoded, see
+          encode_column. Gauges are kept as they are.
+
+        :return: ({'timestamp_us' or column: array}, {'timestamp_us' or counter column: list of base values})
+        """
+        arrays, bases = {}, {}
+        arrays['timestamp_us'], bases['timestamp_us'] = encode_column(self.timestamps, order=TIMESTAMP_ORDER)
+        for name in self.names:
+            if self.kinds[name] == 'counter':
+                arrays[name], bases[name] = encode_column(self.column(name), order=COUNTER_ORDER)
+            else:
+                arrays[name] = self.column(name)
+        return arrays, bases
+
+    @classmethod
+    def decode(cls, arrays, bases, kinds):
+        """
+        Inverse of encode
+        """
+        columns = {name: decode_column(values, bases[name], order=COUNTER_ORDER) if kinds[name] == 'counter'
+                   else values for name, values in arrays.items() if name != 'timestamp_us'}
+        return cls.from_arrays(decode_column(arrays['timestamp_us'], bases['timestamp_us'], order=TIMESTAMP_ORDER),
+                               columns, kinds)
+
+
+class TimeSeriesStore(object):
+
+    def __init__(self, path, encoding='delta'):
+        """
+        On disk store of a time series as a directory of chunks. Each appended TimeSeries becomes a chunk with an .npy
+          file per column, and index.json records the columns and the time range of every chunk, so reading a time
+          range only opens the chunks that overlap it.
+
+        With encoding='raw' the files hold the columns as they are and are opened memory mapped, so a read maps the
+          data instead of loading it. With encoding='delta' timestamps and counters are stored as in
+          TimeSeries.encode, with the base values in the chunk's index entry. Timestamps of a regular interval then
+          take one byte a row instead of eight, and counters one to four bytes depending on how far they move
+          between rows. Gauges are stored as they are. The encoded files are still memory mapped, only the columns
+          that are read get decoded.
+
+        :param path: directory of the store, created if needed. An existing store is opened with its own encoding.
+        :param encoding: 'delta' or 'raw', for a new store
+        """
+        if encoding not in ENCODINGS:
+            raise ValueError(f'Encoding must be one of {ENCODINGS}, got {encoding}')
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        index_file = os.path.join(path, INDEX_FILE)
+        if os.path.exists(index_file):
+            with open(index_file) as f:
+                self.index = json.load(f)
+        else:
+            self.index = dict(encoding=encoding, columns={}, chunks=[])
+
+    def __repr__(self):
+        return f'TimeSeriesStore({self.path!r}, chunks={len(self.index["chunks"])})'
+
+    def __len__(self):
+        return sum(chunk['rows'] for chunk in self.index['chunks'])
+
+    @property
+    def encoding(self):
+        return self.index['encoding']
+
+    @property
+    def names(self):
+        return list(self.index['columns'])
+
+    def _write_index(self):
+        # Replace the index atomically so a crash never leaves a store that lists a half written chunk
+        temporary = os.path.join(self.path, f'{INDEX_FILE}.tmp')
+        with open(temporary, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(temporary, os.path.join(self.path, INDEX_FILE))
+
+    def append(self, series):
+        """
+        Write a series as a new chunk. Its rows must not be before the end of the last chunk.
+        """
+        if len(series) == 0:
+            return
+        chunks = self.index['chunks']
+        if chunks and series.timestamps[0] < chunks[-1]['end_us']:
+            raise ValueError(f'Chunk starts at {series.timestamps[0]}, before the end of the store at '
+                             f'{chunks[-1]["end_us"]}')
+
+        columns = self.index['columns']
+        for name in series.names:
+            if name not in columns:
+                columns[name] = dict(kind=series.kinds[name], file=f'{len(columns)}.npy')
+            elif columns[name]['kind'] != series.kinds[name]:
+                raise ValueError(f'Column "{name}" is a {columns[name]["kind"]} in the store, not a '
+                                 f'{series.kinds[name]}')
+
+        bases = None
+        if self.encoding == 'delta':
+            arrays, bases = series.encode()
+        else:
+            arrays = dict(timestamp_us=series.timestamps, **{name: series.column(name) for name in series.names})
+
+        # The chunk is written to a temporary directory and moved into place once complete. A directory the index
+        #   doesn't list is what's left of an append that crashed before the index was written, it's replaced.
+        chunk_name = f'chunk-{len(chunks):06d}'
+        directory = os.path.join(self.path, chunk_name)
+        temporary = os.path.join(self.path, f'.{chunk_name}.tmp')
+        for leftover in (temporary, directory):
+            if os.path.exists(leftover):
+                shutil.rmtree(leftover)
+        os.makedirs(temporary)
+        for name, values in arrays.items():
+            file_name = 'timestamp_us.npy' if name == 'timestamp_us' else columns[name]['file']
+            np.save(os.path.join(temporary, file_name), values)
+        os.replace(temporary, directory)
+
+        chunk = dict(name=chunk_name, rows=len(series), start_us=int(series.timestamps[0]),
+                     end_us=int(series.timestamps[-1]), columns=series.names)
+        if bases is not None:
+            chunk['bases'] = bases
+        chunks.append(chunk)
+        self._write_index()
+
+    def chunks(self, start_us=None, end_us=None):
+        """
+        Index entries of the chunks with rows in start_us <= timestamp < end_us
+        """
+        return [chunk for chunk in self.index['chunks']
+                if (start_us is None or chunk['end_us'] >= start_us) and (end_us is None or chunk['start_us'] < end_us)]
+
+    def _load(self, chunk, file_name):
+        return np.load(os.path.join(self.path, chunk['name'], file_name), mmap_mode='r')
+
+    def read_chunk(self, chunk, columns=None):
+        """
+        :param chunk: an entry of chunks()
+        :param columns: names to read, all by default. Columns the chunk doesn't have are NaN or 0.
+        :return: TimeSeries. With raw encoding the arrays are copies of the mapped files.
+        """
+        names = self.names if columns is None else columns
+        kinds = {name: self.index['columns'][name]['kind'] for name in names}
+        arrays = dict(timestamp_us=self._load(chunk, 'timestamp_us.npy'))
+        bases = dict(chunk.get('bases', {}))
+        for name in names:
+            if name in chunk['columns']:
+                arrays[name] = self._load(chunk, self.index['columns'][name]['file'])
+            elif kinds[name] == 'gauge':
+                arrays[name] = np.full(chunk['rows'], np.nan)
+            elif self.encoding == 'delta':
+                # A counter the chunk doesn't have is 0 on every row
+                arrays[name] = np.zeros(max(chunk['rows'] - COUNTER_ORDER, 0), dtype=np.int8)
+                bases[name] = [0] * min(COUNTER_ORDER, chunk['rows'])
+            else:
+                arrays[name] = np.zeros(chunk['rows'], dtype=np.int64)
+
+        if self.encoding == 'delta':
+            return TimeSeries.decode(arrays, bases, kinds)
+        timestamps = arrays.pop('timestamp_us')
+        return TimeSeries.from_arrays(timestamps, arrays, kinds)
+
+    def read_column(self, name, start_us=None, end_us=None):
+        """
+        One column (or 'timestamp_us') over a time range without building a TimeSeries. With raw encoding and a
+          single chunk in range the result is a view of the memory mapped file.
+
+        :return: array
+        """
+        parts = []
+        for chunk in self.chunks(start_us, end_us):
+            timestamps = self._load(chunk, 'timestamp_us.npy')
+            if self.encoding == 'delta':
+                timestamps = decode_column(timestamps, chunk['bases']['timestamp_us'], order=TIMESTAMP_ORDER)
+            low = 0 if start_us is None else np.searchsorted(timestamps, start_us, side='left')
+            high = len(timestamps) if end_us is None else np.searchsorted(timestamps, end_us, side='left')
+            if name == 'timestamp_us':
+                parts.append(timestamps[low:high])
+            else:
+                parts.append(self.read_chunk(chunk, [name]).column(name)[low:high] if self.encoding == 'delta'
+                             or name not in chunk['columns']
+                             else self._load(chunk, self.index['columns'][name]['file'])[low:high])
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts) if parts else np.array([])
+
+    def read(self, start_us=None, end_us=None, columns=None):
+        """
+        :return: TimeSeries of the rows in start_us <= timestamp < end_us
+        """
+        names = self.names if columns is None else columns
+        kinds = {name: self.index['columns'][name]['kind'] for name in names}
+        parts = [self.read_chunk(chunk, names).select(start_us, end_us) for chunk in self.chunks(start_us, end_us)]
+        if not parts:
+            return TimeSeries.from_arrays([], {name: [] for name in names}, kinds)
+        return TimeSeries.from_arrays(np.concatenate([part.timestamps for part in parts]),
+                                      {name: np.concatenate([part.column(name) for part in parts]) for name in names},
+                                      kinds)
@@ -0,0 +1,111 @@
+import time
+import threading
+import multiprocessing
+
+from pbk.util import capabilities
+from pbk.util.remote import LocalTransport
+from pbk.util.capabilities import CapabilityCache, probe_executables, get_capability_cache
+
+
+class CountingTransport(LocalTransport):
+
+    def __init__(self, log_path=None, delay=0.0, *args, **kwargs):
+        """
+        LocalTransport that records each probe, in a file when probes come from several processes
+        """
+        super().__init__(*args, **kwargs)
+        self.log_path = log_path
+        self.delay = delay
+        self.probes = []
+
+    def send_command(self, command, timeout=60, deadline=None):
+        self.probes.append(command)
+        if self.log_path is not None:
+            with open(self.log_path, 'a') as log:
+                log.write(f'{command}\n')
+        time.sleep(self.delay)
+        return super().send_command(command, timeout=timeout, deadline=deadline)
+
+
+def test_probe_executables():
+    transport = CountingTransport()
+    paths = probe_executables(transport, ['sh', 'no-such-executable', 'sh', "it's"])
+    assert list(paths) == ['sh', 'no-such-executable', "it's"]
+    assert paths['sh'].endswith('/sh')
+    assert paths['no-such-executable'] is None and paths["it's"] is None
+    assert len(transport.probes) == 1
+    assert probe_executables(transport, []) == {}
+    assert len(transport.probes) == 1
+
+
+def test_lookup_only_probes_missing_and_expired(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(capabilities.time, 'time', lambda: now[0])
+    cache = CapabilityCache(ttl=60)
+    transport = CountingTransport()
+
+    assert cache.lookup(transport, ['sh'])['sh'].endswith('/sh')
+    assert cache.lookup(transport, ['sh', 'no-such-executable'])['no-such-executable'] is None
+    assert len(transport.probes) == 2
+    assert 'sh' not in transport.probes[1]
+
+    now[0] += 59
+    cache.lookup(transport, ['sh', 'no-such-executable'])
+    assert len(transport.probes) == 2
+    now[0] += 1
+    cache.lookup(transport, ['sh', 'no-such-executable'])
+    assert len(transport.probes) == 3
+
+    # Other users of the same host are other hosts to the cache
+    cache.lookup(CountingTransport(username='other'), ['sh'])
+    cache.invalidate(transport)
+    cache.lookup(transport, ['sh'])
+    assert len(transport.probes) == 4
+
+
+def test_cache_file_is_shared(tmp_path):
+    path = str(tmp_path / 'cache' / 'capabilities.json')
+    transport = CountingTransport()
+    CapabilityCache(path=path).lookup(transport, ['sh'])
+    assert CapabilityCache(path=path).lookup(transport, ['sh'])['sh'].endswith('/sh')
+    assert len(transport.probes) == 1
+
+    CapabilityCache(path=path).invalidate()
+    CapabilityCache(path=path).lookup(transport, ['sh'])
+    assert len(transport.probes) == 2
+
+    # A damaged file is probed over
+    with open(path, 'w') as f:
+        f.write('{"local:')
+    CapabilityCache(path=path).lookup(transport, ['sh'])
+    assert len(transport.probes) == 3
+
+    assert get_capability_cache(path) is get_capability_cache(str(tmp_path / 'cache' / '.' / 'capabilities.json'))
+
+
+def lookup_in_process(path, log_path):
+    CapabilityCache(path=path).lookup(CountingTransport(log_path=log_path, delay=0.2), ['sh'])
+
+
+def test_concurrent_lookups_probe_once(tmp_path):
+    path, log_path = str(tmp_path / 'capabilities.json'), str(tmp_path / 'probes.log')
+
+    # Threads sharing a cache
+    cache = CapabilityCache()
+    transport = CountingTransport(delay=0.2)
+    threads = [threading.Thread(target=cache.lookup, args=(transport, ['sh'])) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(transport.probes) == 1
+
+    # Processes sharing a cache file
+    processes = [multiprocessing.Process(target=lookup_in_process, args=(path, log_path)) for _ in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=30)
+        assert process.exitcode == 0
+    with open(log_path) as log:
+        assert len(log.readlines()) == 1
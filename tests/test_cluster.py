@@ -0,0 +1,93 @@
+import time
+import subprocess
+
+import pytest
+
+from pbk.util.remote import LocalTransport
+from pbk.util.cluster import (SynchronizedLaunch, build_staged_script, measure_clock_offset, aggregate_series,
+                              ABORTED, STAGE_TIMED_OUT)
+
+HOSTS = ['localhost', '127.0.0.1']
+
+
+def stage(command, release_file, stage_timeout=10):
+    process = subprocess.Popen(build_staged_script(command, str(release_file), stage_timeout=stage_timeout),
+                               shell=True, stdout=subprocess.PIPE, text=True)
+    assert process.stdout.readline() == 'PBK-READY\n'
+    return process
+
+
+def test_staged_script_waits_for_release(tmp_path):
+    release_file = tmp_path / 'release'
+    process = stage('printf "%s\\n" "it\'s quoted"', release_file)
+    time.sleep(0.2)
+    assert process.poll() is None
+
+    start_ns = time.time_ns() + 2 * 10 ** 8
+    release_file.write_text(f'{start_ns}\n')
+    stdout, _ = process.communicate(timeout=10)
+    marker, output = stdout.splitlines()
+    assert marker.startswith('PBK-START ')
+    assert int(marker.split()[1]) >= start_ns
+    assert output == "it's quoted"
+    assert process.returncode == 0
+    assert not release_file.exists()
+
+
+def test_staged_script_abort_and_timeout(tmp_path):
+    release_file = tmp_path / 'release'
+    process = stage('echo never', release_file)
+    release_file.write_text('abort\n')
+    assert process.communicate(timeout=10) == ('', None)
+    assert process.returncode == ABORTED
+
+    process = stage('echo never', release_file, stage_timeout=0.2)
+    assert process.communicate(timeout=10) == ('', None)
+    assert process.returncode == STAGE_TIMED_OUT
+
+
+def test_measure_clock_offset():
+    offset_ns, round_trip_ns = measure_clock_offset(LocalTransport(), samples=2)
+    # Same clock, the offset is bounded by the round trip
+    assert 0 < round_trip_ns < 5 * 10 ** 9
+    assert abs(offset_ns) <= round_trip_ns
+
+
+def test_aggregate_series():
+    series_by_host = {'a': dict(elapsed_s=[0.5, 1.0, 1.5, 2.0], iops=[10, 20, 30, 40], bw_bytes=[1, 1, 1, None]),
+                      'b': dict(elapsed_s=[1.0, 2.0, 3.0], iops=[100, 200, 300], bw_bytes=[2, 2, 2])}
+    aggregate = aggregate_series(series_by_host, window=1.0)
+    # Samples of one host in the same window are averaged, the hosts are summed
+    assert aggregate == dict(elapsed_s=[1.0, 2.0, 3.0], hosts=[2, 2, 1], iops=[115.0, 235.0, 300.0],
+                             bw_bytes=[3.0, 3.0, 2.0])
+    assert aggregate_series({}) == dict(elapsed_s=[], hosts=[], iops=[], bw_bytes=[])
+
+
+def test_synchronized_launch():
+    launch = SynchronizedLaunch(HOSTS, transport='local', start_delay=0.5, stage_timeout=10, timeout=30)
+    launched = launch.run({'localhost': 'echo one', '127.0.0.1': 'echo two; exit 3'})
+    hosts = launched['hosts']
+    assert (hosts['localhost']['stdout'], hosts['localhost']['exit_status']) == ('one\n', 0)
+    assert (hosts['127.0.0.1']['stdout'], hosts['127.0.0.1']['exit_status']) == ('two\n', 3)
+    for outcome in hosts.values():
+        assert outcome['error'] is None
+        assert outcome['start_ns'] >= launched['start_ns'] - 10 ** 8
+        assert abs(outcome['skew_ns']) < 10 ** 9
+
+
+def test_synchronized_launch_host_fails_staging():
+    launch = SynchronizedLaunch(HOSTS, transport='local', start_delay=0.5, stage_timeout=10, timeout=30)
+    transport = launch.transports['127.0.0.1']
+    stream = transport.stream
+
+    def unreachable_when_staging(command, *args, **kwargs):
+        if 'PBK-READY' in command:
+            raise ConnectionError('no route to host')
+        return stream(command, *args, **kwargs)
+
+    transport.stream = unreachable_when_staging
+    started = time.time()
+    # The other host is aborted instead of released, without waiting for the stage timeout
+    with pytest.raises(RuntimeError, match='127.0.0.1'):
+        launch.run('echo started')
+    assert time.time() - started < 5
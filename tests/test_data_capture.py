@@ -1,10 +1,18 @@
+import os
 import time
+import asyncio
+import threading
 import pprint
 import logging
 import logging.config
 import logging.handlers
+import multiprocessing
+
+import numpy as np
+import pytest
 
 from pbk.util.perflogger import configure_basic_logger, get_queued_logger
+from pbk.util.data_capture import DataCaptureManager, DataCapture, ResultHandle, SPILL_ALIGNMENT
 
 
 def log_queue_listener(q, stop_event, logger_name, **kwargs):
@@ -19,6 +27,229 @@ def log_queue_listener(q, stop_event, logger_name, **kwargs):
     listener.stop()
 
 
+@pytest.fixture
+def log_queue():
+    # Drain the queue, a child process can't exit while its log records are stuck in a full pipe
+    log_queue = multiprocessing.Queue()
+    listener = logging.handlers.QueueListener(log_queue, logging.NullHandler())
+    listener.start()
+    yield log_queue
+    listener.stop()
+
+
+@pytest.fixture
+def make_manager(log_queue):
+    managers = []
+
+    def make_manager(capture_classes, hosts=('a',), **kwargs):
+        dcm = DataCaptureManager(capture_classes, multi_params=dict(host=list(hosts)), log_queue=log_queue, **kwargs)
+        managers.append(dcm)
+        return dcm
+
+    yield make_manager
+    # Let captures a test left behind run to their end, the interpreter joins capture processes on exit
+    for dcm in managers:
+        loop = getattr(dcm.runner, 'loop', None)
+        if loop is not None and loop.is_closed():
+            # Torn down already
+            continue
+        for event in dcm.state_events.values():
+            event.set()
+        for capture in dcm.captures:
+            capture.join(timeout=10)
+        dcm.runner.close()
+
+
+class HostCapture(DataCapture):
+
+    def __init__(self, host=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.host = host
+        self.calls = []
+
+    def setup(self):
+        self.calls.append('setup')
+
+    def start(self):
+        self.calls.append('start')
+
+    def stop(self):
+        self.calls.append('stop')
+
+    @property
+    def data(self):
+        return dict(host=self.host, calls=self.calls, pid=os.getpid())
+
+
+class SlowSetupCapture(HostCapture):
+
+    def setup(self):
+        time.sleep(1)
+
+
+class FailingStartCapture(HostCapture):
+
+    def start(self):
+        raise OSError('collector not installed')
+
+
+class DyingCapture(HostCapture):
+
+    def setup(self):
+        # Killed without a chance to report a state
+        os._exit(1)
+
+
+class ArrayCapture(HostCapture):
+
+    @property
+    def data(self):
+        return dict(host=self.host, samples=np.arange(100000, dtype=np.float64))
+
+
+class AsyncCapture(HostCapture):
+
+    async def setup(self):
+        await asyncio.sleep(0.01)
+        self.calls.append(('setup', threading.current_thread().name))
+
+    async def start(self):
+        self.calls.append(('start', threading.current_thread().name))
+
+
+def run_captures(dcm):
+    dcm.setup(timeout=30)
+    dcm.start(timeout=30)
+    dcm.stop(timeout=30)
+    dcm.teardown(timeout=30)
+    return dcm.result_data
+
+
+def test_capture_processes(make_manager):
+    dcm = make_manager([HostCapture], hosts=['a', 'b'])
+    result_data = run_captures(dcm)
+    assert [result_set['host'] for result_set in result_data] == ['a', 'b']
+    for result_set in result_data:
+        capture_data, = result_set['result_data']
+        assert capture_data['host'] == result_set['host']
+        assert capture_data['calls'] == ['setup', 'start', 'stop']
+        assert capture_data['pid'] != os.getpid()
+    for process in dcm.captures:
+        process.join(timeout=10)
+        assert process.exitcode == 0
+
+
+def test_capture_wait_timeout(make_manager):
+    dcm = make_manager([SlowSetupCapture])
+    started = time.time()
+    with pytest.raises(TimeoutError, match='Stragglers: SlowSetupCapture.*"initializing"'):
+        dcm.setup(timeout=0.2)
+    assert time.time() - started < 1
+    # The capture keeps going, waiting again returns once its setup is done
+    dcm._wait_for_state('setuped', timeout=10)
+    assert time.time() - started < 5
+
+
+def test_capture_failures(make_manager):
+    dcm = make_manager([HostCapture, FailingStartCapture])
+    dcm.setup(timeout=30)
+    with pytest.raises(RuntimeError, match='FailingStartCapture.*"failed"'):
+        dcm.start(timeout=30)
+    dcm.stop(wait=False)
+    dcm.teardown(wait=False)
+    for capture in dcm.captures:
+        capture.join(timeout=30)
+    # The failed capture sends a failure marker in place of its result
+    handles = dcm.result_handles[0]['result_handles']
+    assert sorted(handle.error is None for handle in handles) == [False, True]
+    with pytest.raises(RuntimeError, match='collector not installed'):
+        dcm.result_data
+
+    # A process that dies is noticed without a timeout
+    dcm = make_manager([DyingCapture])
+    started = time.time()
+    with pytest.raises(RuntimeError, match='DyingCapture'):
+        dcm.setup()
+    assert time.time() - started < 10
+
+
+
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+@pytest.mark.parametrize('runner', ['thread', 'asyncio'])
+def test_capture_runners(make_manager, runner):
+    dcm = make_manager([HostCapture, FailingStartCapture], hosts=['a', 'b'], runner=runner)
+    assert dcm.spill_dir is None
+    dcm.setup(timeout=30)
+    with pytest.raises(RuntimeError, match='FailingStartCapture'):
+        dcm.start(timeout=30)
+
+    dcm = make_manager([HostCapture], hosts=['a', 'b'], runner=runner)
+    result_data = run_captures(dcm)
+    assert [result_set['host'] for result_set in result_data] == ['a', 'b']
+    for result_set in result_data:
+        capture_data, = result_set['result_data']
+        assert capture_data['calls'] == ['setup', 'start', 'stop']
+        assert capture_data['pid'] == os.getpid()
+
+
+def test_asyncio_runner_awaits_coroutines(make_manager):
+    dcm = make_manager([AsyncCapture], hosts=['a', 'b'], runner='asyncio', max_workers=2)
+    result_data = run_captures(dcm)
+    for result_set in result_data:
+        calls = result_set['result_data'][0]['calls']
+        # Coroutine methods run on the loop, blocking ones on the executor
+        assert calls[:2] == [('setup', 'pbk-capture-loop'), ('start', 'pbk-capture-loop')]
+        assert calls[2] == 'stop'
+    # Teardown stops the loop thread
+    assert not dcm.runner.thread.is_alive()
+
+
+def test_unknown_runner(log_queue):
+    with pytest.raises(ValueError):
+        DataCaptureManager([HostCapture], multi_params=dict(host=['a']), log_queue=log_queue, runner='fiber')
+
+
+
+def test_result_handles(tmp_path):
+    data = dict(rows=[1, 2, 3])
+    assert ResultHandle.spill(data).load() is data
+
+    handle = ResultHandle.spill(data, str(tmp_path))
+    assert handle.payload is not None and handle.path is None
+    assert handle.load() == data
+    assert list(tmp_path.iterdir()) == []
+
+    # Over the inline limit or holding arrays: spilled, with the arrays' buffers aligned after the pickle
+    assert ResultHandle.spill(dict(text='x' * 100), str(tmp_path), inline_limit=10).load() == dict(text='x' * 100)
+    arrays = dict(a=np.arange(10, dtype=np.int8), b=np.linspace(0, 1, 1000))
+    handle = ResultHandle.spill(arrays, str(tmp_path))
+    assert handle.payload is None and os.path.exists(handle.path)
+    assert len(handle.buffer_spans) == 2
+    assert all(offset % SPILL_ALIGNMENT == 0 for offset, _ in handle.buffer_spans)
+    loaded = handle.load()
+    assert list(tmp_path.iterdir()) == []
+    np.testing.assert_array_equal(loaded['a'], arrays['a'])
+    np.testing.assert_array_equal(loaded['b'], arrays['b'])
+    # Used in place from the read only mapping
+    assert not loaded['b'].flags.writeable
+    assert handle.load() is loaded
+
+    with pytest.raises(RuntimeError, match='OSError: disk gone'):
+        ResultHandle(error='OSError: disk gone').load()
+
+
+def test_capture_processes_spill_arrays(make_manager):
+    dcm = make_manager([ArrayCapture])
+    dcm.setup(timeout=30)
+    dcm.start(timeout=30)
+    dcm.stop(timeout=30)
+    handle, = dcm.result_handles[0]['result_handles']
+    assert os.path.dirname(handle.path) == dcm.spill_dir
+    capture_data, = dcm.result_data[0]['result_data']
+    np.testing.assert_array_equal(capture_data['samples'], np.arange(100000, dtype=np.float64))
+    dcm.teardown(timeout=30)
+
+
 if __name__ == "__main__":
     import json
     import pprint
@@ -0,0 +1,127 @@
+import collections
+
+import pytest
+
+from pbk.util.designs import (ParameterSpace, full_factorial, latin_hypercube, fractional_factorial, coarse_space,
+                              refine_space, coarse_to_fine, expand)
+
+AXES = {'blocksize': ['4k', '16k', '64k', '256k', '1m'], 'numjobs': [1, 2, 4, 8], 'rw': ['read', 'write']}
+
+
+@pytest.fixture
+def space():
+    return ParameterSpace(AXES)
+
+
+def test_space_shape_and_points(space):
+    assert space.names == ['blocksize', 'numjobs', 'rw']
+    assert space.shape == [5, 4, 2]
+    assert len(space) == 40
+
+    points = list(space)
+    assert len(points) == 40
+    assert points[0] == dict(blocksize='4k', numjobs=1, rw='read')
+    # The last axis varies fastest and point() decodes the same order
+    assert points[1] == dict(blocksize='4k', numjobs=1, rw='write')
+    assert all(space.point(index) == point for index, point in enumerate(points))
+    assert all(space.point_from_indices(space.indices_of(point)) == point for point in points)
+    with pytest.raises(IndexError):
+        space.point(40)
+
+
+def test_space_rejects_empty_axis():
+    with pytest.raises(ValueError):
+        ParameterSpace({'numjobs': []})
+
+
+def test_subspace(space):
+    subspace = space.subspace({'numjobs': [2, 4]})
+    assert subspace.shape == [5, 2, 2]
+    assert subspace.axes['blocksize'] == AXES['blocksize']
+
+
+def test_full_factorial_is_lazy(space):
+    points = full_factorial(space)
+    assert next(points) == dict(blocksize='4k', numjobs=1, rw='read')
+
+
+@pytest.mark.parametrize('samples', [3, 5, 10])
+def test_latin_hypercube_covers_every_stratum(space, samples):
+    points = list(latin_hypercube(space, samples=samples, seed=1))
+    assert len(points) <= samples
+    assert len({tuple(point.values()) for point in points}) == len(points)
+    if samples == len(AXES['blocksize']):
+        # One sample per level of the axis with as many levels as samples
+        assert sorted(point['blocksize'] for point in points) == sorted(AXES['blocksize'])
+
+
+def test_latin_hypercube_is_reproducible(space):
+    assert list(latin_hypercube(space, 6, seed=3)) == list(latin_hypercube(space, 6, seed=3))
+
+
+@pytest.mark.parametrize('fraction', [1, 2, 5])
+def test_fractional_factorial(space, fraction):
+    blocks = [list(fractional_factorial(space, fraction=fraction, offset=offset)) for offset in range(fraction)]
+    assert all(len(block) == len(space) // fraction for block in blocks)
+
+    # The blocks are complementary: together they are the full factorial, each point once
+    combined = [tuple(point.values()) for block in blocks for point in block]
+    assert sorted(combined) == sorted(tuple(point.values()) for point in space)
+
+    # Every combination of the other axes is still run
+    others = collections.Counter((point['numjobs'], point['rw']) for point in blocks[0])
+    assert len(others) == 8
+
+
+def test_fractional_factorial_rejects_large_fraction(space):
+    with pytest.raises(ValueError):
+        list(fractional_factorial(space, fraction=6))
+
+
+def test_coarse_space_keeps_first_and_last(space):
+    coarse = coarse_space(space, stride=2)
+    assert coarse.axes['blocksize'] == ['4k', '64k', '1m']
+    assert coarse.axes['numjobs'] == [1, 4, 8]
+    assert coarse.axes['rw'] == ['read', 'write']
+
+
+def test_refine_space(space):
+    best = dict(blocksize='64k', numjobs=8, rw='read')
+    worse = dict(blocksize='4k', numjobs=1, rw='read')
+    refined = refine_space(space, [(worse, 1.0), (best, 5.0)], span=1)
+    assert refined.axes['blocksize'] == ['16k', '64k', '256k']
+    assert refined.axes['numjobs'] == [4, 8]
+    assert refined.axes['rw'] == ['read', 'write']
+
+    # Minimizing refines around the other point, and top merges the regions of several points
+    assert refine_space(space, [(worse, 1.0), (best, 5.0)], maximize=False).axes['blocksize'] == ['4k', '16k']
+    assert refine_space(space, [(worse, 1.0), (best, 5.0)], top=2).axes['numjobs'] == [1, 2, 4, 8]
+
+    with pytest.raises(ValueError):
+        refine_space(space, [])
+
+
+def test_coarse_to_fine_finds_the_peak():
+    space = ParameterSpace({'x': list(range(17)), 'y': list(range(17))})
+    evaluated = []
+
+    def evaluate(point):
+        evaluated.append(tuple(point.values()))
+        return -(point['x'] - 11) ** 2 - (point['y'] - 5) ** 2
+
+    scored = coarse_to_fine(space, evaluate, stride=4, span=2, rounds=3)
+    best, score = max(scored, key=lambda item: item[1])
+    assert dict(best) == dict(x=11, y=5)
+    assert score == 0
+    # Points are evaluated once, far fewer than the full factorial
+    assert len(evaluated) == len(set(evaluated)) == len(scored)
+    assert len(evaluated) < len(space) / 2
+
+
+def test_expand(space):
+    assert len(list(expand(space))) == 40
+    assert len(list(expand(AXES, design='fractional', fraction=2))) == 20
+    assert len(list(expand(space, design='coarse', stride=2))) == 18
+    assert len(list(expand(space, design='latin_hypercube', samples=4, seed=0))) <= 4
+    with pytest.raises(ValueError):
+        expand(space, design='random')
@@ -0,0 +1,232 @@
+import time
+import random
+import threading
+
+import pytest
+
+# Imported through the module, pytest would try to collect the Test* classes as test cases
+from pbk import execution
+
+
+class PointTest(execution.TestExecutor):
+
+    def __init__(self, x=0, y=0, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.x = x
+        self.y = y
+
+    def setup(self):
+        pass
+
+    def teardown(self):
+        pass
+
+    def execute(self):
+        if (self.x, self.y) == (6, 1):
+            raise RuntimeError('This point fails')
+        return -(self.x - 5) ** 2 - (self.y - 3) ** 2
+
+
+class PointSequence(execution.TestSequence):
+    parameter_space = {'x': list(range(9)), 'y': list(range(7))}
+
+    def setup(self):
+        pass
+
+    def make_test(self, point):
+        return PointTest(**point)
+
+
+def test_build_test_list_full(tmp_path):
+    with PointSequence(filename=str(tmp_path / 'tests')) as sequence:
+        assert sequence.build_test_list() == 63
+        assert sequence.progress() == dict(completed=0, pending=63, failed=0)
+        while sequence.tests_remaining:
+            sequence.execute_next()
+        assert sequence.progress() == dict(completed=62, pending=0, failed=1)
+
+
+def test_build_test_list_coarse_to_fine(tmp_path):
+    with PointSequence(filename=str(tmp_path / 'tests')) as sequence:
+        progress = sequence.run(design='coarse_to_fine', score=lambda result: result.data, stride=4, rounds=2)
+        # The tests ran while the list was built
+        assert progress['pending'] == 0
+        assert progress['completed'] < 63
+        best = max((test for test in sequence.test_list if test.status == 'completed'),
+                   key=lambda test: test.result.data)
+        assert (best.x, best.y) == (5, 3)
+
+
+def test_sequence_without_filename():
+    with PointSequence() as sequence:
+        assert sequence.resumed is False
+        assert sequence.run(design='coarse', stride=4) == dict(completed=9, pending=0, failed=0)
+        result = sequence.test_list[0].result
+        assert sequence.execute_next() is None
+    sequence.test_list.remove_file()
+    assert isinstance(result, execution.TestResult)
+
+
+def test_sequence_resumes(tmp_path):
+    filename = str(tmp_path / 'tests')
+    with PointSequence(filename=filename) as sequence:
+        sequence.build_test_list()
+        for _ in range(45):
+            sequence.execute_next()
+        assert sequence.progress() == dict(completed=44, pending=18, failed=1)
+        first = sequence.test_list[0].result.data
+
+    # Nothing is rebuilt or run again, the resumed sequence only runs what was left
+    with PointSequence(filename=filename) as sequence:
+        assert sequence.resumed is True
+        assert sequence.run() == dict(completed=62, pending=0, failed=1)
+        assert len(sequence.test_list) == 63
+        assert sequence.test_list[0].result.data == first
+
+    with PointSequence(filename=filename, retry_failed=True) as sequence:
+        assert sequence.progress() == dict(completed=62, pending=1, failed=0)
+        assert sequence.execute_next() is None
+        assert sequence.progress() == dict(completed=62, pending=0, failed=1)
+
+    with pytest.raises(FileExistsError):
+        PointSequence(filename=filename, resume=False)
+
+
+def test_sequence_needs_make_test():
+    class Incomplete(execution.TestSequence):
+        def setup(self):
+            pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_sequence_needs_parameter_space(tmp_path):
+    class NoSpace(PointSequence):
+        parameter_space = None
+
+    with NoSpace(filename=str(tmp_path / 'tests')) as sequence:
+        with pytest.raises(ValueError):
+            sequence.build_test_list()
+
+
+class NoisyTest(execution.TestExecutor):
+
+    def __init__(self, host=None, noise=0.0, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.host = host
+        self.noise = noise
+        self.executions = 0
+
+    def setup(self):
+        pass
+
+    def teardown(self):
+        pass
+
+    def execute(self):
+        self.executions += 1
+        return dict(iops=1000 * (1 + random.uniform(-self.noise, self.noise)))
+
+
+def test_run_stores_result():
+    test = NoisyTest()
+    result = test.run()
+    assert test.status == 'completed'
+    assert result is test.result
+    assert result.data['iops'] == 1000
+    assert result.samples == []
+
+
+def test_run_marks_failures():
+    test = PointTest(x=6, y=1)
+    assert test.run() is None
+    assert test.status == 'failed'
+    assert test.result is None
+
+
+def test_repetition_stops_when_stable():
+    controller = execution.RepetitionController(metric='iops', min_repetitions=3, max_repetitions=10)
+    test = NoisyTest(repetition=controller)
+    result = test.run()
+    assert test.executions == 3
+    assert result.samples == [1000.0] * 3
+    assert result.metric == 'iops'
+    assert result.statistics['converged'] is True
+    assert result.statistics['mean'] == 1000.0
+
+
+def test_repetition_bounded_by_max():
+    random.seed(0)
+    controller = execution.RepetitionController(metric=lambda data: data['iops'], target_relative_width=0.001,
+                                      min_repetitions=3, max_repetitions=6)
+    test = NoisyTest(noise=0.5, repetition=controller)
+    result = test.run()
+    assert test.executions == 6
+    assert len(result.samples) == 6
+    assert result.statistics['converged'] is False
+    # A callable metric has no name to record
+    assert result.metric is None
+
+
+LOCKSTEP = threading.Barrier(4)
+
+
+class LockstepTest(NoisyTest):
+
+    def execute(self):
+        # Every test adds a sample at the same time as the others
+        LOCKSTEP.wait(timeout=10)
+        return super().execute()
+
+
+def test_repetition_controller_shared_by_parallel_tests(tmp_path):
+    controller = execution.RepetitionController(metric='iops', min_repetitions=4, max_repetitions=4)
+    test_list = execution.TestList(filename=str(tmp_path / 'tests'))
+    with test_list.batch():
+        for host in range(4):
+            test_list.append(LockstepTest(host=f'host{host}', repetition=controller))
+    execution.TestScheduler(test_list, workers=4).run()
+
+    assert [test.status for test in test_list] == ['completed'] * 4
+    assert [len(test.result.samples) for test in test_list] == [4] * 4
+    assert controller.samples == []
+
+
+class TimedTest(NoisyTest):
+
+    def execute(self):
+        start = time.monotonic()
+        time.sleep(0.1)
+        return dict(start=start, end=time.monotonic())
+
+
+def overlaps(first, second):
+    return first.result.data['start'] < second.result.data['end'] and \
+        second.result.data['start'] < first.result.data['end']
+
+
+def test_scheduler_resource_exclusion(tmp_path):
+    test_list = execution.TestList(filename=str(tmp_path / 'tests'))
+    with test_list.batch():
+        for host in ['a', 'b', 'a', 'b', 'a']:
+            test_list.append(TimedTest(host=host))
+        # Different hosts, one shared device
+        test_list.append(TimedTest(host='c', resources=['device:san']))
+        test_list.append(TimedTest(host='d', resources=['device:san']))
+        test_list[0].status = 'completed'
+
+    counts = execution.TestScheduler(test_list, workers=4).run()
+    assert counts == dict(completed=6)
+    assert test_list[0].result is None
+
+    tests = list(test_list)[1:]
+    for index, test in enumerate(tests):
+        for other in tests[index + 1:]:
+            if test.resources & other.resources:
+                assert not overlaps(test, other), (test.resources, other.resources)
+    # Tests that share nothing ran in parallel
+    assert any(overlaps(test, other) for test in tests for other in tests if not test.resources & other.resources)
+    # Tests on the same host run in list order
+    starts = [test.result.data['start'] for test in tests if test.host == 'a']
+    assert starts == sorted(starts)
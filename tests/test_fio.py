@@ -0,0 +1,179 @@
+import json
+
+import pytest
+
+from pbk.util.remote import LocalTransport
+from pbk.benchmarks.fio import (parse_fio_json, parse_fio_document, parse_latency, merge_latencies, FioStatusParser,
+                                 interval_series, FioTest)
+
+
+def direction(ios, runtime_ms, blocksize=4096, clat_mean=1000.0, bins=None):
+    clat = dict(min=100, max=5000, mean=clat_mean, stddev=10.0, N=ios, percentile={'50.000000': 900, '99.000000': 4000})
+    if bins is not None:
+        clat['bins'] = bins
+    return dict(io_bytes=ios * blocksize, bw_bytes=ios * blocksize * 1000 // runtime_ms, iops=ios * 1000 / runtime_ms,
+                runtime=runtime_ms, total_ios=ios, clat_ns=clat)
+
+
+def job(name='pbk', read=None, write=None):
+    idle = dict(io_bytes=0, bw_bytes=0, iops=0.0, runtime=0, total_ios=0)
+    return dict(jobname=name, error=0, read=read or idle, write=write or idle, trim=idle)
+
+
+def document(*jobs):
+    return {'fio version': 'fio-3.35', 'jobs': list(jobs)}
+
+
+def test_parse_fio_json_single_job():
+    # fio prints warnings before the JSON document
+    stdout = 'fio: ioengine libaio not loaded, using psync\n' + json.dumps(document(job(read=direction(2000, 1000))))
+    result = parse_fio_json(stdout)
+    assert result['fio_version'] == 'fio-3.35'
+    assert [parsed['name'] for parsed in result['jobs']] == ['pbk']
+    assert result['read']['iops'] == 2000.0
+    assert result['read']['bw_bytes'] == 2000 * 4096
+    assert result['read']['clat_ns']['percentiles'] == {50.0: 900, 99.0: 4000}
+    assert result['write'] is None and result['trim'] is None
+
+
+def test_parse_fio_json_sums_jobs():
+    stdout = json.dumps(document(job('a', read=direction(1000, 1000), write=direction(500, 1000)),
+                                 job('b', read=direction(3000, 2000))))
+    result = parse_fio_json(stdout)
+    assert result['read']['iops'] == 1000.0 + 1500.0
+    assert result['read']['io_bytes'] == 4000 * 4096
+    assert result['read']['total_ios'] == 4000
+    assert result['read']['runtime_ms'] == 2000
+    # A direction only one job did I/O in is that job's result
+    assert result['write'] == result['jobs'][0]['write']
+
+
+def test_parse_fio_json_kib_bandwidth():
+    # Older fio versions only report bw in KiB/s
+    stats = direction(100, 1000)
+    del stats['bw_bytes']
+    stats['bw'] = 400
+    assert parse_fio_json(json.dumps(document(job(read=stats))))['read']['bw_bytes'] == 400 * 1024
+
+
+def test_parse_fio_json_without_json():
+    with pytest.raises(ValueError):
+        parse_fio_json('fio: failed to open /dev/nvme9n1\n')
+
+
+def test_fio_job_file():
+    test = FioTest(host='localhost', transport='local', device='/tmp/fio.data', size='1G', rw='randread',
+                   numjobs=4, ramp_time=5, job_options={'norandommap': None, 'rate_iops': 1000})
+    assert test.build_job_file().splitlines() == [
+        '[pbk]', 'filename=/tmp/fio.data', 'rw=randread', 'bs=4k', 'numjobs=4', 'iodepth=1', 'ioengine=libaio',
+        'direct=1', 'time_based', 'runtime=60', 'group_reporting', 'ramp_time=5', 'size=1G', 'norandommap',
+        'rate_iops=1000']
+    assert test.timeout == 125
+    # rwmixread only applies to the mixed modes
+    assert ('rwmixread', 100) in FioTest(host='localhost', transport='local', device='/dev/sdb').job_options_list()
+
+
+def test_fio_requires_a_device():
+    with pytest.raises(ValueError):
+        FioTest(host='localhost', transport='local')
+
+
+def status_documents():
+    # Cumulative reports of a job with a ramp: nothing measured yet, then 1000 ios at ~1us, then 2000 at ~3us
+    return [document(job()),
+            document(job(read=direction(1000, 1000, clat_mean=1000.0, bins={'1000': 1000}))),
+            document(job(read=direction(3000, 2000, clat_mean=7000000 / 3000, bins={'1000': 1000, '3000': 2000})))]
+
+
+def test_status_parser_chunks():
+    stdout = ''.join(json.dumps(status, indent=4) + '\n' for status in status_documents())
+    parser = FioStatusParser()
+    parsed = []
+    for start in range(0, len(stdout), 7):
+        parsed += parser.feed(stdout[start:start + 7])
+    assert parsed == status_documents()
+
+
+def test_status_parser_skips_broken_document():
+    broken = '{\n    "jobs": [\nfio: io_u error on file /dev/sdb\n}\n'
+    valid = json.dumps(document(job()), indent=4) + '\n'
+    parser = FioStatusParser()
+    assert parser.feed('fio: warning\n' + broken) == []
+    assert parser.feed(valid + valid) == [document(job()), document(job())]
+
+
+def test_interval_series():
+    series = interval_series(status_documents())
+    # Only directions with I/O, the ramp interval without runtime is skipped
+    assert list(series) == ['read']
+    read = series['read']
+    assert read['elapsed_s'] == [1.0, 2.0]
+    assert read['iops'] == [1000.0, 2000.0]
+    assert read['bw_bytes'] == [1000 * 4096, 2000 * 4096]
+    assert read['clat_mean_ns'] == pytest.approx([1000.0, 3000.0])
+    # The p99 of each interval comes from the difference of the cumulative histograms
+    assert read['clat_p99_ns'] == pytest.approx([1000, 3000], rel=0.02)
+
+
+def test_interval_series_without_bins():
+    documents = [document(job(read=direction(1000, 1000))), document(job(read=direction(1500, 2000)))]
+    read = interval_series(documents)['read']
+    assert read['iops'] == [1000.0, 500.0]
+    assert read['clat_p99_ns'] == [None, None]
+
+
+def test_fio_parse_output_with_status_interval():
+    stdout = ''.join(json.dumps(status, indent=4) + '\n' for status in status_documents())
+    test = FioTest(host='localhost', transport='local', device='/dev/sdb', status_interval=1)
+    assert test.fio_arguments() == ['--output-format=json+', '--status-interval=1']
+    result = test.parse_output(stdout)
+    # The totals are those of fio's final report
+    assert result['read']['total_ios'] == 3000
+    assert result['series']['read']['iops'] == [1000.0, 2000.0]
+    with pytest.raises(ValueError):
+        test.parse_output('fio: no output\n')
+
+
+def test_merge_latencies():
+    fast = parse_latency(dict(min=900, max=1100, mean=1000.0, N=990, bins={'1000': 990}))
+    slow = parse_latency(dict(min=90000, max=110000, mean=100000.0, N=10, bins={'100000': 10}))
+    merged = merge_latencies([fast, slow, None])
+    assert merged['count'] == 1000
+    assert (merged['min'], merged['max']) == (900, 110000)
+    assert merged['mean'] == pytest.approx(1990.0)
+    assert merged['histogram'].total == 1000
+    assert merged['percentiles'][50.0] == pytest.approx(1000, rel=0.02)
+    assert merged['percentiles'][99.5] == pytest.approx(100000, rel=0.02)
+
+
+def test_merge_latencies_without_histograms():
+    # Plain json output has no bins, percentiles can't be combined from the summaries
+    merged = merge_latencies([parse_latency(dict(min=1, max=3, mean=2.0, N=10, percentile={'99.000000': 3})),
+                              parse_latency(dict(min=2, max=8, mean=4.0, N=30, percentile={'99.000000': 7}))])
+    assert merged['mean'] == 3.5
+    assert merged['percentiles'] == {}
+    assert merged['histogram'] is None
+    assert merge_latencies([None, parse_latency(dict(min=0, max=0, mean=0.0, N=0))]) is None
+
+
+def test_parse_fio_json_merges_job_histograms():
+    stdout = json.dumps(document(job('a', read=direction(900, 1000, bins={'1000': 900})),
+                                 job('b', read=direction(100, 1000, clat_mean=50000.0, bins={'50000': 100}))))
+    clat = parse_fio_json(stdout)['read']['clat_ns']
+    assert clat['count'] == 1000
+    assert clat['percentiles'][50.0] == pytest.approx(1000, rel=0.02)
+    assert clat['percentiles'][95.0] == pytest.approx(50000, rel=0.02)
+
+
+def test_run_streaming_parses_status_reports(tmp_path):
+    output = tmp_path / 'fio.out'
+    output.write_text(''.join(json.dumps(status, indent=4) + '\n' for status in status_documents()))
+    test = FioTest(host='localhost', transport='local', device='/dev/sdb', status_interval=1)
+    documents, stderr, exit_status = test._run_streaming(LocalTransport(), f'cat {output}')
+    assert documents == status_documents()
+    assert exit_status == 0
+
+    # The documents are already decoded, parsing them needs no JSON text
+    result = test.parse_output('', documents=documents)
+    assert result['read'] == parse_fio_document(documents[-1])['read']
+    assert result['series']['read']['iops'] == [1000.0, 2000.0]
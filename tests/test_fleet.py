@@ -0,0 +1,73 @@
+import time
+import asyncio
+
+import pytest
+
+from pbk.util.fleet import FleetExecutor, HostResult, aggregate_results, fleet_execute
+
+HOSTS = ['node1', 'node2', 'node3', 'node4']
+
+
+def test_fleet_execute():
+    host_results = fleet_execute(HOSTS, 'echo hi', transport='local')
+    assert sorted(host_result.host for host_result in host_results) == HOSTS
+    assert all(host_result.ok for host_result in host_results)
+    assert all(host_result.results == [('hi\n', '', 0)] for host_result in host_results)
+
+
+def test_fleet_execute_command_set():
+    host_results = fleet_execute(HOSTS[:2], commands=['echo a', 'exit 2'], transport='local')
+    assert [host_result.results for host_result in host_results] == [[('a\n', '', 0), ('', '', 2)]] * 2
+    assert not any(host_result.ok for host_result in host_results)
+
+
+def test_fleet_needs_one_command_argument():
+    with pytest.raises(ValueError):
+        fleet_execute(HOSTS, transport='local')
+    with pytest.raises(ValueError):
+        fleet_execute(HOSTS, 'true', commands=['true'], transport='local')
+
+
+def test_fleet_concurrency_is_bounded():
+    started = time.time()
+    fleet_execute(HOSTS, 'sleep 0.3', concurrency=2, transport='local')
+    # Two waves of two hosts
+    assert time.time() - started >= 0.6
+
+
+def test_fleet_as_completed_yields_fastest_first():
+    fleet = FleetExecutor(['slow', 'fast'], transport='local')
+
+    async def hosts_in_order():
+        return [host_result.host async for host_result in fleet.as_completed(commands=['true'])]
+
+    # Both hosts run the same command, slow down one of them
+    original = fleet._run_host
+
+    def run_host(host, command=None, commands=None):
+        if host == 'slow':
+            time.sleep(0.3)
+        return original(host, command=command, commands=commands)
+
+    fleet._run_host = run_host
+    assert asyncio.run(hosts_in_order()) == ['fast', 'slow']
+
+
+def test_fleet_host_errors():
+    started = time.time()
+    host_results = fleet_execute(['node1'], 'sleep 5', timeout=0.5, transport='local')
+    assert time.time() - started < 3
+    assert host_results[0].error.startswith('Timed out')
+    assert not host_results[0].ok
+
+    # SSH without credentials fails for the host instead of raising
+    host_results = fleet_execute(['node1'], 'true', transport='ssh')
+    assert host_results[0].error.startswith('Exception')
+
+
+def test_aggregate_results():
+    host_results = [HostResult('a', results=[('x', '', 0)]), HostResult('b', results=[('y', '', 0)]),
+                    HostResult('c', results=[('x', '', 0)]), HostResult('d', error='Timed out')]
+    groups = aggregate_results(host_results)
+    assert [hosts for _, hosts in groups] == [['a', 'c'], ['b'], ['d']]
+    assert groups[0][0].results == [('x', '', 0)]
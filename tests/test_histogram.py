@@ -0,0 +1,102 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from pbk.util.histogram import LatencyHistogram
+
+
+def test_small_values_are_exact():
+    histogram = LatencyHistogram()
+    assert histogram.index_of(np.arange(128)).tolist() == list(range(128))
+    # Above 2**7 every power of two has 64 buckets
+    assert histogram.index_of([128, 129, 130, 255, 256]).tolist() == [128, 128, 129, 191, 192]
+
+
+def test_bucket_bounds_match_index_of():
+    histogram = LatencyHistogram(sub_bucket_bits=4, max_bits=20)
+    lower, upper = histogram.bucket_bounds()
+    indices = np.arange(len(histogram.counts))
+    assert histogram.index_of(lower).tolist() == indices.tolist()
+    assert histogram.index_of(upper - 1).tolist() == indices.tolist()
+    # The buckets cover every value without gaps
+    assert (lower[1:] == upper[:-1]).all()
+    assert upper[-1] == 1 << 20
+
+
+def test_relative_error():
+    histogram = LatencyHistogram()
+    values = np.unique(np.random.default_rng(0).integers(1, 10 ** 12, size=10000))
+    bucket_values = histogram.bucket_values()[histogram.index_of(values)]
+    assert (np.abs(bucket_values - values) / values).max() < 2 ** -6
+
+
+def test_large_values_are_clamped():
+    histogram = LatencyHistogram(max_bits=20)
+    histogram.record([1 << 30, -5])
+    assert histogram.counts[-1] == 1
+    assert histogram.counts[0] == 1
+
+
+def test_percentiles():
+    histogram = LatencyHistogram()
+    histogram.record(np.arange(1, 101))
+    assert histogram.total == 100
+    assert histogram.percentiles([0, 50, 99, 100]) == [1.0, 50.0, 99.0, 100.0]
+    assert histogram.mean() == 50.5
+    assert histogram.max() == 100.0
+    assert LatencyHistogram().percentile(50) is None
+    assert LatencyHistogram().mean() is None
+
+
+def test_record_counts():
+    histogram = LatencyHistogram()
+    histogram.record([10, 1000], counts=[3, 1])
+    histogram.record(10)
+    assert histogram.total == 5
+    assert histogram.percentile(80) == 10.0
+    assert histogram.percentile(100) == pytest.approx(1000, rel=0.02)
+
+
+def test_merge_and_subtract():
+    first = LatencyHistogram()
+    first.record(np.full(90, 1000))
+    second = LatencyHistogram()
+    second.record(np.full(10, 50000))
+
+    merged = LatencyHistogram.merge_all([first, second])
+    assert merged.total == 100
+    # The p99 of the combined data, which no average of the two p99s gives
+    assert merged.percentile(99) == pytest.approx(50000, rel=0.02)
+    assert first.total == 90
+    assert (first + second) == merged
+    assert (merged - first) == second
+    assert LatencyHistogram.merge_all([]) is None
+
+    first += second
+    assert first == merged
+
+
+def test_layouts_must_match():
+    with pytest.raises(ValueError):
+        LatencyHistogram().merge(LatencyHistogram(sub_bucket_bits=5))
+    with pytest.raises(ValueError):
+        LatencyHistogram(sub_bucket_bits=5, counts=[0] * 10)
+    with pytest.raises(ValueError):
+        LatencyHistogram(sub_bucket_bits=0)
+
+
+def test_from_fio_bins():
+    histogram = LatencyHistogram.from_fio_bins({'1000': 5, '2016': 2, 2048: 1})
+    assert histogram.total == 8
+    # Buckets above 2**7 report their midpoint
+    assert histogram.percentiles([50, 100]) == pytest.approx([1000, 2048], rel=0.02)
+
+
+def test_serialization():
+    histogram = LatencyHistogram()
+    histogram.record([1, 1, 500, 10 ** 9])
+    data = histogram.to_dict()
+    assert data['counts'] == [2, 1, 1]
+    assert LatencyHistogram.from_dict(data) == histogram
+    assert pickle.loads(pickle.dumps(histogram)) == histogram
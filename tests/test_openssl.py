@@ -0,0 +1,112 @@
+import pytest
+
+from pbk.benchmarks.openssl import scaling_curve, parse_mr_output, sum_mr_results, row_name, parse_cpu_list
+
+
+def sweep(throughputs):
+    return [dict(instances=instances, throughput=throughput, per_instance=[throughput / instances] * instances)
+            for instances, throughput in enumerate(throughputs, start=1)]
+
+
+def test_scaling_curve_finds_saturation():
+    curve = scaling_curve(sweep([100.0, 200.0, 290.0, 295.0, 296.0]))
+    assert [point['speedup'] for point in curve['curve']] == pytest.approx([1.0, 2.0, 2.9, 2.95, 2.96])
+    assert [point['efficiency'] for point in curve['curve']][:3] == [1.0, 1.0, pytest.approx(290 / 300)]
+    # Going from 3 to 4 instances gains 5, less than 10% of a single instance
+    assert curve['saturation_point'] == 3
+    assert curve['peak_throughput'] == 296.0
+    assert curve['peak_instances'] == 5
+
+
+def test_scaling_curve_peak_before_the_end():
+    curve = scaling_curve(sweep([100.0, 190.0, 150.0]))
+    assert curve['saturation_point'] == 2
+    assert (curve['peak_instances'], curve['peak_throughput']) == (2, 190.0)
+
+
+def test_scaling_curve_without_saturation():
+    # Linear scaling never saturates, the saturation point is the largest instance count measured
+    assert scaling_curve(sweep([100.0, 200.0, 300.0]))['saturation_point'] == 3
+    assert scaling_curve(sweep([100.0, 200.0, 300.0]), saturation_gain=1.5)['saturation_point'] == 1
+
+
+def test_scaling_curve_uneven_steps():
+    points = [dict(instances=instances, throughput=throughput, per_instance=[])
+              for instances, throughput in [(2, 200.0), (4, 400.0), (8, 430.0)]]
+    curve = scaling_curve(points)
+    # The gain is per added instance: 7.5 per instance from 4 to 8, below 10% of the single instance throughput of 100
+    assert curve['saturation_point'] == 4
+    assert curve['curve'][2]['efficiency'] == pytest.approx(430 / 800)
+
+
+def test_scaling_curve_empty():
+    assert scaling_curve([]) == dict(curve=[], peak_throughput=None, peak_instances=None, saturation_point=None)
+
+
+# openssl speed -mr -bytes 16 sha256 ecdsap384 ecdhbrp256r1 ecdhp256 ed25519 rsa2048, with the +DT/+R progress lines
+MR_OUTPUT = '''+DT:sha256:3:16
++R:26859485:sha256:3.000000
++H:16:64
++F:6:sha256:143250586.67:410745216.00
++F2:2:2048:1493.333333:50592.666667
++F4:4:384:1207.000000:1431.333333
++F5:16:256:1702.000000:0.000588
++F5:3:256:17120.202020:0.000058
++F6:0:253:Ed25519:30003.030303:9358.585859
+'''
+
+
+def test_parse_mr_output():
+    parsed = parse_mr_output(MR_OUTPUT)
+    assert parsed['block_sizes'] == [16, 64]
+    assert parsed['symmetric'] == {'sha256': {16: 143250586.67, 64: 410745216.0}}
+
+    rows = {row['name']: row for row in parsed['asymmetric']}
+    assert list(rows) == ['rsa2048', 'ecdsap384', 'ecdhbrp256r1', 'ecdhp256', 'Ed25519']
+    assert rows['rsa2048'] == dict(type='rsa', index=2, bits=2048, name='rsa2048', sign=1493.333333,
+                                   verify=50592.666667)
+    assert rows['ecdsap384']['type'] == 'ecdsa'
+    # Curves with the same bit size are told apart by their index
+    assert rows['ecdhbrp256r1']['bits'] == rows['ecdhp256']['bits'] == 256
+    assert rows['ecdhp256']['derive'] == 17120.20202
+    assert rows['ecdhp256']['seconds_per_derive'] == 0.000058
+    assert rows['Ed25519'] == dict(type='eddsa', index=0, bits=253, name='Ed25519', sign=30003.030303,
+                                   verify=9358.585859)
+
+
+def test_row_name_unknown_curve():
+    assert row_name('ecdh', 99, 256) == 'ecdh256-99'
+    assert row_name('dsa', 1, 1024) == 'dsa1024'
+
+
+@pytest.mark.parametrize('stdout', ['+F:6:sha256:fast', '+F4:4', '+F6:0:253:Ed25519:x:1.0'])
+def test_parse_mr_output_malformed_line(stdout):
+    with pytest.raises(ValueError):
+        parse_mr_output(f'+H:16\n{stdout}\n')
+
+
+def test_parse_mr_output_without_results():
+    with pytest.raises(ValueError):
+        parse_mr_output('+DT:sha256:3:16\n')
+
+
+def test_sum_mr_results():
+    first = parse_mr_output(MR_OUTPUT)
+    # The rows of the other instance come in another order
+    lines = MR_OUTPUT.splitlines()
+    second = parse_mr_output('\n'.join(lines[:4] + lines[4:][::-1]))
+    total = sum_mr_results([first, second])
+
+    assert total['block_sizes'] == [16, 64]
+    assert total['symmetric']['sha256'] == {16: 2 * 143250586.67, 64: 2 * 410745216.0}
+    rows = {row['name']: row for row in total['asymmetric']}
+    assert rows['ecdhbrp256r1']['derive'] == 2 * 1702.0
+    assert rows['ecdhp256']['derive'] == 2 * 17120.20202
+    assert rows['ecdhp256']['seconds_per_derive'] == pytest.approx(1 / (2 * 17120.20202))
+    assert rows['Ed25519']['verify'] == 2 * 9358.585859
+
+
+@pytest.mark.parametrize('text, cpus', [('0-3', [0, 1, 2, 3]), ('0-3,8,10-11\n', [0, 1, 2, 3, 8, 10, 11]),
+                                        ('5', [5]), ('', [])])
+def test_parse_cpu_list(text, cpus):
+    assert parse_cpu_list(text) == cpus
@@ -0,0 +1,380 @@
+import os
+import time
+import pickle
+
+import pytest
+
+from pbk.util.persist import PersistentMutableSequence, apply_mutation
+
+
+def mutate(sequence):
+    sequence.append('a')
+    sequence.append('b')
+    sequence.insert(0, 'c')
+    sequence[1] = 'd'
+    sequence.extend(['e', 'f', 'g'])
+    del sequence[-1]
+    sequence[1:3] = ['h']
+    return ['c', 'h', 'e', 'f']
+
+
+@pytest.mark.parametrize('storage', ['snapshot', 'journal'])
+@pytest.mark.parametrize('method', ['pickle', 'json'])
+def test_round_trip(tmp_path, storage, method):
+    filename = str(tmp_path / 'sequence')
+    sequence = PersistentMutableSequence(filename=filename, method=method, storage=storage)
+    expected = mutate(sequence)
+    sequence.close()
+
+    loaded = PersistentMutableSequence.load(filename, method=method, storage=storage)
+    assert list(loaded) == expected
+    loaded.close()
+
+
+def test_apply_mutation_rejects_unknown_op():
+    with pytest.raises(ValueError):
+        apply_mutation([], 'move', 0, None)
+
+
+def test_journal_appends_records_instead_of_rewriting(tmp_path):
+    filename = str(tmp_path / 'sequence')
+    sequence = PersistentMutableSequence(filename=filename, storage='journal')
+    snapshot_size = os.path.getsize(filename)
+    for value in range(10):
+        sequence.append(value)
+    sequence.close()
+
+    assert os.path.getsize(filename) == snapshot_size
+    assert os.path.getsize(f'{filename}.journal') > 0
+    assert list(PersistentMutableSequence.load(filename, storage='journal')) == list(range(10))
+
+
+def test_journal_compaction(tmp_path):
+    filename = str(tmp_path / 'sequence')
+    sequence = PersistentMutableSequence(filename=filename, storage='journal', compact_threshold=256)
+    for value in range(200):
+        sequence.append(value)
+        # Appends don't wait for a running compaction, waiting here makes every compaction finish before the next
+        sequence._storage.wait()
+    sequence.close()
+
+    assert not os.path.exists(f'{filename}.journal.old')
+    assert os.path.getsize(f'{filename}.journal') < 256
+    with open(filename, 'rb') as snapshot_file:
+        assert len(pickle.load(snapshot_file)['data']) > 150
+    assert list(PersistentMutableSequence.load(filename, storage='journal')) == list(range(200))
+
+
+def test_journal_ignores_torn_record(tmp_path):
+    filename = str(tmp_path / 'sequence')
+    sequence = PersistentMutableSequence(filename=filename, storage='journal')
+    sequence.extend([1, 2, 3])
+    sequence.close()
+
+    # A crash in the middle of an append leaves part of a record at the end of the journal
+    record = pickle.dumps([99, 'insert', 3, 4], protocol=pickle.HIGHEST_PROTOCOL)
+    with open(f'{filename}.journal', 'ab') as journal:
+        journal.write(record[:len(record) // 2])
+
+    assert list(PersistentMutableSequence.load(filename, storage='journal')) == [1, 2, 3]
+
+
+@pytest.mark.parametrize('method', ['pickle', 'json'])
+@pytest.mark.parametrize('cut', [1, 2, 5])
+def test_journal_appends_after_torn_record(tmp_path, method, cut):
+    filename = str(tmp_path / 'sequence')
+    sequence = PersistentMutableSequence(filename=filename, method=method, storage='journal')
+    sequence.extend([1, 2, 3])
+    sequence.close()
+
+    # Cut into the last record, its newline is always lost for json
+    with open(f'{filename}.journal', 'rb+') as journal:
+        journal.truncate(os.path.getsize(f'{filename}.journal') - cut)
+
+    loaded = PersistentMutableSequence.load(filename, method=method, storage='journal')
+    assert list(loaded) == [1, 2]
+    loaded.append(4)
+    loaded.append(5)
+    loaded.close()
+    assert list(PersistentMutableSequence.load(filename, method=method, storage='journal')) == [1, 2, 4, 5]
+
+
+def test_journal_recovers_unfinished_compaction(tmp_path):
+    filename = str(tmp_path / 'sequence')
+    sequence = PersistentMutableSequence(filename=filename, storage='journal')
+    sequence.extend([1, 2, 3])
+    sequence.close()
+
+    # A crash after the journal was rotated but before the snapshot covering it was written: the first records are
+    #   only in the rotated journal, the last one went to the new journal
+    with open(f'{filename}.journal', 'rb') as journal:
+        records = [pickle.load(journal) for _ in range(3)]
+    with open(f'{filename}.journal.old', 'wb') as rotated:
+        for record in records[:2]:
+            pickle.dump(record, rotated)
+    with open(f'{filename}.journal', 'wb') as journal:
+        pickle.dump(records[2], journal)
+
+    loaded = PersistentMutableSequence.load(filename, storage='journal')
+    assert list(loaded) == [1, 2, 3]
+    # Loading folded the rotated journal into a new snapshot
+    assert not os.path.exists(f'{filename}.journal.old')
+    loaded.append(4)
+    loaded.close()
+    assert list(PersistentMutableSequence.load(filename, storage='journal')) == [1, 2, 3, 4]
+
+
+def test_journal_skips_records_older_than_snapshot(tmp_path):
+    filename = str(tmp_path / 'sequence')
+    sequence = PersistentMutableSequence(filename=filename, storage='journal')
+    sequence.extend([1, 2])
+    sequence.close()
+    with open(f'{filename}.journal', 'rb') as journal:
+        records = journal.read()
+
+    # A compaction wrote the snapshot but died before removing the rotated journal
+    sequence = PersistentMutableSequence.load(filename, storage='journal')
+    sequence.persist()
+    sequence.close()
+    with open(f'{filename}.journal.old', 'wb') as rotated:
+        rotated.write(records)
+
+    assert list(PersistentMutableSequence.load(filename, storage='journal')) == [1, 2]
+
+
+def test_remove_file(tmp_path):
+    filename = str(tmp_path / 'sequence')
+    sequence = PersistentMutableSequence([1], filename=filename, storage='journal')
+    sequence.append(2)
+    sequence.remove_file()
+    assert os.listdir(tmp_path) == []
+
+
+class Member(object):
+
+    def __init__(self, name, status='pending'):
+        self.name = name
+        self.status = status
+
+
+def count_writes(monkeypatch, sequence):
+    writes = []
+    record_many = sequence._storage.record_many
+
+    def counting(records, data):
+        writes.append(list(records))
+        record_many(records, data)
+
+    monkeypatch.setattr(sequence._storage, 'record_many', counting)
+    monkeypatch.setattr(sequence._storage, 'record', lambda op, index, obj, data: counting([(op, index, obj)], data))
+    return writes
+
+
+def test_batch_coalesces_writes(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'sequence')
+    sequence = PersistentMutableSequence(filename=filename, storage='journal')
+    writes = count_writes(monkeypatch, sequence)
+
+    with sequence.batch():
+        for value in range(5):
+            sequence.append(Member(value))
+        with sequence.batch():
+            member = sequence[2]
+            for status in ('running', 'completed'):
+                member.status = status
+                sequence.persist_item(member)
+        assert writes == []
+
+    # One write with the appends in order and a single record for the member that changed twice
+    assert len(writes) == 1
+    assert [op for op, _, _ in writes[0]] == ['insert'] * 5 + ['set']
+    sequence.close()
+
+    loaded = PersistentMutableSequence.load(filename, storage='journal')
+    assert [member.status for member in loaded] == ['pending', 'pending', 'completed', 'pending', 'pending']
+
+
+def test_persist_item_outside_batch_writes_one_record(tmp_path, monkeypatch):
+    sequence = PersistentMutableSequence([Member('a'), Member('b')], filename=str(tmp_path / 'sequence'),
+                                         storage='journal')
+    writes = count_writes(monkeypatch, sequence)
+    sequence[1].status = 'completed'
+    sequence.persist_item(sequence[1])
+    # Objects that aren't members are ignored
+    sequence.persist_item(Member('b'))
+    assert writes == [[('set', 1, sequence[1])]]
+    sequence.close()
+
+
+def test_group_commit(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'sequence')
+    sequence = PersistentMutableSequence(filename=filename, storage='journal', durability='group',
+                                         group_commit_ms=10000)
+    writes = count_writes(monkeypatch, sequence)
+    for value in range(3):
+        sequence.append(value)
+    assert writes == []
+
+    # Closing commits what is pending
+    sequence.close()
+    assert [records for records in writes if records] == [[('insert', index, index) for index in range(3)]]
+    assert list(PersistentMutableSequence.load(filename, storage='journal')) == [0, 1, 2]
+
+
+def test_group_commit_in_background(tmp_path):
+    filename = str(tmp_path / 'sequence')
+    sequence = PersistentMutableSequence(filename=filename, storage='journal', durability='group',
+                                         group_commit_ms=10)
+    sequence.append(1)
+    deadline = time.time() + 5
+    while time.time() < deadline and not os.path.exists(f'{filename}.journal'):
+        time.sleep(0.01)
+    assert list(PersistentMutableSequence.load(filename, storage='journal')) == [1]
+    sequence.close()
+
+
+def test_unknown_durability(tmp_path):
+    with pytest.raises(ValueError):
+        PersistentMutableSequence(filename=str(tmp_path / 'sequence'), storage='journal', durability='sometimes')
+
+
+@pytest.mark.parametrize('method', ['pickle', 'json'])
+def test_sqlite_round_trip(tmp_path, method):
+    filename = str(tmp_path / 'sequence.db')
+    sequence = PersistentMutableSequence(filename=filename, method=method, storage='sqlite')
+    sequence.append('a')
+    sequence.append('b')
+    sequence.insert(0, 'c')
+    sequence[1] = 'd'
+    sequence.extend(['e', 'f', 'g'])
+    del sequence[-1]
+    del sequence[1:3]
+    sequence.insert(-1, 'h')
+    assert list(sequence) == ['c', 'e', 'h', 'f']
+    sequence.close()
+
+    loaded = PersistentMutableSequence.load(filename, method=method, storage='sqlite')
+    assert len(loaded) == 4
+    assert list(loaded) == ['c', 'e', 'h', 'f']
+    assert loaded[-1] == 'f'
+    with pytest.raises(IndexError):
+        loaded[4]
+    loaded.close()
+
+
+def test_sqlite_loads_members_lazily(tmp_path):
+    filename = str(tmp_path / 'sequence.db')
+    sequence = PersistentMutableSequence([Member(index) for index in range(100)], filename=filename,
+                                         storage='sqlite')
+    sequence.close()
+
+    loaded_members = []
+    sequence = PersistentMutableSequence.load(filename, storage='sqlite')
+    sequence._on_member_loaded = loaded_members.append
+    sequence._data.on_member_loaded = loaded_members.append
+    assert len(sequence) == 100
+    assert loaded_members == []
+
+    member = sequence[42]
+    assert member.name == 42
+    # A member that is held on to is the same object on the next access, so its changes can be persisted
+    assert sequence[42] is member
+    assert len(loaded_members) == 1
+    sequence.close()
+
+
+def test_sqlite_status_queries(tmp_path):
+    filename = str(tmp_path / 'sequence.db')
+    statuses = ['completed', 'completed', 'failed', 'pending', 'pending']
+    sequence = PersistentMutableSequence([Member(index, status) for index, status in enumerate(statuses)],
+                                         filename=filename, storage='sqlite')
+    assert sequence.find_status('pending') == 3
+    assert sequence.find_status(['failed', 'pending']) == 2
+    assert sequence.find_status('pending', start=4) == 4
+    assert sequence.find_status('running') is None
+    assert sequence.count_status('completed') == 2
+
+    member = sequence[3]
+    member.status = 'completed'
+    sequence.persist_item(member)
+    assert sequence.count_status('completed') == 3
+    assert sequence.find_status('pending') == 4
+    sequence.close()
+
+    loaded = PersistentMutableSequence.load(filename, storage='sqlite')
+    assert [member.status for member in loaded] == ['completed', 'completed', 'failed', 'completed', 'pending']
+    assert loaded.count_status('pending') == 1
+    loaded.close()
+
+
+def test_sqlite_batch_and_positions(tmp_path):
+    filename = str(tmp_path / 'sequence.db')
+    sequence = PersistentMutableSequence([Member(index) for index in range(5)], filename=filename,
+                                         storage='sqlite')
+    held = sequence[4]
+    with sequence.batch():
+        sequence.insert(0, Member('first'))
+        held.status = 'completed'
+        sequence.persist_item(held)
+    assert sequence.index_of(held) == 5
+    sequence.close()
+
+    loaded = PersistentMutableSequence.load(filename, storage='sqlite')
+    assert [member.name for member in loaded] == ['first', 0, 1, 2, 3, 4]
+    assert loaded.find_status('completed') == 5
+    loaded.close()
+
+
+class UnhashableMember(Member):
+
+    def __eq__(self, other):
+        return isinstance(other, Member) and self.name == other.name
+
+    __hash__ = None
+
+
+def test_sqlite_unhashable_members(tmp_path):
+    sequence = PersistentMutableSequence([UnhashableMember(index) for index in range(3)],
+                                         filename=str(tmp_path / 'sequence.db'), storage='sqlite')
+    held = sequence[1]
+    assert held.name == 1
+    sequence.insert(0, UnhashableMember('first'))
+    del sequence[1]
+    assert [member.name for member in sequence] == ['first', 1, 2]
+    sequence.close()
+
+
+def test_sqlite_set_writes_row_once(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'sequence.db')
+    PersistentMutableSequence([Member(index) for index in range(3)], filename=filename, storage='sqlite').close()
+
+    sequence = PersistentMutableSequence.load(filename, storage='sqlite')
+    loaded_members = []
+    sequence._data.on_member_loaded = loaded_members.append
+    written = []
+    write_row = sequence._storage.write_row
+
+    def counting(position, obj, insert=False):
+        written.append(position)
+        write_row(position, obj, insert)
+
+    monkeypatch.setattr(sequence._storage, 'write_row', counting)
+
+    sequence[1] = Member('new')
+    # The old member isn't loaded just to be replaced
+    assert loaded_members == []
+    assert written == [1]
+
+    # A state change after the set in the same batch still gets written
+    with sequence.batch():
+        member = Member('batched')
+        sequence[2] = member
+        member.status = 'completed'
+        sequence.persist_item(member)
+    assert written == [1, 2, 2]
+    sequence.close()
+
+    loaded = PersistentMutableSequence.load(filename, storage='sqlite')
+    assert [(member.name, member.status) for member in loaded] == [(0, 'pending'), ('new', 'pending'),
+                                                                   ('batched', 'completed')]
+    loaded.close()
@@ -0,0 +1,221 @@
+import time
+import socket
+import getpass
+import subprocess
+
+import pytest
+
+from pbk.util.remote import (build_batch_script, parse_batch_output, SSHConnectionPool, CommandStream, LocalTransport,
+                             SSHTransport, is_local_host, get_transport, send_command, run_command, send_commands,
+                             stream_command)
+
+
+def run_batch(commands):
+    script, token = build_batch_script(commands, token='test')
+    completed = subprocess.run(script, shell=True, capture_output=True, text=True)
+    return parse_batch_output(completed.stdout, completed.stderr, len(commands), token)
+
+
+def test_batch_round_trip():
+    # Argument lists are joined with spaces, like single commands
+    results = run_batch(['echo one', ['echo', 'two', 2], 'echo err >&2; exit 3', 'printf no-newline'])
+    assert results == [('one\n', '', 0), ('two 2\n', '', 0), ('', 'err\n', 3), ('no-newline', '', 0)]
+
+
+def test_batch_exit_does_not_end_the_batch():
+    results = run_batch(['exit 1', 'echo after'])
+    assert results[1] == ('after\n', '', 0)
+
+
+def test_parse_batch_output_truncated():
+    stdout = ('PBK-BATCH:t:0:begin\nfirst\n\nPBK-BATCH:t:0:end:0\n'
+              'PBK-BATCH:t:1:begin\npartial')
+    stderr = 'PBK-BATCH:t:0:begin\n\nPBK-BATCH:t:0:end\nPBK-BATCH:t:1:begin\nwarning'
+    assert parse_batch_output(stdout, stderr, 3, 't') == [
+        ('first\n', '', 0),
+        # Killed before its end marker: the output so far and no exit code
+        ('partial', 'warning', None),
+        # Never started
+        ('', '', None),
+    ]
+
+
+def test_parse_batch_output_ignores_other_tokens():
+    stdout = 'PBK-BATCH:other:0:begin\nx\n\nPBK-BATCH:other:0:end:0\n'
+    assert parse_batch_output(stdout, '', 1, 't') == [('', '', None)]
+
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.active = True
+
+    def get_transport(self):
+        return self
+
+    def is_active(self):
+        return self.active
+
+    def close(self):
+        self.active = False
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = SSHConnectionPool(idle_timeout=60)
+    monkeypatch.setattr(pool, '_connect', lambda *args: FakeClient())
+    yield pool
+    pool.close_all()
+
+
+def test_pool_reuses_connections(pool):
+    client = pool.acquire('host1', 'root', password='secret')
+    pool.release('host1', 'root', password='secret')
+    assert pool.acquire('host1', 'root', password='secret') is client
+    assert pool.acquire('host1', 'other', password='secret') is not client
+    assert pool.acquire('host1', 'root', key_filename='/tmp/key') is not client
+    assert len(pool) == 3
+
+
+def test_pool_keys_hold_no_passwords(pool):
+    pool.acquire('host1', 'root', password='secret')
+    assert 'secret' not in repr(pool._connections)
+    assert SSHConnectionPool.pool_key('host1', 'root', 'secret') == SSHConnectionPool.pool_key('host1', 'root', 'other')
+
+
+def test_pool_release_evicts_idle_connections(pool, monkeypatch):
+    idle = pool.acquire('host1', 'root', password='secret')
+    pool.release('host1', 'root', password='secret')
+    busy = pool.acquire('host2', 'root', password='secret')
+
+    later = time.time() + 120
+    monkeypatch.setattr(time, 'time', lambda: later)
+    # Releasing any connection closes the others that have been idle too long
+    pool.release('host2', 'root', password='secret')
+    assert not idle.active
+    assert busy.active
+    assert len(pool) == 1
+
+
+def test_pool_replaces_dead_connections(pool):
+    client = pool.acquire('host1', 'root', password='secret')
+    pool.release('host1', 'root', password='secret')
+    client.close()
+    assert pool.acquire('host1', 'root', password='secret') is not client
+
+
+def test_commands_default_to_the_current_user(monkeypatch):
+    # Without credentials anything but a LocalTransport would refuse to run
+    monkeypatch.setattr(getpass, 'getuser', lambda: 'bench')
+    assert isinstance(get_transport('localhost'), LocalTransport)
+    assert send_command('echo hi', 'localhost') == ('hi\n', '')
+    assert run_command('exit 4', 'localhost') == ('', '', 4)
+    assert send_commands(['echo a', 'echo b'], 'localhost') == [('a\n', '', 0), ('b\n', '', 0)]
+    with stream_command('echo streamed', 'localhost') as command_stream:
+        assert list(command_stream) == [('stdout', 'streamed\n')]
+
+
+def stream_of(*chunks, **kwargs):
+    closed = []
+    command_stream = CommandStream(iter(chunks), exit_status=lambda: 0, on_close=lambda: closed.append(True),
+                                   **kwargs)
+    return command_stream, closed
+
+
+def test_command_stream_lines():
+    command_stream, closed = stream_of(('stdout', b'one\ntw'), ('stderr', b'warn'), ('stdout', b'o\nthree'),
+                                       ('stderr', b'ing\n'))
+    assert list(command_stream) == [('stdout', 'one\n'), ('stdout', 'two\n'), ('stderr', 'warning\n'),
+                                    ('stdout', 'three')]
+    assert command_stream.exit_status == 0
+    assert closed == [True]
+
+
+def test_command_stream_holds_back_trailing_cr():
+    # The \n of a \r\n can arrive in the next chunk, the \r alone must not end the line
+    command_stream, _ = stream_of(('stdout', b'a\r'), ('stdout', b'\nb\r'), ('stdout', b'\n'), ('stdout', b'c\r'))
+    assert list(command_stream) == [('stdout', 'a\r\n'), ('stdout', 'b\r\n'), ('stdout', 'c\r')]
+
+
+def test_command_stream_decodes_split_characters():
+    data = 'naïve ✓\n'.encode()
+    command_stream, _ = stream_of(*[('stdout', data[index:index + 1]) for index in range(len(data))])
+    assert list(command_stream) == [('stdout', 'naïve ✓\n')]
+
+    command_stream, _ = stream_of(('stdout', data[:3]), ('stdout', data[3:]), mode='text')
+    assert ''.join(text for _, text in command_stream) == 'naïve ✓\n'
+
+
+def test_command_stream_splits_long_lines():
+    # The held back part of a line never grows past max_line_length
+    command_stream, _ = stream_of(('stdout', b'x' * 10), ('stdout', b'y' * 3 + b'\n'), ('stdout', b'z' * 5),
+                                  max_line_length=4)
+    assert [line for _, line in command_stream] == ['xxxx', 'xxxx', 'xxyyy\n', 'zzzz', 'z']
+
+
+def test_command_stream_bytes_and_close():
+    command_stream, closed = stream_of(('stdout', b'\xff\n'), mode='bytes')
+    assert list(command_stream) == [('stdout', b'\xff\n')]
+
+    command_stream, closed = stream_of(('stdout', b'never read'))
+    with command_stream:
+        pass
+    command_stream.close()
+    assert closed == [True]
+    assert command_stream.exit_status == 0
+
+    with pytest.raises(ValueError):
+        CommandStream(iter([]), mode='words')
+
+
+def test_local_transport_run():
+    transport = LocalTransport()
+    assert transport.run('echo out; echo err >&2; exit 4') == ('out\n', 'err\n', 4)
+    assert transport.send_command(['echo', 'a b']) == ('a b\n', '')
+    assert transport.send_commands(['echo one', 'false', 'echo two >&2']) == [('one\n', '', 0), ('', '', 1),
+                                                                             ('', 'two\n', 0)]
+    assert transport.send_commands([]) == []
+
+
+def test_local_transport_stream():
+    transport = LocalTransport()
+    with transport.stream('echo one; sleep 0.1; echo two') as command_stream:
+        assert list(command_stream) == [('stdout', 'one\n'), ('stdout', 'two\n')]
+    assert command_stream.exit_status == 0
+
+    # Closing the stream early stops the command
+    command_stream = transport.stream('echo first; sleep 30')
+    started = time.time()
+    with command_stream:
+        assert next(iter(command_stream)) == ('stdout', 'first\n')
+    assert time.time() - started < 5
+    assert command_stream.exit_status is not None
+
+
+def test_local_transport_timeouts():
+    transport = LocalTransport()
+    started = time.time()
+    # No output for timeout seconds
+    with pytest.raises(TimeoutError):
+        transport.run('sleep 30', timeout=0.3)
+    # Output keeps coming but the deadline passes
+    with pytest.raises(TimeoutError):
+        transport.run('while true; do echo tick; sleep 0.05; done', timeout=10, deadline=time.monotonic() + 0.3)
+    assert time.time() - started < 5
+
+
+def test_transport_selection():
+    assert is_local_host('localhost')
+    assert is_local_host(socket.gethostname(), getpass.getuser())
+    assert not is_local_host('localhost', 'somebody-else')
+    assert not is_local_host('192.0.2.1')
+
+    assert isinstance(get_transport('127.0.0.1'), LocalTransport)
+    assert isinstance(get_transport('192.0.2.1', password='secret'), SSHTransport)
+    assert isinstance(get_transport('192.0.2.1', transport='local'), LocalTransport)
+    assert isinstance(get_transport('localhost', password='secret', transport='ssh'), SSHTransport)
+    # A remote host needs credentials, a local one doesn't
+    with pytest.raises(Exception, match='password or key filename'):
+        get_transport('192.0.2.1')
+    with pytest.raises(ValueError):
+        get_transport('localhost', transport='telnet')
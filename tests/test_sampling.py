@@ -0,0 +1,177 @@
+import time
+import multiprocessing
+
+import pytest
+
+from pbk.util.sampling import (parse_proc_stat, parse_diskstats, parse_meminfo, parse_net_dev, parse_interrupts,
+                               build_sampling_script, SampleParser, compute_deltas, raw_counters, ProcSamplingCapture)
+
+PROC_STAT = '''cpu  100 0 50 800 50 0 0 0 0 0
+cpu0 60 0 30 400 10 0 0 0 0 0
+cpu1 40 0 20 400
+intr 12345 10 20 0
+ctxt 5000
+btime 1700000000
+procs_running 3
+procs_blocked 1
+'''
+
+DISKSTATS = '''   8       0 sda 100 5 800 40 200 10 1600 80 2 120 160 0 0 0 0
+   8       1 sda1 1 2 3
+'''
+
+MEMINFO = '''MemTotal:       16000000 kB
+MemFree:         8000000 kB
+HugePages_Total:       4
+Empty:
+'''
+
+NET_DEV = '''Inter-|   Receive                                    |  Transmit
+ face |bytes packets errs drop fifo frame compressed multicast|bytes packets errs drop fifo colls carrier compressed
+    lo: 1000 10 0 0 0 0 0 0 1000 10 0 0 0 0 0 0
+  eth0: 500000 400 1 2 0 0 0 0 200000 300 3 4 0 0 0 0
+'''
+
+INTERRUPTS = '''           CPU0       CPU1
+  0:         10          5   IO-APIC   2-edge      timer
+ 24:        100        200   PCI-MSI 65536-edge    nvme0q0
+NMI:          1          2   Non-maskable interrupts
+ERR:          0
+'''
+
+
+def test_parse_proc_stat():
+    stat = parse_proc_stat(PROC_STAT)
+    assert stat['cpu']['cpu'] == [100, 0, 50, 800, 50, 0, 0, 0]
+    # Short lines of old kernels are padded
+    assert stat['cpu']['cpu1'] == [40, 0, 20, 400, 0, 0, 0, 0]
+    assert (stat['context_switches'], stat['interrupts']) == (5000, 12345)
+    assert (stat['procs_running'], stat['procs_blocked']) == (3, 1)
+
+
+def test_parse_proc_files():
+    assert parse_diskstats(DISKSTATS) == {'sda': [100, 5, 800, 40, 200, 10, 1600, 80, 2, 120, 160]}
+    assert parse_meminfo(MEMINFO) == dict(MemTotal=16000000, MemFree=8000000, HugePages_Total=4)
+    assert parse_net_dev(NET_DEV) == {'lo': [1000, 10, 0, 0, 1000, 10, 0, 0],
+                                      'eth0': [500000, 400, 1, 2, 200000, 300, 3, 4]}
+    assert parse_interrupts(INTERRUPTS) == {'0': 15, '24': 300, 'NMI': 3, 'ERR': 0}
+    assert parse_interrupts('') == {}
+
+
+def frame(timestamp_us, files):
+    lines = [f'PBK-SAMPLE {timestamp_us}\n']
+    for path, content in files.items():
+        lines.append(f'PBK-FILE {path}\n')
+        lines.extend(content.splitlines(keepends=True))
+    return lines + ['PBK-END\n']
+
+
+def test_sample_parser():
+    parser = SampleParser()
+    lines = ['PBK-PID 4242\n'] + frame(1000000, {'/proc/stat': PROC_STAT, '/proc/unknown': 'ignored\n'})
+    # A sample cut short by the signal is dropped when the next one starts
+    lines += frame(2000000, {'/proc/meminfo': MEMINFO})[:3] + frame(3000000, {'/proc/meminfo': MEMINFO})
+    samples = [sample for sample in map(parser.feed, lines) if sample is not None]
+    assert parser.pid == 4242
+    assert [sample['timestamp_us'] for sample in samples] == [1000000, 3000000]
+    assert samples[0]['/proc/stat'] == parse_proc_stat(PROC_STAT)
+    assert '/proc/unknown' not in samples[0]
+    assert samples[1]['/proc/meminfo']['MemFree'] == 8000000
+
+
+def sample(timestamp_us, jiffies, context_switches, disk, rx_bytes, irq_count, memory_free):
+    return {'timestamp_us': timestamp_us,
+            '/proc/stat': dict(cpu={'cpu0': jiffies}, context_switches=context_switches, interrupts=irq_count,
+                               procs_running=2, procs_blocked=0),
+            '/proc/diskstats': {'sda': disk},
+            '/proc/meminfo': dict(MemFree=memory_free),
+            '/proc/net/dev': {'eth0': [rx_bytes, 0, 0, 0, 0, 0, 0, 0]},
+            '/proc/interrupts': {'24': irq_count}}
+
+
+DISK_BEFORE = [100, 0, 800, 0, 200, 0, 1600, 0, 0, 100, 0]
+DISK_AFTER = [300, 0, 2800, 0, 200, 0, 1600, 0, 3, 600, 0]
+
+
+def test_compute_deltas():
+    samples = [sample(0, [100, 0, 0, 100, 0, 0, 0, 0], 1000, DISK_BEFORE, 0, 50, 900),
+               # 2 seconds later
+               sample(2000000, [250, 0, 0, 150, 0, 0, 0, 0], 3000, DISK_AFTER, 4096, 250, 800),
+               # The counters reset
+               sample(3000000, [260, 0, 0, 240, 0, 0, 0, 0], 10, DISK_AFTER, 0, 0, 700)]
+    deltas = compute_deltas(samples)
+    assert deltas['timestamp_us'] == [2000000, 3000000]
+    assert deltas['interval_s'] == [2.0, 1.0]
+    assert deltas['cpu']['cpu0']['busy_pct'] == [75.0, 10.0]
+    assert deltas['cpu']['cpu0']['idle_pct'] == [25.0, 90.0]
+    assert deltas['system']['context_switches_per_s'] == [1000.0, None]
+    assert deltas['system']['procs_running'] == [2, 2]
+
+    disk = deltas['disk']['sda']
+    assert disk['read_iops'] == [100.0, 0.0]
+    assert disk['write_iops'] == [0.0, 0.0]
+    assert disk['read_bytes_per_s'] == [2000 * 512 / 2, 0.0]
+    assert disk['utilization_pct'] == [25.0, 0.0]
+    assert disk['in_flight'] == [3, 3]
+
+    assert deltas['memory']['MemFree'] == [800, 700]
+    assert deltas['net']['eth0']['rx_bytes_per_s'] == [2048.0, None]
+    assert deltas['interrupts']['24'] == [100.0, None]
+
+    assert compute_deltas(samples[:1])['timestamp_us'] == []
+
+
+def test_compute_deltas_devices_come_and_go():
+    first = sample(0, [0] * 8, 0, DISK_BEFORE, 0, 0, 0)
+    second = sample(1000000, [0] * 8, 0, DISK_AFTER, 0, 0, 0)
+    second['/proc/diskstats']['sdb'] = DISK_BEFORE
+    third = sample(2000000, [0] * 8, 0, DISK_AFTER, 0, 0, 0)
+    third['/proc/diskstats'] = {'sdb': DISK_AFTER}
+    deltas = compute_deltas([first, second, third])
+    assert deltas['disk']['sda']['read_iops'] == [200.0, None]
+    assert deltas['disk']['sdb']['read_iops'] == [None, 200.0]
+    # No jiffies passed, no percentages
+    assert deltas['cpu']['cpu0']['busy_pct'] == [None, None]
+
+
+def test_raw_counters():
+    samples = [sample(0, [1, 2, 3, 4, 5, 6, 7, 8], 1000, DISK_BEFORE, 0, 50, 900),
+               sample(1000000, [2, 3, 4, 5, 6, 7, 8, 9], 2000, DISK_AFTER, 100, 60, 800)]
+    counters = raw_counters(samples)
+    assert counters['cpu']['cpu0']['user_jiffies'] == [2]
+    assert counters['system'] == dict(context_switches=[2000], interrupts=[60])
+    assert counters['disk']['sda']['reads'] == [300]
+    # in_flight is a gauge, compute_deltas has it
+    assert 'in_flight' not in counters['disk']['sda']
+    assert counters['net']['eth0']['rx_bytes'] == [100]
+    assert counters['interrupt_counts'] == {'24': [60]}
+
+
+@pytest.fixture
+def log_queue():
+    log_queue = multiprocessing.Queue()
+    yield log_queue
+    log_queue.cancel_join_thread()
+
+
+def test_sampling_script_stops_with_a_final_sample(log_queue):
+    capture = ProcSamplingCapture(host='localhost', transport='local', interval=0.1, columnar=True,
+                                  sources=['/proc/stat', '/proc/meminfo'], log_queue=log_queue)
+    capture.setup()
+    capture.start()
+    time.sleep(0.35)
+    started_stop = time.time()
+    capture.stop()
+    assert time.time() - started_stop < 5
+
+    data = capture.data['ProcSamplingCapture']
+    assert data['error'] is None
+    assert data['samples'] >= 3
+    series = data['series']
+    assert len(series) == data['samples'] - 1
+    assert 'cpu/cpu/busy_pct' in series.names
+    assert series.kinds['cpu/cpu/user_jiffies'] == 'counter'
+
+    with pytest.raises(ValueError):
+        ProcSamplingCapture(host='localhost', transport='local', sources=['/proc/vmstat'], log_queue=log_queue)
+    assert 'PBK-PID' in build_sampling_script(0.5, ['/proc/stat'])
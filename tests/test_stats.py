@@ -0,0 +1,49 @@
+import math
+
+import pytest
+
+from pbk.util.stats import t_critical, summarize
+
+
+def test_t_critical_table_values():
+    assert t_critical(1) == 12.706
+    assert t_critical(10, 0.99) == 3.169
+    assert t_critical(120, 0.90) == 1.658
+
+
+def test_t_critical_interpolates_and_approaches_normal():
+    assert 2.021 > t_critical(50) > 2.000
+    assert t_critical(10 ** 9) == pytest.approx(1.960, abs=1e-6)
+    assert t_critical(200) < t_critical(120)
+
+
+def test_t_critical_rejects_bad_arguments():
+    with pytest.raises(ValueError):
+        t_critical(0)
+    with pytest.raises(ValueError):
+        t_critical(5, confidence=0.8)
+
+
+def test_summarize():
+    summary = summarize([10.0, 12.0, 14.0])
+    assert summary['count'] == 3
+    assert summary['mean'] == 12.0
+    assert summary['variance'] == 4.0
+    assert summary['stdev'] == 2.0
+    half_width = 4.303 * 2.0 / math.sqrt(3)
+    assert summary['ci_half_width'] == pytest.approx(half_width)
+    assert (summary['ci_low'], summary['ci_high']) == pytest.approx((12.0 - half_width, 12.0 + half_width))
+    assert summary['relative_ci_width'] == pytest.approx(2 * half_width / 12.0)
+    assert summary['confidence'] == 0.95
+
+
+def test_summarize_few_samples():
+    assert summarize([])['mean'] is None
+    single = summarize([5.0])
+    assert single['mean'] == 5.0
+    assert single['stdev'] is None and single['relative_ci_width'] is None
+
+
+def test_summarize_zero_mean():
+    assert summarize([0.0, 0.0])['relative_ci_width'] == 0.0
+    assert summarize([-1.0, 1.0])['relative_ci_width'] == math.inf
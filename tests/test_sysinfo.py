@@ -0,0 +1,82 @@
+import logging
+import logging.handlers
+import multiprocessing
+
+import pytest
+
+from pbk.util.remote import LocalTransport
+from pbk.util.sysinfo import SystemInfoCache, SystemInfo, get_fingerprint, FINGERPRINT_KEYS
+
+FINGERPRINT = dict(boot_id='b1', kernel_release='6.1', dmi_mtime='100', block_mtime='200', partitions='123 456')
+
+
+def test_get_fingerprint():
+    fingerprint = get_fingerprint(LocalTransport())
+    assert list(fingerprint) == list(FINGERPRINT_KEYS)
+    assert fingerprint['kernel_release']
+    assert get_fingerprint(LocalTransport()) == fingerprint
+
+
+def test_section_fingerprint():
+    assert SystemInfoCache.section_fingerprint('uname', FINGERPRINT) == dict(boot_id='b1', kernel_release='6.1')
+    # Sections that aren't listed depend on every value
+    assert SystemInfoCache.section_fingerprint('other', FINGERPRINT) == FINGERPRINT
+    # An empty value would match forever
+    assert SystemInfoCache.section_fingerprint('dmidecode', dict(FINGERPRINT, dmi_mtime='')) is None
+    assert SystemInfoCache.section_fingerprint('uname', dict(FINGERPRINT, dmi_mtime='')) is not None
+
+
+def test_cache_invalidation_by_fingerprint(tmp_path):
+    cache = SystemInfoCache(str(tmp_path / 'cache'))
+    sections = dict(uname={'kernel': 'Linux'}, parted={'sda': 1}, dmidecode={'bios': 'x'})
+    cache.store('ssh:root@host/1', FINGERPRINT, sections)
+    assert cache.valid_sections('ssh:root@host/1', FINGERPRINT) == sections
+    assert cache.valid_sections('ssh:root@other', FINGERPRINT) == {}
+
+    # A new disk only invalidates parted, a new kernel only uname, a reboot everything
+    assert set(cache.valid_sections('ssh:root@host/1', dict(FINGERPRINT, partitions='789 456'))) == \
+        {'uname', 'dmidecode'}
+    assert set(cache.valid_sections('ssh:root@host/1', dict(FINGERPRINT, kernel_release='6.2'))) == \
+        {'parted', 'dmidecode'}
+    assert cache.valid_sections('ssh:root@host/1', dict(FINGERPRINT, boot_id='b2')) == {}
+
+    # Without a DMI value dmidecode is dropped instead of cached with an empty value
+    cache.store('ssh:root@host/1', dict(FINGERPRINT, dmi_mtime=''), dict(dmidecode={'bios': 'y'}))
+    assert set(cache.load('ssh:root@host/1')) == {'uname', 'parted'}
+    assert cache.valid_sections('ssh:root@host/1', dict(FINGERPRINT, dmi_mtime='')) == \
+        dict(uname={'kernel': 'Linux'}, parted={'sda': 1})
+
+    cache.invalidate('ssh:root@host/1', ['parted'])
+    assert set(cache.load('ssh:root@host/1')) == {'uname'}
+    cache.invalidate('ssh:root@host/1')
+    assert cache.load('ssh:root@host/1') == {}
+
+    (tmp_path / 'cache' / 'damaged.json').write_text('{"uname": ')
+    assert cache.load('damaged') == {}
+
+
+@pytest.fixture
+def log_queue():
+    log_queue = multiprocessing.Queue()
+    listener = logging.handlers.QueueListener(log_queue, logging.NullHandler())
+    listener.start()
+    yield log_queue
+    listener.stop()
+
+
+def test_system_info_uses_cached_sections(tmp_path, log_queue):
+    kwargs = dict(transport='local', runner='thread', cache_dir=str(tmp_path / 'cache'), log_queue=log_queue)
+    collected = SystemInfo('localhost', None, **kwargs)
+    collected.get_all()
+    assert collected.cached_sections == []
+    # uname is the one getter whose prerequisite every host has
+    assert collected.system_info['uname']['kernel'] == 'Linux'
+
+    cached = SystemInfo('localhost', None, **kwargs)
+    cached.get_all()
+    assert 'uname' in cached.cached_sections
+    assert cached.system_info['uname'] == collected.system_info['uname']
+
+    cached.invalidate_cache(['uname'])
+    cached.get_all()
+    assert 'uname' not in cached.cached_sections
@@ -0,0 +1,195 @@
+import numpy as np
+import pytest
+
+from pbk.util.timeseries import (TimeSeries, TimeSeriesStore, delta_encode, delta_decode, encode_column,
+                                 decode_column, smallest_int_dtype)
+
+START_US = 1700000000000000
+
+
+@pytest.mark.parametrize('order', [1, 2, 3])
+def test_delta_round_trip(order):
+    values = np.random.default_rng(order).integers(-10 ** 12, 10 ** 12, size=50)
+    assert delta_decode(delta_encode(values, order=order), order=order).tolist() == values.tolist()
+
+
+def test_delta_of_delta_regular_timestamps():
+    timestamps = START_US + 1000000 * np.arange(5)
+    assert delta_encode(timestamps, order=2).tolist() == [START_US, 1000000, 0, 0, 0]
+
+
+def test_smallest_int_dtype():
+    assert smallest_int_dtype(np.array([-128, 127])) == np.int8
+    assert smallest_int_dtype(np.array([128])) == np.int16
+    assert smallest_int_dtype(np.array([-40000])) == np.int32
+    assert smallest_int_dtype(np.array([2 ** 40])) == np.int64
+    assert smallest_int_dtype(np.array([], dtype=np.int64)) == np.int8
+
+
+def test_encode_column_keeps_bases_apart():
+    # Epoch microseconds with a little jitter: the bases hold the large values so the deltas fit in a byte
+    timestamps = START_US + 1000000 * np.arange(100) + np.tile([0, 30, -20, 10], 25)
+    deltas, bases = encode_column(timestamps, order=2)
+    assert deltas.dtype == np.int8
+    assert len(deltas) == 98
+    assert bases == [START_US, 1000030]
+    assert decode_column(deltas, bases, order=2).tolist() == timestamps.tolist()
+
+
+@pytest.mark.parametrize('rows', [0, 1, 2])
+def test_encode_column_short(rows):
+    values = np.arange(rows) + START_US
+    deltas, bases = encode_column(values, order=2)
+    assert len(bases) == rows
+    assert decode_column(deltas, bases, order=2).tolist() == values.tolist()
+
+
+def sample_series(rows=10, start_us=START_US):
+    series = TimeSeries(kinds={'disk/sda/reads': 'counter'})
+    for row in range(rows):
+        values = {'cpu/busy_pct': 10.0 + row, 'disk/sda/reads': 10 ** 9 + 100 * row}
+        if row == 3:
+            # A missing gauge is NaN, a missing counter repeats the previous value
+            values = {}
+        series.append(start_us + 1000000 * row, values)
+    return series
+
+
+def test_append_and_missing_values():
+    series = TimeSeries(capacity=1)
+    series.append(START_US, {'a': 1.0})
+    series.add_column('count', 'counter')
+    series.append(START_US + 1, {'b': None, 'count': 5})
+    series.append(START_US + 2, {'a': 2.0})
+    assert len(series) == 3
+    assert series.names == ['a', 'count', 'b']
+    assert series['count'].tolist() == [0, 5, 5]
+    assert np.isnan(series['b']).all()
+    assert np.isnan(series['a'][1])
+    with pytest.raises(ValueError):
+        series.append(START_US, {'a': 0.0})
+    with pytest.raises(ValueError):
+        series.add_column('a')
+    with pytest.raises(ValueError):
+        series.add_column('c', 'histogram')
+
+
+def test_encode_decode_round_trip():
+    series = sample_series()
+    arrays, bases = series.encode()
+    assert arrays['timestamp_us'].dtype == np.int8
+    # The counter moves 200 across the row where it was missing
+    assert arrays['disk/sda/reads'].dtype == np.int16
+    assert bases == {'timestamp_us': [START_US, 1000000], 'disk/sda/reads': [10 ** 9]}
+
+    decoded = TimeSeries.decode(arrays, bases, series.kinds)
+    assert decoded.timestamps.tolist() == series.timestamps.tolist()
+    assert decoded['disk/sda/reads'].tolist() == series['disk/sda/reads'].tolist()
+    np.testing.assert_array_equal(decoded['cpu/busy_pct'], series['cpu/busy_pct'])
+
+
+def test_from_dict_with_counters():
+    data = dict(timestamp_us=[START_US, START_US + 1000000, START_US + 2000000],
+                cpu={'cpu0': {'busy_pct': [1.0, None, 3.0]}}, hostname='host1', short=[1.0])
+    counters = dict(net={'eth0': {'rx_bytes': [100, None, 300]}})
+    series = TimeSeries.from_dict(data, counters=counters)
+    assert series.names == ['cpu/cpu0/busy_pct', 'net/eth0/rx_bytes']
+    assert series.kinds == {'cpu/cpu0/busy_pct': 'gauge', 'net/eth0/rx_bytes': 'counter'}
+    assert series['net/eth0/rx_bytes'].tolist() == [100, 100, 300]
+    assert np.isnan(series['cpu/cpu0/busy_pct'][1])
+    assert series.to_dict()['columns']['cpu/cpu0/busy_pct'] == [1.0, None, 3.0]
+
+    with pytest.raises(ValueError):
+        TimeSeries.from_dict(data, counters=dict(cpu={'cpu0': {'busy_pct': [1, 2, 3]}}))
+
+
+def test_select_and_downsample():
+    series = sample_series()
+    selected = series.select(START_US + 2000000, START_US + 5000000, columns=['disk/sda/reads'])
+    assert selected.names == ['disk/sda/reads']
+    assert selected['disk/sda/reads'].tolist() == [10 ** 9 + 200] * 2 + [10 ** 9 + 400]
+
+    downsampled = series.downsample(5000000)
+    assert len(downsampled) == 2
+    # Gauges are averaged ignoring NaN, counters keep the last value of the window
+    assert downsampled['cpu/busy_pct'].tolist() == pytest.approx([(10 + 11 + 12 + 14) / 4, 17.0])
+    assert downsampled['disk/sda/reads'].tolist() == [10 ** 9 + 400, 10 ** 9 + 900]
+
+
+@pytest.mark.parametrize('encoding', ['delta', 'raw'])
+def test_store_round_trip(tmp_path, encoding):
+    store = TimeSeriesStore(str(tmp_path / 'store'), encoding=encoding)
+    first, second = sample_series(), sample_series(start_us=START_US + 10 ** 7)
+    store.append(first)
+    store.append(second)
+    assert len(store) == 20
+
+    reopened = TimeSeriesStore(str(tmp_path / 'store'), encoding='raw' if encoding == 'delta' else 'delta')
+    assert reopened.encoding == encoding
+    read = reopened.read()
+    assert read.timestamps.tolist() == first.timestamps.tolist() + second.timestamps.tolist()
+    assert read['disk/sda/reads'].tolist() == first['disk/sda/reads'].tolist() * 2
+    np.testing.assert_array_equal(read['cpu/busy_pct'], np.concatenate([first['cpu/busy_pct']] * 2))
+
+    with pytest.raises(ValueError):
+        reopened.append(sample_series())
+
+
+def test_store_delta_files_are_small(tmp_path):
+    delta = TimeSeriesStore(str(tmp_path / 'delta'))
+    raw = TimeSeriesStore(str(tmp_path / 'raw'), encoding='raw')
+    delta.append(sample_series(rows=1000))
+    raw.append(sample_series(rows=1000))
+    chunk = delta.chunks()[0]
+    timestamps = np.load(tmp_path / 'delta' / chunk['name'] / 'timestamp_us.npy')
+    assert timestamps.dtype == np.int8
+    assert chunk['bases']['timestamp_us'] == [START_US, 1000000]
+    assert 'bases' not in raw.chunks()[0]
+
+
+@pytest.mark.parametrize('encoding', ['delta', 'raw'])
+def test_store_range_reads(tmp_path, encoding):
+    store = TimeSeriesStore(str(tmp_path / 'store'), encoding=encoding)
+    for chunk in range(3):
+        store.append(sample_series(start_us=START_US + chunk * 10 ** 7))
+
+    start_us, end_us = START_US + 15 * 10 ** 6, START_US + 22 * 10 ** 6
+    assert [chunk['name'] for chunk in store.chunks(start_us, end_us)] == ['chunk-000001', 'chunk-000002']
+    read = store.read(start_us, end_us, columns=['disk/sda/reads'])
+    assert read.names == ['disk/sda/reads']
+    assert read.timestamps.tolist() == (START_US + 10 ** 6 * np.arange(15, 22)).tolist()
+
+    assert store.read_column('timestamp_us', start_us, end_us).tolist() == read.timestamps.tolist()
+    assert store.read_column('disk/sda/reads', start_us, end_us).tolist() == read['disk/sda/reads'].tolist()
+    assert len(store.read_column('cpu/busy_pct', START_US + 10 ** 9)) == 0
+    assert len(store.read(START_US + 10 ** 9)) == 0
+
+
+@pytest.mark.parametrize('encoding', ['delta', 'raw'])
+def test_store_columns_missing_from_chunks(tmp_path, encoding):
+    store = TimeSeriesStore(str(tmp_path / 'store'), encoding=encoding)
+    store.append(TimeSeries.from_arrays([START_US, START_US + 1], {'a': [1.0, 2.0]}))
+    store.append(TimeSeries.from_arrays([START_US + 2, START_US + 3], {'count': [7, 9]}, {'count': 'counter'}))
+
+    read = store.read()
+    assert read['count'].tolist() == [0, 0, 7, 9]
+    assert np.isnan(read['a'][2:]).all()
+    assert store.read_column('count').tolist() == [0, 0, 7, 9]
+
+    with pytest.raises(ValueError):
+        store.append(TimeSeries.from_arrays([START_US + 4], {'a': [1]}, {'a': 'counter'}))
+
+
+def test_store_replaces_chunk_left_by_crash(tmp_path):
+    path = tmp_path / 'store'
+    store = TimeSeriesStore(str(path))
+    store.append(sample_series())
+    # An append that crashed before the index was written leaves a directory the index doesn't list
+    (path / 'chunk-000001').mkdir()
+    (path / 'chunk-000001' / 'timestamp_us.npy').write_bytes(b'partial')
+    (path / '.chunk-000001.tmp').mkdir()
+
+    reopened = TimeSeriesStore(str(path))
+    reopened.append(sample_series(start_us=START_US + 10 ** 7))
+    assert sorted(entry.name for entry in path.iterdir()) == ['chunk-000000', 'chunk-000001', 'index.json']
+    assert len(TimeSeriesStore(str(path)).read()) == 20